@@ -27,10 +27,12 @@ import logging
 import time
 try:
     from pydio.job.localdb import DBCorruptedException, ClosingCursor
+    from pydio.job.db_connections import SqliteConnections
     from pydio.utils.pydio_profiler import pydio_profile
     from pydio.utils.global_config import GlobalConfigManager
 except ImportError:
     from job.localdb import DBCorruptedException, ClosingCursor
+    from job.db_connections import SqliteConnections
     from utils.pydio_profiler import pydio_profile
     from utils.global_config import GlobalConfigManager
 
@@ -69,14 +71,13 @@ class EventLogger():
     @pydio_profile
     def log(self, event_type, message, action, status, source='', target='', uniq=False):
         insert = True
-        conn = sqlite3.connect(self.db, timeout=self.timeout)
+        conn = SqliteConnections.for_db(self.db, self.timeout).get()
         if uniq:
             try:
                 sel = conn.execute('SELECT id FROM events WHERE type=?', (event_type, ))
                 for r in sel:
                     insert = False
             except sqlite3.OperationalError as oe:
-                conn.close()
                 raise DBCorruptedException(oe)
 
         try:
@@ -91,10 +92,9 @@ class EventLogger():
             conn.commit()
         except sqlite3.OperationalError as e:
             logging.error('sql insert error while trying to log event : %s ' % (e.message,))
-            conn.close()
+            conn.rollback()
             time.sleep(.05)
             self.log(event_type, message, action, status, source, target, uniq)
-        conn.close()
 
     @pydio_profile
     def get_all(self, limit=10, offset=0, filter_type=None, filter_action=None):
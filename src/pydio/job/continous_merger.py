@@ -118,7 +118,6 @@ class ContinuousDiffMerger(threading.Thread):
             proxies=ConfigManager.Instance().get_defined_proxies(),
             timeout=job_config.timeout
         )
-        self.system = SystemSdk(job_config.directory)
         self.remote_seq = 0
         self.local_seq = 0
         self.local_target_seq = 0
@@ -126,6 +125,7 @@ class ContinuousDiffMerger(threading.Thread):
         self.local_seqs = []
         self.remote_seqs = []
         self.db_handler = LocalDbHandler(self.configs_path, job_config.directory)
+        self.system = SystemSdk(job_config.directory, hash_cache=self.db_handler.hash_cache)
         self.interrupt = False
         self.event_timer = 2
         self.online_timer = job_config.online_timer
@@ -138,6 +138,8 @@ class ContinuousDiffMerger(threading.Thread):
         self.current_tasks = []
         self.event_handler = None
         self.watcher = None
+        self.compactor = None
+        self.last_compaction = None
         self.watcher_first_run = True
         # TODO: TO BE LOADED FROM CONFIG
         self.storage_watcher = job_config.label.startswith('LSYNC')
@@ -151,7 +153,10 @@ class ContinuousDiffMerger(threading.Thread):
             self.event_handler = SqlEventHandler(includes=job_config.filters['includes'],
                                                  excludes=job_config.filters['excludes'],
                                                  basepath=job_config.directory,
-                                                 job_data_path=self.configs_path)
+                                                 job_data_path=self.configs_path,
+                                                 poolsize=job_config.poolsize,
+                                                 hash_processes=(job_config.hashing_pool == 'processes'),
+                                                 local_hash=job_config.local_hash)
             self.watcher = LocalWatcher(job_config.directory,
                                         self.configs_path,
                                         event_handler=self.event_handler)
@@ -253,6 +258,10 @@ class ContinuousDiffMerger(threading.Thread):
             eta = remaining_operations * self.global_progress['total_time'] / self.global_progress['queue_done']
 
         self.global_progress['eta'] = eta
+        if self.watcher:
+            self.global_progress['local_events'] = self.watcher.get_metrics()
+        if self.last_compaction:
+            self.global_progress['journal_compaction'] = self.last_compaction
 
         # logging.info(self.global_progress)
         return self.global_progress
@@ -379,12 +388,44 @@ class ContinuousDiffMerger(threading.Thread):
         self.processing = False
         self.init_global_progress()
         logger.log_state(_('Synchronized'), 'success')
+        self.compact_journal()
         if self.job_config.frequency == 'manual':
             self.job_status_running = False
             self.sleep_offline()
         else:
             self.sleep_online()
 
+    def detect_conflicts(self):
+        """
+        Run the conflict pass of the current store, its status updates being written in one batch
+        :return: number of conflicts
+        """
+        self.db_handler.buffer_node_status(size=10000)
+        try:
+            return self.current_store.clean_and_detect_conflicts(self.db_handler)
+        finally:
+            self.db_handler.flush_node_status(stop=True)
+
+    def compact_journal(self):
+        """
+        Prune, in the background, the local changes acknowledged by the last cycle
+        """
+        if self.compactor and self.compactor.is_alive():
+            return
+        self.compactor = threading.Thread(target=self.run_compaction, args=(self.local_seq,), name='JournalCompaction')
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    def run_compaction(self, checkpoint):
+        try:
+            stats = self.db_handler.compact_changes(checkpoint, interrupt=lambda: self.interrupt)
+            if stats['rows']:
+                logging.info('Compacted local journal up to %i: %i rows deleted, %i bytes reclaimed'
+                             % (checkpoint, stats['rows'], stats['bytes']))
+            self.last_compaction = stats
+        except Exception as e:
+            logging.exception(e)
+
     def exit_loop_error(self, message):
         self.current_store.close()
         self.init_global_progress()
@@ -472,14 +513,10 @@ class ContinuousDiffMerger(threading.Thread):
                         self.watcher.check_from_snapshot(snap_path, use_transaction=False)
                     self.marked_for_snapshot_pathes = []
 
-                writewait = .5  # To avoid reading events before they're written (db lock) wait for writing to finish
-                totalwait = 0
-                while self.event_handler and self.event_handler.locked and totalwait < 60 * 3:
+                # To avoid reading events before they're written (db lock) wait for writing to finish
+                if self.event_handler and self.event_handler.locked:
                     logging.info("Waiting for changes to be written before retrieving remote changes.")
-                    if writewait < 5:
-                        writewait += .5
-                    time.sleep(writewait)
-                    totalwait += writewait
+                    self.event_handler.wait_for_writes(60 * 3)
                 # Load local and/or remote changes, depending on the direction
                 self.current_store = SqliteChangeStore(self.configs_path + '/changes.sqlite',
                                                        self.job_config.filters['includes'],
@@ -615,23 +652,23 @@ class ContinuousDiffMerger(threading.Thread):
                 self.update_min_seqs_from_store()
 
                 logging.debug('Store conflicts ' + self.job_config.id)
-                store_conflicts = self.current_store.clean_and_detect_conflicts(self.db_handler)
+                store_conflicts = self.detect_conflicts()
                 if store_conflicts:
                     if self.job_config.solve == 'both':
                         logging.info('Marking nodes SOLVED:KEEPBOTH')
-                        for row in self.db_handler.list_conflict_nodes():
-                            self.db_handler.update_node_status(row['node_path'], 'SOLVED:KEEPBOTH')
-                        store_conflicts = self.current_store.clean_and_detect_conflicts(self.db_handler)
+                        self.db_handler.update_bulk_node_status([(row['node_path'], 'SOLVED:KEEPBOTH', '')
+                                                                 for row in self.db_handler.list_conflict_nodes()])
+                        store_conflicts = self.detect_conflicts()
                     if self.job_config.solve == 'local':
                         logging.info('Marking nodes SOLVED:KEEPLOCAL')
-                        for row in self.db_handler.list_conflict_nodes():
-                            self.db_handler.update_node_status(row['node_path'], 'SOLVED:KEEPLOCAL')
-                        store_conflicts = self.current_store.clean_and_detect_conflicts(self.db_handler)
+                        self.db_handler.update_bulk_node_status([(row['node_path'], 'SOLVED:KEEPLOCAL', '')
+                                                                 for row in self.db_handler.list_conflict_nodes()])
+                        store_conflicts = self.detect_conflicts()
                     if self.job_config.solve == 'remote':
                         logging.info('Marking nodes SOLVED:KEEPREMOTE')
-                        for row in self.db_handler.list_conflict_nodes():
-                            self.db_handler.update_node_status(row['node_path'], 'SOLVED:KEEPREMOTE')
-                        store_conflicts = self.current_store.clean_and_detect_conflicts(self.db_handler)
+                        self.db_handler.update_bulk_node_status([(row['node_path'], 'SOLVED:KEEPREMOTE', '')
+                                                                 for row in self.db_handler.list_conflict_nodes()])
+                        store_conflicts = self.detect_conflicts()
 
                 if store_conflicts:
                     logging.info('Conflicts detected, cannot continue!')
@@ -698,7 +735,11 @@ class ContinuousDiffMerger(threading.Thread):
                             set(self.current_store.find_modified_parents()) - set(self.marked_for_snapshot_pathes))
                     if not self.processing:
                         self.processing = True
-                        self.current_store.process_changes_with_callback(processor_callback)
+                        self.db_handler.buffer_node_status()
+                        try:
+                            self.current_store.process_changes_with_callback(processor_callback)
+                        finally:
+                            self.db_handler.flush_node_status(stop=True)
                         # logging.info("Updating seqs")
                         self.current_store.process_pending_changes()
                         self.update_min_seqs_from_store(success=True)
@@ -776,6 +817,9 @@ class ContinuousDiffMerger(threading.Thread):
             self.processing = False
             logging.debug('Finished this cycle, waiting for %i seconds' % self.online_timer)
             very_first = False
+        if self.event_handler:
+            # the hashing workers would outlive the job otherwise
+            self.event_handler.close()
 
     def start_watcher(self):
         if self.watcher:
@@ -0,0 +1,142 @@
+#
+#  Copyright 2007-2014 Charles du Jeu - Abstrium SAS <team (at) pyd.io>
+#  This file is part of Pydio.
+#
+#  Pydio is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Pydio is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Pydio.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The latest code can be found at <http://pyd.io/>.
+#
+import os
+import sqlite3
+import logging
+import threading
+import weakref
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3.Connection does not support weak references, its subclasses do.
+    """
+    pass
+
+
+class SqliteConnections(object):
+    """
+    Long-lived connections to one sqlite file. Each thread gets its own connection, opened on first use and kept
+    until the thread ends, or replaced by the thread itself after close_all(). The database is switched to WAL
+    journal mode, so that readers (UI, merger) never block the writer (watcher) and the writer never blocks them.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    # Pragmas applied to every new connection. synchronous=NORMAL is safe in WAL mode: a power loss can only lose
+    # the last transactions, it cannot corrupt the database.
+    pragmas = [
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -8000",
+        "PRAGMA mmap_size = 67108864",
+        "PRAGMA temp_store = MEMORY",
+    ]
+    cached_statements = 256
+
+    @classmethod
+    def for_db(cls, db, timeout=30):
+        """
+        :param db: path to the sqlite file
+        :param timeout: how long a statement waits for a lock before raising OperationalError
+        :return: the SqliteConnections shared by every user of this file
+        """
+        key = os.path.abspath(db)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(db, timeout)
+            return cls._instances[key]
+
+    @classmethod
+    def close_db(cls, db):
+        """
+        Close the connections to a database, before deleting it for example. The threads still running close theirs on
+        their next use, see close_all()
+        :param db: path to the sqlite file
+        """
+        with cls._instances_lock:
+            instance = cls._instances.get(os.path.abspath(db))
+        if instance:
+            instance.close_all()
+
+    def __init__(self, db, timeout=30):
+        self.db = db
+        self.timeout = timeout
+        self.local = threading.local()
+        # connection returned by get() => its thread
+        self.owners = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def open(self):
+        """
+        Open a new dedicated connection, the caller is responsible for closing it
+        :return: PooledConnection
+        """
+        conn = sqlite3.connect(self.db, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=self.cached_statements, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if mode.lower() != 'wal':
+            logging.debug("WAL journal mode not available for %s, using %s" % (self.db, mode))
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def get(self, name='conn'):
+        """
+        :param name: a thread may keep several connections, one per name: the commits and rollbacks on one of them
+        never touch the changes pending on the others
+        :return: the connection of the current thread. Never close it, commit or rollback instead.
+        """
+        if not hasattr(self.local, 'conns'):
+            self.local.conns = {}
+        conn, generation = self.local.conns.get(name, (None, None))
+        if conn is not None and generation != self.generation:
+            # close_all() was called meanwhile
+            self.close(conn)
+            conn = None
+        if conn is None:
+            conn = self.open()
+            with self.lock:
+                self.owners[conn] = threading.current_thread()
+            self.local.conns[name] = conn, self.generation
+        return conn
+
+    def close(self, conn):
+        with self.lock:
+            self.owners.pop(conn, None)
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logging.debug("Error while closing connection to %s: %s" % (self.db, e))
+
+    def close_all(self):
+        """
+        Make every connection returned by get() stale. The ones of the current thread and of the threads that ended
+        are closed now; another thread may be using its own right now, so it closes it and opens a new one on its
+        next get(). The dedicated connections of open() are left to their callers.
+        """
+        current = threading.current_thread()
+        with self.lock:
+            self.generation += 1
+            connections = [conn for conn, thread in self.owners.items() if thread is current or not thread.is_alive()]
+        for conn in connections:
+            self.close(conn)
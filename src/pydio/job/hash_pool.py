@@ -0,0 +1,167 @@
+#
+#  Copyright 2007-2014 Charles du Jeu - Abstrium SAS <team (at) pyd.io>
+#  This file is part of Pydio.
+#
+#  Pydio is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Pydio is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Pydio.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The latest code can be found at <http://pyd.io/>.
+#
+import os
+import hashlib
+import logging
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from pydio.utils.functions import hashfile, stat_columns, get_hasher
+except ImportError:
+    from utils.functions import hashfile, stat_columns, get_hasher
+
+# Files up to this size are fully read when indexed. Bigger files only get a sampled fingerprint, their MD5 is
+# computed later by the hashing pass.
+FULL_HASH_LIMIT = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+SAMPLES = 4
+
+
+def fingerprint_file(path, algorithm='md5'):
+    """
+    Fast identity of a file: its size plus the hash of its head, its tail and a few blocks in between. Small files
+    are hashed whole. With md5, the fingerprint of a small file is its MD5 and it is returned as such. With another
+    algorithm the fingerprint is prefixed by the algorithm name, and the MD5 is always left to the hashing pass.
+    :param path: full path of the file
+    :param algorithm: name of the local hash algorithm of the job, see utils.functions.hash_providers()
+    :return: tuple (fingerprint, md5, stat_result). md5 is None when it was not computed.
+    """
+    prefix = '' if algorithm == 'md5' else algorithm + ':'
+    with open(path, 'rb') as fd:
+        stat_result = os.fstat(fd.fileno())
+        size = stat_result.st_size
+        if size <= FULL_HASH_LIMIT:
+            digest = hashfile(fd, get_hasher(algorithm))
+            return prefix + digest, None if prefix else digest, stat_result
+        hasher = get_hasher(algorithm)
+        hasher.update(str(size))
+        step = (size - SAMPLE_SIZE) // (SAMPLES + 1)
+        for offset in [step * i for i in range(SAMPLES + 1)] + [size - SAMPLE_SIZE]:
+            fd.seek(offset)
+            hasher.update(fd.read(SAMPLE_SIZE))
+    # prefixed, so that it can never be mistaken for the hash of a small file
+    return 'fp:' + prefix + hasher.hexdigest(), None, stat_result
+
+
+def fingerprint_row(task):
+    """
+    Build the index row of a new file. Runs inside the pool workers, so it must not touch the database.
+    :param task: tuple (basepath, node_path, algorithm)
+    :return: tuple of the ajxp_index values (node_path, bytesize, md5, mtime, fingerprint, mode, ino, dev, mtime_ns,
+    ctime_ns), or None if the file cannot be read
+    """
+    base, node_path, algorithm = task
+    try:
+        fingerprint, md5, stat_result = fingerprint_file(base + node_path, algorithm)
+    except (IOError, OSError) as e:
+        logging.debug('Skipping file %s: %s' % (base + node_path, e))
+        return None
+    return (node_path, stat_result.st_size, md5 or 'HASHME', stat_result.st_mtime, fingerprint) + \
+        stat_columns(stat_result)
+
+
+def hash_row(task):
+    """
+    Hash one file of the index. Runs inside the pool workers, so it must not touch the database.
+    :param task: tuple (basepath, node_path)
+    :return: a dict containing SQL code and values to be executed later by the db writer, plus the stat the hash
+    was computed for when the file was read, or None if the file
+    cannot be read right now (it will stay HASHME and be picked up by the next pass)
+    """
+    base, node_path = task
+    full_path = base + node_path
+    try:
+        with open(full_path, 'rb') as fd:
+            stat_result = os.fstat(fd.fileno())
+            md5 = hashfile(fd, hashlib.md5())
+    except (IOError, OSError) as e:
+        if os.path.exists(full_path):
+            logging.debug('Cannot hash %s for now: %s' % (full_path, e))
+            return None
+        # delete the index of non existing files
+        return {"sql": "DELETE FROM ajxp_index WHERE node_path=? AND md5='HASHME'", "values": (node_path,)}
+    t = (
+        stat_result.st_size,
+        md5,
+        stat_result.st_mtime
+    ) + stat_columns(stat_result) + (
+        node_path,
+    )
+    return {"sql": "UPDATE ajxp_index SET bytesize=?, md5=?, mtime=?, mode=?, ino=?, dev=?, mtime_ns=?, ctime_ns=? "
+                   "WHERE node_path=? AND md5='HASHME'",
+            "values": t, "stat": stat_result}
+
+
+class HashPool(object):
+    """
+    Bounded pool of workers hashing files in parallel. Results are handed back, as soon as they are ready, to
+    the thread iterating over imap_unordered(): that thread stays the only one writing to the database.
+    The workers are started on first use and shared by the threads of the job (background hashing pass, merger,
+    bulk indexing).
+    """
+
+    def __init__(self, size=None, use_processes=False):
+        """
+        :param size: number of workers, defaults to the number of CPUs when not set
+        :param use_processes: use a pool of processes instead of threads (avoids the GIL for MD5 on small files)
+        """
+        if not size or size < 1:
+            try:
+                size = multiprocessing.cpu_count()
+            except NotImplementedError:
+                size = 4
+        self.size = int(size)
+        self.use_processes = use_processes
+        self.pool = None
+        # guards the creation and the closing of the workers
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            return self.open_locked()
+
+    def open_locked(self):
+        if self.pool is None:
+            if self.use_processes:
+                self.pool = multiprocessing.Pool(self.size)
+            else:
+                self.pool = ThreadPool(self.size)
+            logging.debug('Started hashing pool of %i %s' % (self.size, 'processes' if self.use_processes else 'threads'))
+        return self.pool
+
+    def imap_unordered(self, tasks, func=hash_row):
+        """
+        :param tasks: list of tasks to feed to func
+        :param func: module level function (it has to be picklable when using processes)
+        :return: iterator over the results, in completion order
+        """
+        chunksize = max(1, min(32, len(tasks) // (self.size * 4)))
+        # the tasks are submitted before close() can stop the workers, which then finish them: the iterator keeps
+        # its pool and still yields every result
+        with self.lock:
+            return self.open_locked().imap_unordered(func, tasks, chunksize)
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+            if pool is not None:
+                pool.close()
+                pool.join()
@@ -0,0 +1,239 @@
+#
+#  Copyright 2007-2014 Charles du Jeu - Abstrium SAS <team (at) pyd.io>
+#  This file is part of Pydio.
+#
+#  Pydio is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Pydio is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Pydio.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The latest code can be found at <http://pyd.io/>.
+#
+import os
+import mmap
+import struct
+import logging
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from pydio.job.localdb import IndexStat, subtree_bounds
+except ImportError:
+    from job.localdb import IndexStat, subtree_bounds
+
+MAGIC = 'PYDIOIDX'
+VERSION = 1
+# magic, version, number of rows, size of the paths blob, then the stamp of the index: rows, last change, checksum
+HEADER = struct.Struct('<8sIxxxxqqqqq')
+COLUMNS = ('mode', 'ino', 'dev', 'bytesize', 'mtime_ns', 'ctime_ns')
+# rows packed at once when writing the columns
+CHUNK = 4096
+
+
+def index_stamp(conn):
+    """
+    Cheap identity of the content of ajxp_index, computed inside SQLite without building any Python row. The last
+    change catches the inserts, deletes, moves and journaled updates, the checksum the stat updates done with the
+    journal muted.
+    :param conn: sqlite3 connection to the index
+    :return: tuple (rows, last change seq, checksum)
+    """
+    rows, checksum = conn.execute(
+        "SELECT count(*), ifnull(sum((mode % 65521) + (ifnull(ino, 0) % 2147483629) + (ifnull(dev, 0) % 65521) "
+        "+ (ifnull(bytesize, 0) % 2147483629) + (ifnull(mtime_ns, 0) % 2147483629) "
+        "+ (ifnull(ctime_ns, 0) % 2147483629) + length(node_path) * 131 + unicode(substr(node_path, -1))), 0) "
+        "FROM ajxp_index WHERE mode NOT NULL").fetchone()
+    last_seq = conn.execute("SELECT ifnull(max(seq), 0) FROM ajxp_changes").fetchone()[0]
+    return int(rows), int(last_seq), int(checksum)
+
+
+def write_at(f, position, data):
+    """
+    :return: position following the data written
+    """
+    f.seek(position)
+    f.write(data)
+    return position + len(data)
+
+
+def write_index_snapshot(conn, path):
+    """
+    Dump the stat columns of ajxp_index to a sidecar file: a header, one packed array of 64 bits integers per column,
+    the offsets of the paths, then the UTF-8 paths themselves in the order of the index. The file is replaced
+    atomically.
+    :param conn: sqlite3 connection to the index, dedicated to this call
+    :param path: path of the sidecar file
+    :return: number of rows written
+    """
+    tmp_path = path + '.tmp'
+    # the stamp and the rows are read in the same transaction, so that they always match
+    conn.isolation_level = None
+    conn.execute("BEGIN")
+    try:
+        stamp = index_stamp(conn)
+        # the number of rows is known from the stamp: every section is written in place as the rows come, nothing
+        # is kept in memory but the current chunk
+        count = stamp[0]
+        positions = [HEADER.size + 8 * count * i for i in range(len(COLUMNS) + 1)]
+        blob_position = positions[-1] + 8 * (count + 1)
+        offset = 0
+        res = conn.cursor()
+        res.row_factory = None
+        res.execute("SELECT node_path, mode, ino, dev, ifnull(bytesize, 0), ifnull(mtime_ns, 0), "
+                    "ifnull(ctime_ns, 0) FROM ajxp_index WHERE mode NOT NULL ORDER BY node_path")
+        with open(tmp_path, 'wb') as f:
+            while True:
+                rows = res.fetchmany(CHUNK)
+                if not rows:
+                    break
+                pack = struct.Struct('<%iq' % len(rows)).pack
+                keys = [row[0].encode('utf-8') for row in rows]
+                row_offsets = []
+                for key in keys:
+                    row_offsets.append(offset)
+                    offset += len(key)
+                for i in range(len(COLUMNS)):
+                    positions[i] = write_at(f, positions[i], pack(*[int(row[i + 1] or 0) for row in rows]))
+                positions[-1] = write_at(f, positions[-1], pack(*row_offsets))
+                blob_position = write_at(f, blob_position, ''.join(keys))
+            write_at(f, positions[-1], struct.pack('<q', offset))
+            # last, so that an interrupted write never looks complete
+            write_at(f, 0, HEADER.pack(MAGIC, VERSION, count, offset, *stamp))
+    finally:
+        conn.execute("COMMIT")
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return count
+
+
+class IndexSnapshot(object):
+    """
+    Read only, memory mapped view of a sidecar written by write_index_snapshot(). Walking it does not involve SQLite
+    nor any unpacking of the rows that are not used. When NumPy is available the columns are arrays sharing the
+    mapped memory and the mtimes are compared by batches, otherwise the values are unpacked one by one.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the sidecar file
+        :raise ValueError: if the file is not a sidecar of a known version
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.map) < HEADER.size:
+                raise ValueError('Truncated index snapshot')
+            magic, version, self.count, blob_size, rows, last_seq, checksum = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('Unknown index snapshot format')
+            self.stamp = (rows, last_seq, checksum)
+            offset = HEADER.size
+            self.column_offsets = {}
+            for name in COLUMNS:
+                self.column_offsets[name] = offset
+                offset += 8 * self.count
+            self.offsets_offset = offset
+            self.blob_offset = offset + 8 * (self.count + 1)
+            if len(self.map) != self.blob_offset + blob_size:
+                raise ValueError('Truncated index snapshot')
+            self.arrays = None
+            if numpy is not None:
+                self.arrays = dict((name, numpy.frombuffer(self.map, '<i8', self.count, self.column_offsets[name]))
+                                   for name in COLUMNS)
+        except Exception:
+            self.map.close()
+            raise
+
+    @classmethod
+    def load(cls, path, conn):
+        """
+        :param path: path of the sidecar file
+        :param conn: sqlite3 connection to the index it was written from
+        :return: IndexSnapshot or None if the file is missing, unreadable or does not match the index anymore
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            snapshot = cls(path)
+        except (IOError, OSError, ValueError, mmap.error, struct.error) as e:
+            logging.info('Ignoring the index snapshot: %s' % e)
+            return None
+        if snapshot.stamp != index_stamp(conn):
+            logging.info('Ignoring the index snapshot, the index changed since it was written')
+            snapshot.close()
+            return None
+        return snapshot
+
+    def close(self):
+        # the arrays share the mapped memory, they have to go first
+        self.arrays = None
+        self.map.close()
+
+    def value(self, name, i):
+        return struct.unpack_from('<q', self.map, self.column_offsets[name] + 8 * i)[0]
+
+    def key(self, i):
+        start, end = struct.unpack_from('<qq', self.map, self.offsets_offset + 8 * i)
+        return self.map[self.blob_offset + start:self.blob_offset + end]
+
+    def stat(self, i):
+        """
+        :return: IndexStat of the row i
+        """
+        return IndexStat(*[self.value(name, i) for name in COLUMNS])
+
+    def bisect(self, key):
+        """
+        :return: index of the first row whose key is not lower than key
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def entries(self, sub_folder=None):
+        """
+        :param sub_folder: optional folder, only this folder and its content are returned
+        :return: iterator of tuples (sort key, node_path, row), in the order of the index
+        """
+        start, end = 0, self.count
+        if sub_folder:
+            low, high = subtree_bounds(sub_folder)
+            start = self.bisect(sub_folder.encode('utf-8'))
+            end = self.bisect(high.encode('utf-8'))
+            # the folder itself, then its descendants: the names between them, like "folder-x", are skipped
+            if start < self.count and self.key(start) == sub_folder.encode('utf-8'):
+                yield self.key(start), self.key(start).decode('utf-8'), start
+            start = self.bisect(low.encode('utf-8'))
+        for i in xrange(start, end):
+            key = self.key(i)
+            yield key, key.decode('utf-8'), i
+
+    def modified_rows(self, rows, mtimes):
+        """
+        :param rows: list of rows
+        :param mtimes: list of the current mtimes of these rows, in whole seconds
+        :return: list of the positions in rows of the entries whose mtime differs from the indexed one
+        """
+        if not rows:
+            return []
+        if self.arrays is not None:
+            indexed = (self.arrays['mtime_ns'][numpy.array(rows, numpy.intp)] / 1e9).astype(numpy.int64)
+            return numpy.flatnonzero(indexed != numpy.array(mtimes, numpy.int64)).tolist()
+        return [position for position, row in enumerate(rows)
+                if long(self.value('mtime_ns', row) / 1e9) != mtimes[position]]
@@ -0,0 +1,489 @@
+#
+#  Copyright 2007-2014 Charles du Jeu - Abstrium SAS <team (at) pyd.io>
+#  This file is part of Pydio.
+#
+#  Pydio is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Pydio is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Pydio.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The latest code can be found at <http://pyd.io/>.
+#
+import os
+import sys
+import stat
+import time
+import errno
+import struct
+import select
+import logging
+import threading
+import ctypes
+import ctypes.util
+from collections import deque, OrderedDict
+
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, DirMovedEvent, \
+    FileCreatedEvent, FileDeletedEvent, FileMovedEvent, FileModifiedEvent
+try:
+    from pydio.utils.functions import scandir
+except ImportError:
+    from utils.functions import scandir
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+EVENT_HEADER = struct.Struct('iIII')
+FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+# seconds an IN_MOVED_FROM waits for its IN_MOVED_TO, it is a move out of the folder after that
+MOVE_DELAY = 0.5
+
+
+def default_watch_budget():
+    """
+    :return: half of the watches allowed to the user by the kernel, the other applications need some too
+    """
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            return max(1, int(f.read()) // 2)
+    except (IOError, ValueError):
+        return 4096
+
+
+def list_subdirectories(path):
+    """
+    :param path: full path of a directory
+    :return: tuple (names of its subdirectories, names of the symbolic links to directories), d_type is used when
+    available so that the files are not stat'ed
+    """
+    dirs, links = [], []
+    if scandir:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_symlink() and entry.is_dir():
+                    links.append(entry.name)
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            try:
+                if stat.S_ISDIR(os.lstat(full_path).st_mode):
+                    dirs.append(name)
+                elif os.path.islink(full_path) and os.path.isdir(full_path):
+                    links.append(name)
+            except OSError:
+                continue
+    return dirs, links
+
+
+def file_stats(path):
+    """
+    :param path: full path of a directory
+    :return: dict, name => (size, mtime) of the entries of the directory that are not directories
+    """
+    stats = {}
+    if scandir:
+        for entry in scandir(path):
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    stat_result = entry.stat(follow_symlinks=False)
+                    stats[entry.name] = (stat_result.st_size, stat_result.st_mtime)
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(path):
+            try:
+                stat_result = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            if not stat.S_ISDIR(stat_result.st_mode):
+                stats[name] = (stat_result.st_size, stat_result.st_mtime)
+    return stats
+
+
+class InotifyObserver(threading.Thread):
+    """
+    Linux observer talking to inotify directly, with the same schedule / start / stop / join interface as the
+    watchdog observers.
+    inotify needs one watch per directory and the kernel caps them (fs.inotify.max_user_watches). The directories
+    are watched breadth first until the budget is spent, the others are polled: every poll_interval seconds, a
+    change of their mtime triggers the rescan of the directory, and a change of the size or mtime of one of their
+    files is dispatched as a modification. Every change seen counts as activity, and a polled directory more active
+    than the least active watched one takes its watch.
+    When the kernel queue overflows, the directories active in the last seconds are rescanned.
+    """
+
+    def __init__(self, max_watches=0, poll_interval=30.0, rescan=None, overflow_window=5.0):
+        """
+        :param max_watches: maximum number of watches, 0 for half of the kernel limit
+        :param poll_interval: seconds between two checks of the mtimes of the directories left without a watch
+        :param rescan: callable(sub_folder, skip_unchanged) asking for the rescan of a folder, relative to the watched
+        path
+        :param overflow_window: seconds, the directories active during this window are rescanned after an overflow
+        :raise OSError: if inotify is not available
+        """
+        threading.Thread.__init__(self, name='InotifyObserver')
+        self.daemon = True
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.max_watches = max_watches if max_watches > 0 else default_watch_budget()
+        self.poll_interval = poll_interval
+        self.rescan = rescan or (lambda sub_folder: None)
+        self.overflow_window = overflow_window
+        self.handler = None
+        self.basepath = None
+        self.interrupt = False
+        # wd => full path, and full path => wd
+        self.watches = {}
+        self.paths = {}
+        # directories without a watch => (their mtime, file_stats() of their files) when last checked
+        self.polled = {}
+        # directory => number of changes seen, and time of the last one
+        self.activity = {}
+        self.last_activity = {}
+        # cookie => (time, path, is_dir) of the IN_MOVED_FROM waiting for their IN_MOVED_TO
+        self.moved_from = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {
+            'events': 0,
+            'overflows': 0,
+            'rescans': 0,
+            'promotions': 0,
+            'watch_limit_hits': 0
+        }
+
+    def schedule(self, handler, path, recursive=True):
+        """
+        :param handler: receives the watchdog events through its dispatch() method
+        :param path: folder to watch, always recursively
+        """
+        self.handler = handler
+        self.basepath = os.path.normpath(path)
+
+    def stop(self):
+        self.interrupt = True
+
+    def get_metrics(self):
+        """
+        :return: dict, number of watches and of polled directories, and counters of events, overflows and rescans
+        """
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics.update(watches=len(self.watches), watch_budget=self.max_watches,
+                           polled_directories=len(self.polled))
+        return metrics
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.metrics[name] += value
+
+    def run(self):
+        try:
+            self.watch_tree(self.basepath)
+            logging.info('Watching %s with %i inotify watches, %i directories polled'
+                         % (self.basepath, len(self.watches), len(self.polled)))
+            last_poll = time.time()
+            while not self.interrupt:
+                if select.select([self.fd], [], [], 0.5)[0]:
+                    self.read_events()
+                self.flush_moves(time.time() - MOVE_DELAY)
+                if self.polled and time.time() - last_poll >= self.poll_interval:
+                    self.poll()
+                    last_poll = time.time()
+            # pass on the events already queued by the kernel, the moves out of the folder included
+            self.read_events()
+            self.flush_moves(time.time())
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            os.close(self.fd)
+
+    def add_watch(self, path):
+        """
+        :return: True if the directory is now watched
+        """
+        if path in self.paths:
+            return True
+        if len(self.watches) >= self.max_watches:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(FS_ENCODING), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC:
+                # the kernel limit is lower than expected, other applications use it too
+                self.count('watch_limit_hits')
+                self.max_watches = len(self.watches)
+                logging.warning('inotify watches limit reached after %i watches, the other directories are polled'
+                                % len(self.watches))
+            elif e != errno.ENOENT:
+                logging.debug('Cannot watch %s: %s' % (path, os.strerror(e)))
+            return False
+        if wd in self.watches:
+            # the same directory under a new name, after a move whose source was not watched
+            self.paths.pop(self.watches[wd], None)
+        self.watches[wd] = path
+        self.paths[path] = wd
+        return True
+
+    def remove_watch(self, path):
+        wd = self.paths.pop(path, None)
+        if wd is not None:
+            del self.watches[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def watch_tree(self, root, emit=False):
+        """
+        Watch a directory and its subdirectories, breadth first, the ones beyond the budget are polled.
+        :param root: full path of the directory
+        :param emit: dispatch creation events for the content found, for a directory that just appeared: its
+        content may have been created before it was watched
+        """
+        queue = deque([root])
+        while queue and not self.interrupt:
+            path = queue.popleft()
+            if not self.add_watch(path):
+                self.poll_directory(path)
+            try:
+                dirs, links = list_subdirectories(path)
+                names = os.listdir(path) if emit else []
+            except OSError:
+                continue
+            for name in sorted(dirs):
+                queue.append(os.path.join(path, name))
+            # not followed, to stay out of the symbolic link loops
+            for name in links:
+                self.poll_directory(os.path.join(path, name))
+            if emit:
+                for name in set(names) - set(dirs):
+                    self.dispatch(FileCreatedEvent(os.path.join(path, name)))
+                for name in dirs:
+                    self.dispatch(DirCreatedEvent(os.path.join(path, name)))
+
+    def poll_directory(self, path):
+        try:
+            self.polled[path] = (os.stat(path).st_mtime, file_stats(path))
+        except OSError:
+            pass
+
+    def forget_tree(self, root):
+        """
+        Drop the watches and the state of a directory and of its subdirectories
+        """
+        prefix = root + os.sep
+        for path in [p for p in self.paths if p == root or p.startswith(prefix)]:
+            self.remove_watch(path)
+        for table in (self.polled, self.activity, self.last_activity):
+            for path in [p for p in table if p == root or p.startswith(prefix)]:
+                del table[path]
+
+    def move_tree(self, source, target):
+        """
+        A watched directory was moved inside the folder: its watches follow it, only their paths change
+        """
+        prefix = source + os.sep
+
+        def moved(path):
+            return target + path[len(source):]
+        for wd, path in self.watches.items():
+            if path == source or path.startswith(prefix):
+                del self.paths[path]
+                self.watches[wd] = moved(path)
+                self.paths[moved(path)] = wd
+        for table in (self.polled, self.activity, self.last_activity):
+            for path in [p for p in table if p == source or p.startswith(prefix)]:
+                table[moved(path)] = table.pop(path)
+
+    def dispatch(self, event):
+        self.count('events')
+        self.handler.dispatch(event)
+
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip('\0')
+                offset += EVENT_HEADER.size + length
+                self.handle_event(wd, mask, cookie, name)
+
+    def handle_event(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflow()
+            return
+        if mask & IN_IGNORED:
+            path = self.watches.pop(wd, None)
+            if path is not None and self.paths.get(path) == wd:
+                del self.paths[path]
+            return
+        parent = self.watches.get(wd)
+        if parent is None or not name:
+            return
+        try:
+            path = os.path.join(parent, name.decode(FS_ENCODING))
+        except UnicodeDecodeError:
+            logging.debug('Ignoring a change on a name that cannot be decoded in %s' % parent)
+            return
+        self.touch(parent)
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & IN_CREATE:
+            if is_dir:
+                self.dispatch(DirCreatedEvent(path))
+                self.watch_tree(path, emit=True)
+            else:
+                self.dispatch(FileCreatedEvent(path))
+        elif mask & (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE):
+            if not is_dir:
+                self.dispatch(FileModifiedEvent(path))
+        elif mask & IN_DELETE:
+            self.dispatch(DirDeletedEvent(path) if is_dir else FileDeletedEvent(path))
+            if is_dir:
+                self.forget_tree(path)
+        elif mask & IN_MOVED_FROM:
+            self.moved_from[cookie] = (time.time(), path, is_dir)
+        elif mask & IN_MOVED_TO:
+            source = self.moved_from.pop(cookie, None)
+            if source is None:
+                # moved in from outside of the folder
+                if is_dir:
+                    self.dispatch(DirCreatedEvent(path))
+                    self.watch_tree(path, emit=True)
+                else:
+                    self.dispatch(FileCreatedEvent(path))
+            elif is_dir:
+                self.dispatch(DirMovedEvent(source[1], path))
+                self.move_tree(source[1], path)
+            else:
+                self.dispatch(FileMovedEvent(source[1], path))
+
+    def flush_moves(self, before):
+        """
+        The IN_MOVED_FROM left alone for too long were moves out of the folder
+        """
+        while self.moved_from:
+            cookie, (moved_time, path, is_dir) = next(iter(self.moved_from.items()))
+            if moved_time > before:
+                return
+            del self.moved_from[cookie]
+            self.dispatch(DirDeletedEvent(path) if is_dir else FileDeletedEvent(path))
+            if is_dir:
+                self.forget_tree(path)
+
+    def touch(self, path):
+        self.activity[path] = self.activity.get(path, 0) + 1
+        self.last_activity[path] = time.time()
+
+    def request_rescan(self, paths, skip_unchanged=False):
+        """
+        :param paths: full paths of directories, rescanned with their subdirectories
+        :param skip_unchanged: only the directories modified since they were indexed are listed again
+        """
+        tops = []
+        for path in sorted(paths):
+            if not tops or not (path == tops[-1] or path.startswith(tops[-1] + os.sep)):
+                tops.append(path)
+        for path in tops:
+            self.count('rescans')
+            self.rescan(path[len(self.basepath):] or u'/', skip_unchanged)
+
+    def overflow(self):
+        """
+        The kernel queue overflowed and events were lost: rescan the directories active just before, where the
+        burst most likely happened, and watch the directories created meanwhile. The lost events may belong to any
+        directory, the whole folder is rescanned after them, without the directories that did not change.
+        """
+        self.count('overflows')
+        since = time.time() - self.overflow_window
+        active = [path for path, last in self.last_activity.items() if last >= since] or [self.basepath]
+        logging.warning('inotify queue overflow, rescanning %i directories' % len(active))
+        for path in active:
+            self.watch_tree(path)
+        self.request_rescan(active)
+        if self.basepath not in active:
+            self.request_rescan([self.basepath], skip_unchanged=True)
+
+    def poll(self):
+        """
+        Check the directories without a watch: rescan the ones whose mtime changed, and dispatch the modifications
+        of the files of the others
+        """
+        changed = []
+        active = []
+        for path, (mtime, files) in self.polled.items():
+            try:
+                current = os.stat(path).st_mtime
+                current_files = file_stats(path)
+            except OSError:
+                # its parent sees it disappear
+                del self.polled[path]
+                continue
+            self.polled[path] = (current, current_files)
+            if current != mtime:
+                changed.append(path)
+            else:
+                modified = [name for name, signature in current_files.items()
+                            if files.get(name, signature) != signature]
+                for name in sorted(modified):
+                    self.dispatch(FileModifiedEvent(os.path.join(path, name)))
+                if not modified:
+                    continue
+            self.touch(path)
+            active.append(path)
+        for path in active:
+            self.promote(path)
+        if changed:
+            self.request_rescan(changed)
+
+    def promote(self, path):
+        """
+        Give a watch to a polled directory, taken from the least active watched one if the budget is spent
+        """
+        if path not in self.polled or os.path.islink(path):
+            return
+        if len(self.watches) >= self.max_watches:
+            candidates = [p for p in self.paths if p != self.basepath]
+            if not candidates:
+                return
+            least = min(candidates, key=lambda p: self.activity.get(p, 0))
+            if self.activity.get(least, 0) >= self.activity.get(path, 0):
+                return
+            self.remove_watch(least)
+            self.poll_directory(least)
+        if self.add_watch(path):
+            del self.polled[path]
+            self.count('promotions')
@@ -27,9 +27,11 @@ import logging
 import platform
 import unicodedata
 try:
-    from pydio.utils.functions import Singleton
+    from pydio.utils.functions import Singleton, hash_providers
+    from pydio.job.db_connections import SqliteConnections
 except ImportError:
-    from utils.functions import Singleton
+    from utils.functions import Singleton, hash_providers
+    from job.db_connections import SqliteConnections
 
 
 @Singleton
@@ -100,8 +102,10 @@ class JobsLoader():
         job_data_path = self.build_job_data_path(job_id)
         if os.path.exists(os.path.join(job_data_path, "sequences")):
             os.unlink(os.path.join(job_data_path, "sequences"))
-        if os.path.exists(os.path.join(job_data_path, "pydio.sqlite")):
-            os.unlink(os.path.join(job_data_path, "pydio.sqlite"))
+        SqliteConnections.close_db(os.path.join(job_data_path, "pydio.sqlite"))
+        for name in ("pydio.sqlite", "pydio.sqlite-wal", "pydio.sqlite-shm", "pydio.snapshot"):
+            if os.path.exists(os.path.join(job_data_path, name)):
+                os.unlink(os.path.join(job_data_path, name))
         if parent and os.path.exists(job_data_path):
             import shutil
             shutil.rmtree(job_data_path)
@@ -140,6 +144,10 @@ class JobConfig:
         )
 
         self.timeout = 20
+        # 'threads' or 'processes', workers used to hash the files while indexing
+        self.hashing_pool = 'threads'
+        # hash algorithm used to detect local changes, see utils.functions.hash_providers()
+        self.local_hash = 'md5'
 
         self.hide_up_dir = 'false'
         self.hide_bi_dir = 'false'
@@ -176,7 +184,9 @@ class JobConfig:
                     "hide_up_dir": obj.hide_up_dir,
                     "hide_bi_dir": obj.hide_bi_dir,
                     "hide_down_dir": obj.hide_down_dir,
-                    "poolsize": obj.poolsize
+                    "poolsize": obj.poolsize,
+                    "hashing_pool": obj.hashing_pool,
+                    "local_hash": obj.local_hash
                     }
 
         raise TypeError(repr(JobConfig) + " can't be encoded")
@@ -276,6 +286,13 @@ class JobConfig:
                 job_config.poolsize = obj['poolsize']
             else:
                 job_config.poolsize = 4
+            if 'hashing_pool' in obj and obj['hashing_pool'] in ['threads', 'processes']:
+                job_config.hashing_pool = obj['hashing_pool']
+            if 'local_hash' in obj:
+                if obj['local_hash'] in hash_providers():
+                    job_config.local_hash = obj['local_hash']
+                else:
+                    logging.warning('Hash algorithm %s is not available, using md5' % obj['local_hash'])
             if 'poll_interval' in obj:
                 job_config.online_timer = obj['poll_interval']
             else:
@@ -18,31 +18,54 @@
 #  The latest code can be found at <http://pyd.io/>.
 #
 import threading
+import sqlite3
 import logging
 import stat
 import sys
 import os
 import time
+import heapq
+import pickle
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from watchdog.events import DirCreatedEvent, DirDeletedEvent, DirMovedEvent, \
-    FileCreatedEvent, FileDeletedEvent, FileMovedEvent, FileModifiedEvent
+    FileCreatedEvent, FileDeletedEvent, FileMovedEvent, FileModifiedEvent, FileSystemEventHandler, \
+    EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED
 from watchdog.observers import Observer
 from watchdog.utils import platform
 if platform.is_linux():
     from watchdog.observers.polling import PollingObserver as Observer
-from watchdog.utils.dirsnapshot import DirectorySnapshot, DirectorySnapshotDiff
+from watchdog.utils.dirsnapshot import DirectorySnapshotDiff
 try:
-    from pydio.job.localdb import SqlEventHandler, SqlSnapshot
+    from pydio.job.localdb import SqlEventHandler, IndexStat, indexed_children, subtree_bounds
+    from pydio.job.db_connections import SqliteConnections
+    from pydio.job.index_snapshot import IndexSnapshot, write_index_snapshot
+    from pydio.job.inotify_observer import InotifyObserver
     from pydio.utils.pydio_profiler import pydio_profile
+    from pydio.utils.global_config import GlobalConfigManager
+    from pydio.utils.functions import scan_dir, stat_columns, same_mtime
     from pydio.utils import i18n
     _ = i18n.language.ugettext
 except ImportError:
-    from job.localdb import SqlEventHandler, SqlSnapshot
+    from job.localdb import SqlEventHandler, IndexStat, indexed_children, subtree_bounds
+    from job.db_connections import SqliteConnections
+    from job.index_snapshot import IndexSnapshot, write_index_snapshot
+    from job.inotify_observer import InotifyObserver
     from utils.pydio_profiler import pydio_profile
+    from utils.global_config import GlobalConfigManager
+    from utils.functions import scan_dir, stat_columns, same_mtime
     from utils import i18n
     _ = i18n.language.ugettext
 
 
+def content_key(stat_result):
+    """
+    :return: (size, mtime in microseconds) of a stat, identifies a moved file when inodes are not stable
+    """
+    return stat_result.st_size, stat_columns(stat_result)[3] // 1000
+
+
 class SnapshotDiffStart(DirectorySnapshotDiff):
     def __init__(self, ref_dirsnap, dirsnap):
         """
@@ -67,41 +90,733 @@ class SnapshotDiffStart(DirectorySnapshotDiff):
                     else:
                         self._files_modified.append(path)
 
-        paths_deleted = set(ref_dirsnap.paths) - set(dirsnap.paths)
-        paths_created = set(dirsnap.paths) - set(ref_dirsnap.paths)
+        paths = dirsnap.paths
+        ref_paths = ref_dirsnap.paths
+        deleted = dict((path, ref_dirsnap.stat_info(path)) for path in ref_paths - paths)
+        created = dict((path, dirsnap.stat_info(path)) for path in paths - ref_paths)
 
         # Detect all the moves/renames.
-        # Doesn't work on Windows, so exlude on Windows.
-        if not sys.platform.startswith('win'):
-            for created_path in set(paths_created).copy():
-                created_stat_info = dirsnap.stat_info(created_path)
-                for deleted_path in paths_deleted.copy():
-                    deleted_stat_info = ref_dirsnap.stat_info(deleted_path)
-                    if created_stat_info.st_ino == deleted_stat_info.st_ino:
-                        paths_deleted.remove(deleted_path)
-                        paths_created.remove(created_path)
-                        if stat.S_ISDIR(created_stat_info.st_mode):
-                            self._dirs_moved.append((deleted_path, created_path))
-                        else:
-                            self._files_moved.append((deleted_path, created_path))
+        for deleted_path, created_path, is_dir in match_moves(deleted, created):
+            if is_dir:
+                self._dirs_moved.append((deleted_path, created_path))
+            else:
+                self._files_moved.append((deleted_path, created_path))
 
         # Now that we have renames out of the way, enlist the deleted and
         # created files/directories.
-        for path in paths_deleted:
-            stat_info = ref_dirsnap.stat_info(path)
+        for path, stat_info in deleted.items():
             if stat.S_ISDIR(stat_info.st_mode):
                 self._dirs_deleted.append(path)
             else:
                 self._files_deleted.append(path)
 
-        for path in paths_created:
-            stat_info = dirsnap.stat_info(path)
+        for path, stat_info in created.items():
             if stat.S_ISDIR(stat_info.st_mode):
                 self._dirs_created.append(path)
             else:
                 self._files_created.append(path)
 
 
+def match_moves(deleted, created):
+    """
+    Find the moves among the deleted and the created nodes, through maps of the deleted ones built once. Inodes are
+    matched first. Files whose inode matched nothing are then compared by size and mtime, for the file systems with
+    unstable inodes, as long as the match is not ambiguous. Inodes are not usable on Windows, only size and mtime
+    are used there.
+    :param deleted: dict path => stat of the nodes that disappeared, the moved ones are removed from it
+    :param created: dict path => stat of the new nodes, the moved ones are removed from it
+    :return: list of tuples (deleted path, created path, is_dir)
+    """
+    moves = []
+    use_inodes = not sys.platform.startswith('win')
+    deleted_by_inode = {}
+    deleted_by_content = {}
+    for deleted_path, deleted_stat_info in deleted.items():
+        if use_inodes and deleted_stat_info.st_ino:
+            deleted_by_inode.setdefault(deleted_stat_info.st_ino, []).append(deleted_path)
+        if not stat.S_ISDIR(deleted_stat_info.st_mode):
+            deleted_by_content.setdefault(content_key(deleted_stat_info), []).append(deleted_path)
+    created_by_content = {}
+    for created_path, created_stat_info in created.items():
+        is_dir = stat.S_ISDIR(created_stat_info.st_mode)
+        candidates = deleted_by_inode.get(created_stat_info.st_ino, []) if use_inodes else []
+        while candidates:
+            deleted_path = candidates.pop()
+            if deleted_path in deleted and stat.S_ISDIR(deleted[deleted_path].st_mode) == is_dir:
+                moves.append((deleted_path, created_path, is_dir))
+                del deleted[deleted_path]
+                break
+        else:
+            if not is_dir:
+                created_by_content.setdefault(content_key(created_stat_info), []).append(created_path)
+    for deleted_path, created_path, is_dir in moves:
+        del created[created_path]
+    for key, created_paths in created_by_content.items():
+        deleted_paths = [path for path in deleted_by_content.get(key, []) if path in deleted]
+        if len(created_paths) == 1 and len(deleted_paths) == 1:
+            moves.append((deleted_paths[0], created_paths[0], False))
+            del deleted[deleted_paths[0]]
+            del created[created_paths[0]]
+    return moves
+
+
+def moved_path(path, moved_dirs):
+    """
+    :param path: path of a node before the moves
+    :param moved_dirs: dict source => target of the moved directories
+    :return: the path of the node once the closest of its moved parents is moved
+    """
+    parent = os.path.dirname(path)
+    while parent not in moved_dirs:
+        if os.path.dirname(parent) == parent:
+            return path
+        parent = os.path.dirname(parent)
+    return moved_dirs[parent] + path[len(parent):]
+
+
+# seconds before a clean stop from which the directory changes are not trusted to be indexed: the polling observer
+# and the events window may not have passed on the last changes
+CLEAN_SHUTDOWN_MARGIN = 10
+# seconds given to the observer to pass on its last events when the watcher stops
+OBSERVER_STOP_TIMEOUT = 10
+
+# files whose mtimes are compared at once with an IndexSnapshot
+SNAPSHOT_BATCH = 4096
+# created and deleted nodes among which IndexDiff looks for moves
+MOVE_WINDOW = 10000
+
+
+def utf8_key(path):
+    """
+    :return: the sort key of a path in ajxp_index, SQLite orders TEXT by the bytes of their UTF-8 encoding
+    """
+    return path.encode('utf-8') if isinstance(path, unicode) else path
+
+
+class IndexDiff(object):
+    """
+    Streaming comparison of a local folder with its index. The folder is walked in the order of a
+    "SELECT ... ORDER BY node_path" over ajxp_index and both are merge-joined, so that neither side is ever loaded
+    in memory: what is kept depends on the fan-out of the directories being walked and on the move window, not on
+    the size of the tree. Directories are listed ahead by a pool of threads as soon as they are found, which
+    hides the latency of network file systems.
+    Changes are yielded as events during the walk. Created and deleted nodes are kept in a window of move_window
+    nodes to find the moves among them, they are given once the walk is far enough past them. A move found by
+    neither the window nor the ajxp_deleted table of the SqlEventHandler is indexed as a deletion and a creation.
+    With skip_unchanged, a directory whose mtime and entry names match the index is not stat'ed again: its files
+    are considered unchanged, only its subdirectories are checked. With unchanged_since too, a directory that was
+    not modified after this time is taken from the index without even being listed.
+    When an IndexSnapshot of the index is given, it is walked instead of the database and the mtimes of the files
+    are compared with it by batches.
+    """
+
+    def __init__(self, basepath, db, sub_folder=None, threads=8, timeout=30, skip_unchanged=False, included=None,
+                 interrupt=None, progress=None, progress_interval=1.0, snapshot=None, unchanged_since=None,
+                 move_window=MOVE_WINDOW):
+        """
+        :param basepath: local folder of the job
+        :param db: path of the index database
+        :param sub_folder: optional folder to compare, relative to basepath
+        :param threads: number of directories listed at the same time
+        :param timeout: sqlite timeout
+        :param skip_unchanged: reuse the indexed stat of the files of the unchanged directories
+        :param included: optional callable(full path), entries it rejects are never indexed and are ignored when
+        comparing a directory with the index
+        :param interrupt: optional callable, the walk is abandoned as soon as it returns True
+        :param progress: optional callable(count, rate) called every progress_interval seconds during the walk
+        :param progress_interval: seconds between two calls to progress
+        :param snapshot: optional IndexSnapshot matching the current content of the index
+        :param unchanged_since: optional timestamp up to which the index is known to match the folder, see
+        LocalWatcher.stop()
+        :param move_window: number of created and deleted nodes kept to find the moves among them
+        """
+        self.basepath = basepath
+        self.db = db
+        self.sub_folder = os.path.normpath(sub_folder) if sub_folder and sub_folder != u"/" else None
+        self.threads = max(1, threads)
+        self.timeout = timeout
+        self.skip_unchanged = skip_unchanged
+        self.included = included or (lambda p: True)
+        self.interrupt = interrupt or (lambda: False)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.snapshot = snapshot
+        self.unchanged_since = unchanged_since
+        self.move_window = move_window
+        self.created_count = 0
+        self.deleted_count = 0
+        self.moved_count = 0
+        # modified files, moved ones included
+        self.modified_count = 0
+        # directories created, or whose mtime changed, with their stat when they were listed
+        self.changed_directories = []
+        self.count = 0
+        self.skipped_directories = 0
+        self.interrupted = False
+        self.walk_time = 0
+        self.walk_rate = 0
+        self.lock = threading.Lock()
+
+    def walk(self):
+        """
+        Run the comparison
+        :return: iterator of the watchdog events that bring the index up to date with the folder, found during the
+        walk. Moves come before the deletions and the creations they were found among, the content of a moved
+        directory is given at its new path.
+        """
+        start = last_report = time.time()
+        # created and deleted nodes not given yet, in the order of the walk: the moves are found among them
+        created = OrderedDict()
+        deleted = OrderedDict()
+        # source => target of the directories moved so far
+        moved_dirs = {}
+        # files compared with the snapshot by the next batch: (row, current mtime, path)
+        pending = []
+        pool = ThreadPool(self.threads)
+        conn = SqliteConnections.for_db(self.db, self.timeout).open()
+        try:
+            local_entries = self.local_entries(pool)
+            indexed_entries = self.indexed_entries(conn)
+            local = next(local_entries, None)
+            indexed = next(indexed_entries, None)
+            while local is not None or indexed is not None:
+                if self.interrupt():
+                    self.interrupted = True
+                    return
+                if indexed is None or (local is not None and local[0] < indexed[0]):
+                    key, path, stat_result = local
+                    if stat_result is None:
+                        # a file of an unchanged directory, indexed without its stat
+                        try:
+                            stat_result = os.stat(self.basepath + path)
+                        except OSError:
+                            pass
+                    if stat_result is not None:
+                        created[path] = stat_result
+                    local = next(local_entries, None)
+                    self.count += 1
+                elif local is None or indexed[0] < local[0]:
+                    deleted[indexed[1]] = self.indexed_stat(indexed[2])
+                    indexed = next(indexed_entries, None)
+                else:
+                    stat_result = local[2]
+                    if stat_result is None:
+                        # a file of an unchanged directory
+                        pass
+                    elif stat.S_ISDIR(stat_result.st_mode):
+                        if not same_mtime(self.indexed_stat(indexed[2]).st_mtime_ns, stat_columns(stat_result)[3]):
+                            self.changed_directories.append((self.basepath + local[1], stat_result))
+                    elif self.snapshot:
+                        pending.append((indexed[2], long(stat_result.st_mtime), local[1]))
+                        if len(pending) >= SNAPSHOT_BATCH:
+                            for path in self.modified_files(pending):
+                                yield FileModifiedEvent(path)
+                            pending = []
+                    elif long(stat_result.st_mtime) != long(indexed[2].st_mtime):
+                        self.modified_count += 1
+                        yield FileModifiedEvent(self.basepath + local[1])
+                    local = next(local_entries, None)
+                    indexed = next(indexed_entries, None)
+                    self.count += 1
+                if len(created) + len(deleted) > self.move_window:
+                    for event in self.flush_window(created, deleted, moved_dirs):
+                        yield event
+                now = time.time()
+                if self.progress and now - last_report >= self.progress_interval:
+                    last_report = now
+                    self.progress(self.count, self.count / (now - start))
+            for path in self.modified_files(pending):
+                yield FileModifiedEvent(path)
+            for event in self.flush_window(created, deleted, moved_dirs, everything=True):
+                yield event
+        finally:
+            pool.terminate()
+            pool.join()
+            conn.close()
+        self.walk_time = time.time() - start
+        self.walk_rate = self.count / max(self.walk_time, 0.001)
+
+    def flush_window(self, created, deleted, moved_dirs, everything=False):
+        """
+        Find the moves among the pending nodes, then give up on the oldest half of the others: a move whose source
+        and target are further apart than the window is seen as a deletion and a creation.
+        :param created: OrderedDict path => stat of the created nodes in the order of the walk, emptied as they are
+        given
+        :param deleted: OrderedDict path => IndexStat of the deleted nodes in the order of the walk, same
+        :param moved_dirs: dict source => target of the directories moved so far, completed by the new moves
+        :param everything: give all the pending nodes, at the end of the walk
+        :return: list of events, the moves, the moved files whose content changed too, the deletions and the
+        creations
+        """
+        events = []
+        # the index rows of a moved directory follow it: the moves and deletions of its content are applied to
+        # their new path, and the moves of its children already done by its own move are dropped
+        deleted_stats = dict(deleted)
+        created_stats = dict(created)
+        moves = sorted(match_moves(deleted, created), key=lambda move: (not move[2], move))
+        moved_dirs.update((source, target) for source, target, is_dir in moves if is_dir)
+        modified = []
+        for source, target, is_dir in moves:
+            if moved_path(source, moved_dirs) != target:
+                event_class = DirMovedEvent if is_dir else FileMovedEvent
+                events.append(event_class(self.basepath + moved_path(source, moved_dirs), self.basepath + target))
+                self.moved_count += 1
+            if not is_dir and long(deleted_stats[source].st_mtime) != long(created_stats[target].st_mtime):
+                modified.append(FileModifiedEvent(self.basepath + target))
+        self.modified_count += len(modified)
+        events += modified
+        if everything:
+            limit = None
+        else:
+            keys = sorted(utf8_key(path) for nodes in (created, deleted) for path in nodes)
+            limit = keys[len(keys) // 2 - 1] if len(keys) > 1 else None
+        for path in [path for path in deleted if limit is None or utf8_key(path) <= limit]:
+            stat_result = deleted.pop(path)
+            event_class = DirDeletedEvent if stat.S_ISDIR(stat_result.st_mode) else FileDeletedEvent
+            events.append(event_class(self.basepath + moved_path(path, moved_dirs)))
+            self.deleted_count += 1
+        for path in [path for path in created if limit is None or utf8_key(path) <= limit]:
+            stat_result = created.pop(path)
+            if stat.S_ISDIR(stat_result.st_mode):
+                events.append(DirCreatedEvent(self.basepath + path))
+                self.changed_directories.append((self.basepath + path, stat_result))
+            else:
+                events.append(FileCreatedEvent(self.basepath + path))
+            self.created_count += 1
+        return events
+
+    def changes_count(self):
+        return self.created_count + self.deleted_count + self.moved_count + self.modified_count
+
+    def indexed_stat(self, indexed):
+        """
+        :param indexed: IndexStat, or row of the snapshot
+        :return: IndexStat
+        """
+        return self.snapshot.stat(indexed) if self.snapshot else indexed
+
+    def modified_files(self, pending):
+        """
+        :param pending: list of tuples (row of the snapshot, current mtime in whole seconds, path)
+        :return: list of the full paths of the files whose mtime differs from the snapshot
+        """
+        positions = self.snapshot.modified_rows([row for row, mtime, path in pending],
+                                                [mtime for row, mtime, path in pending]) if pending else []
+        self.modified_count += len(positions)
+        return [self.basepath + pending[position][2] for position in positions]
+
+    def indexed_entries(self, conn):
+        """
+        :return: iterator of tuples (sort key, node_path, IndexStat or row of the snapshot) of the index, in the
+        order of the sort keys
+        """
+        if self.snapshot:
+            for entry in self.snapshot.entries(self.sub_folder):
+                yield entry
+            return
+        if self.sub_folder:
+            res = conn.execute("SELECT node_path, mode, ino, dev, bytesize, mtime_ns, ctime_ns FROM ajxp_index "
+                               "WHERE mode NOT NULL AND (node_path=? OR (node_path>=? AND node_path<?)) "
+                               "ORDER BY node_path", (self.sub_folder,) + subtree_bounds(self.sub_folder))
+        else:
+            res = conn.execute("SELECT node_path, mode, ino, dev, bytesize, mtime_ns, ctime_ns FROM ajxp_index "
+                               "WHERE mode NOT NULL ORDER BY node_path")
+        for row in res:
+            yield utf8_key(row['node_path']), row['node_path'], IndexStat.from_row(row)
+
+    def local_entries(self, pool):
+        """
+        Walk the folder in the order of the sort keys: the next entry is always the smallest one of a heap holding
+        the entries of the directories being walked. A directory is pushed with the pending listing of its content,
+        its entries are pushed once it is popped.
+        :return: iterator of tuples (sort key, path relative to basepath, stat or None for the unchanged files)
+        """
+        root = self.sub_folder or u''
+        root_stat = os.stat(self.basepath + root)
+        if self.sub_folder:
+            yield utf8_key(root), root, root_stat
+        heap = []
+        # the directories above an entry, so that a symlink loop is not followed (st_ino is 0 on Windows)
+        ancestors = ((root_stat.st_ino, root_stat.st_dev),)
+        self.push_entries(pool, heap, self.list_entries(root, root_stat), ancestors)
+        while heap:
+            key, path, stat_result, listing, ancestors = heapq.heappop(heap)
+            yield key, path, stat_result
+            if listing is not None:
+                self.push_entries(pool, heap, listing.get(), ancestors)
+
+    def push_entries(self, pool, heap, entries, ancestors):
+        for path, stat_result in entries:
+            listing = None
+            entry_ancestors = ancestors
+            if stat_result is not None and stat.S_ISDIR(stat_result.st_mode):
+                node = (stat_result.st_ino, stat_result.st_dev)
+                if not stat_result.st_ino or node not in ancestors:
+                    entry_ancestors = ancestors + (node,)
+                    listing = pool.apply_async(self.list_entries, (path, stat_result))
+            heapq.heappush(heap, (utf8_key(path), path, stat_result, listing, entry_ancestors))
+
+    def list_entries(self, path, dir_stat):
+        """
+        Runs in the pool workers.
+        :param path: directory, relative to basepath
+        :param dir_stat: its stat
+        :return: list of tuples (path, stat_result) of its entries, the stat is None for the files of an unchanged
+        directory. Empty if it cannot be listed.
+        """
+        full_path = self.basepath + path
+        if self.skip_unchanged:
+            try:
+                entries = self.unchanged_entries(path, full_path, dir_stat)
+                if entries is not None:
+                    with self.lock:
+                        self.skipped_directories += 1
+                    return entries
+            except (OSError, sqlite3.Error) as e:
+                logging.debug(e)
+        try:
+            return [(path + os.sep + name, stat_result) for name, stat_result in scan_dir(full_path)]
+        except OSError as o:
+            logging.error(o)
+        except Exception as e:
+            # never let a worker fail, the walk is waiting for its answer
+            logging.exception(e)
+        return []
+
+    def unchanged_entries(self, path, full_path, dir_stat):
+        """
+        :return: the entries of the directory if its mtime and its entry names match the index, or if it was not
+        modified since unchanged_since. None otherwise.
+        """
+        conn = SqliteConnections.for_db(self.db, self.timeout).get()
+        row = conn.execute("SELECT mtime_ns FROM ajxp_index WHERE node_path=?", (path,)).fetchone()
+        if row is None:
+            return None
+        # the indexed mtime of a directory is only refreshed by the scans, the changes of its content found by the
+        # watcher since then do not count
+        trusted = self.unchanged_since is not None and dir_stat.st_mtime < self.unchanged_since
+        if not trusted and not same_mtime(row['mtime_ns'], stat_columns(dir_stat)[3]):
+            return None
+        indexed = dict((child['node_path'][len(path) + 1:], child['md5'] == 'directory')
+                       for child in indexed_children(conn, path))
+        if trusted:
+            names = indexed.keys()
+        else:
+            names = [name for name in os.listdir(full_path)
+                     if name in indexed or self.included(os.path.join(full_path, name))]
+            if set(names) != set(indexed):
+                return None
+        entries = []
+        for name in names:
+            if indexed[name]:
+                # its own content may have changed
+                entries.append((path + os.sep + name, os.stat(full_path + os.sep + name)))
+            else:
+                entries.append((path + os.sep + name, None))
+        return entries
+
+
+class EventCoalescer(FileSystemEventHandler):
+    """
+    Sits between the observer and the SqlEventHandler. Events are queued and merged per path, then every window
+    is applied to the index in a single transaction: create+modify gives a create, create+delete gives nothing,
+    delete+create of a file gives a modify. Moves are never merged and keep their position in the queue.
+    """
+
+    def __init__(self, event_handler, window=1.0, max_delay=10.0, max_pending=10000, settle_queue=None):
+        """
+        :param event_handler: SqlEventHandler receiving the merged events
+        :param window: seconds without new events before a batch is applied
+        :param max_delay: a batch is applied after max_delay seconds even if events keep coming
+        :param max_pending: a batch is applied as soon as it holds that many events
+        :param settle_queue: optional SettleQueue holding back the files still being written
+        """
+        super(EventCoalescer, self).__init__()
+        self.event_handler = event_handler
+        self.settle_queue = settle_queue
+        self.window = window
+        self.max_delay = max(window, max_delay)
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        self.by_path = {}
+        self.counter = 0
+        self.first_event_time = 0
+        self.last_event_time = 0
+        self.interrupt = False
+        self.thread = None
+        self.metrics = {
+            'queue_depth': 0,
+            'events_received': 0,
+            'events_applied': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'last_batch_latency': 0,
+            'max_batch_latency': 0
+        }
+
+    def dispatch(self, event):
+        with self.condition:
+            now = time.time()
+            if not self.pending:
+                self.first_event_time = now
+            self.last_event_time = now
+            self.metrics['events_received'] += 1
+            self.merge(event)
+            self.condition.notify()
+
+    def append(self, event, path=None):
+        self.counter += 1
+        self.pending[self.counter] = event
+        if path is not None:
+            self.by_path[path] = self.counter
+
+    def merge(self, event):
+        """
+        Merge an event with the pending one of the same path, if any. Must be called with the condition acquired.
+        """
+        if event.event_type == EVENT_TYPE_MOVED:
+            # later events on these paths must be applied after the move
+            self.by_path.pop(event.src_path, None)
+            self.by_path.pop(event.dest_path, None)
+            self.append(event)
+            return
+        path = event.src_path
+        key = self.by_path.get(path)
+        previous = self.pending.get(key) if key is not None else None
+        if previous is None:
+            self.append(event, path)
+            return
+        if previous.event_type == EVENT_TYPE_CREATED:
+            if event.event_type == EVENT_TYPE_DELETED:
+                del self.pending[key]
+                del self.by_path[path]
+            elif event.event_type != EVENT_TYPE_CREATED and event.event_type != EVENT_TYPE_MODIFIED:
+                self.append(event, path)
+        elif previous.event_type == EVENT_TYPE_MODIFIED:
+            if event.event_type == EVENT_TYPE_DELETED:
+                del self.pending[key]
+                self.append(event, path)
+            elif event.event_type != EVENT_TYPE_MODIFIED:
+                self.append(event, path)
+        elif previous.event_type == EVENT_TYPE_DELETED:
+            if event.event_type == EVENT_TYPE_CREATED and not event.is_directory and not previous.is_directory:
+                del self.pending[key]
+                self.append(FileModifiedEvent(path), path)
+            elif event.event_type != EVENT_TYPE_DELETED:
+                self.append(event, path)
+        else:
+            self.append(event, path)
+
+    def get_metrics(self):
+        with self.condition:
+            self.metrics['queue_depth'] = len(self.pending)
+            return dict(self.metrics)
+
+    def start(self):
+        self.interrupt = False
+        self.thread = threading.Thread(target=self.run, name='EventCoalescer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Apply the pending events, then stop the thread
+        """
+        with self.condition:
+            self.interrupt = True
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    if self.interrupt:
+                        return
+                    self.condition.wait(1)
+                    continue
+                now = time.time()
+                wait = min(self.last_event_time + self.window, self.first_event_time + self.max_delay) - now
+                if wait > 0 and not self.interrupt and len(self.pending) < self.max_pending:
+                    self.condition.wait(wait)
+                    continue
+                events = list(self.pending.values())
+                first_event_time = self.first_event_time
+                self.pending = OrderedDict()
+                self.by_path = {}
+            self.apply(events, first_event_time)
+
+    def apply(self, events, first_event_time):
+        self.event_handler.begin_transaction()
+        try:
+            for event in events:
+                try:
+                    if self.settle_queue and self.settle_queue.hold(event):
+                        continue
+                    self.event_handler.dispatch(event)
+                except Exception as e:
+                    logging.exception(e)
+        finally:
+            self.event_handler.end_transaction()
+        latency = time.time() - first_event_time
+        with self.condition:
+            self.metrics['events_applied'] += len(events)
+            self.metrics['batches'] += 1
+            self.metrics['last_batch_size'] = len(events)
+            self.metrics['last_batch_latency'] = latency
+            self.metrics['max_batch_latency'] = max(self.metrics['max_batch_latency'], latency)
+        logging.debug("Applied %i local events in one transaction, %.2fs after the first one" % (len(events), latency))
+
+
+class SettleQueue(object):
+    """
+    Holds back the files that are still being written: a file is handed back to the coalescer as a single modify
+    event once its size and mtime have not changed for `interval` seconds, so that a file being copied is hashed
+    once instead of on every write. Files that cannot be opened are checked again with an exponential back-off.
+    Files still held when the watcher stops are found again by the snapshot diff of the next start.
+    """
+
+    def __init__(self, dispatch, interval=2.0, max_backoff=300.0):
+        """
+        :param dispatch: callable receiving the events of the settled files
+        :param interval: seconds a file must stay unchanged before being indexed, 0 disables the queue
+        :param max_backoff: maximum delay in seconds between two attempts to open a file
+        """
+        self.dispatch = dispatch
+        self.interval = interval
+        self.max_backoff = max(interval, max_backoff)
+        self.condition = threading.Condition()
+        # path => dict(size, mtime, since, attempts, next)
+        self.pending = {}
+        self.released = set()
+        self.interrupt = False
+        self.thread = None
+        self.metrics = {
+            'settling': 0,
+            'settled': 0,
+            'open_retries': 0,
+            'dropped': 0
+        }
+
+    def hold(self, event):
+        """
+        Check an event before it is applied to the index.
+        :param event: watchdog event
+        :return: True if the event is held back until its file settles
+        """
+        if self.interval <= 0 or event.is_directory:
+            return False
+        path = event.src_path
+        with self.condition:
+            if event.event_type in (EVENT_TYPE_MOVED, EVENT_TYPE_DELETED):
+                # the move or delete is applied now, the file is no longer there to be indexed
+                if self.pending.pop(path, None) is not None:
+                    self.metrics['dropped'] += 1
+                self.released.discard(path)
+                return False
+            if event.event_type not in (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED):
+                return False
+            if path in self.released:
+                self.released.discard(path)
+                return False
+            if path in self.pending:
+                # the next check decides
+                return True
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return False
+            now = time.time()
+            if now - stat_result.st_mtime >= self.interval:
+                return False
+            self.pending[path] = dict(size=stat_result.st_size, mtime=stat_result.st_mtime, since=now, attempts=0,
+                                      next=now + self.interval)
+            self.condition.notify()
+            return True
+
+    def retry(self, path):
+        """
+        A file could not be opened while being indexed: check it again later instead of skipping it.
+        :param path: full path of the file
+        """
+        with self.condition:
+            now = time.time()
+            entry = self.pending.get(path)
+            if entry is None:
+                entry = self.pending[path] = dict(size=None, mtime=None, since=now, attempts=0, next=now)
+            self.backoff(path, entry, now)
+            self.condition.notify()
+
+    def backoff(self, path, entry, now):
+        entry['attempts'] += 1
+        entry['next'] = now + min(self.max_backoff, max(self.interval, 1) * 2 ** entry['attempts'])
+        self.metrics['open_retries'] += 1
+        logging.debug('Cannot open %s yet, next attempt in %is' % (path, entry['next'] - now))
+
+    def check(self, path, entry, now):
+        """
+        Must be called with the condition acquired.
+        :return: True if the file has settled and can be opened
+        """
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            del self.pending[path]
+            self.metrics['dropped'] += 1
+            return False
+        if (stat_result.st_size, stat_result.st_mtime) != (entry['size'], entry['mtime']):
+            entry.update(size=stat_result.st_size, mtime=stat_result.st_mtime, since=now, next=now + self.interval)
+            return False
+        if now - entry['since'] < self.interval:
+            entry['next'] = entry['since'] + self.interval
+            return False
+        try:
+            with open(path, 'rb'):
+                pass
+        except IOError:
+            self.backoff(path, entry, now)
+            return False
+        del self.pending[path]
+        self.released.add(path)
+        self.metrics['settled'] += 1
+        return True
+
+    def get_metrics(self):
+        with self.condition:
+            self.metrics['settling'] = len(self.pending)
+            return dict(self.metrics)
+
+    def start(self):
+        self.interrupt = False
+        self.thread = threading.Thread(target=self.run, name='SettleQueue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.interrupt = True
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.interrupt:
+                    return
+                now = time.time()
+                due = [path for path, entry in self.pending.items() if entry['next'] <= now]
+                if not due:
+                    wait = min(entry['next'] for entry in self.pending.values()) - now if self.pending else 1
+                    self.condition.wait(max(wait, .05))
+                    continue
+                settled = [path for path in due if self.check(path, self.pending[path], now)]
+            for path in settled:
+                self.dispatch(FileModifiedEvent(path))
+
+
 class LocalWatcher(threading.Thread):
     def __init__(self, local_path, data_path, event_handler):
         threading.Thread.__init__(self)
@@ -110,79 +825,246 @@ class LocalWatcher(threading.Thread):
         self.job_data_path = data_path
         self.interrupt = False
         self.event_handler = event_handler
+        general_config = GlobalConfigManager.Instance(configs_path=data_path).get_general_config()
+        self.coalescer = EventCoalescer(event_handler, window=general_config.get('local_events_window', 1.0))
+        self.settle_queue = SettleQueue(self.coalescer.dispatch,
+                                        interval=general_config.get('local_settle_interval', 2.0))
+        self.coalescer.settle_queue = self.settle_queue
+        event_handler.unreadable_callback = self.settle_queue.retry
+        self.walk_threads = general_config.get('local_walk_threads', 8)
+        self.full_scan_interval = general_config.get('local_full_scan_interval', 86400)
+        self.db_timeout = general_config.get('max_wait_time_for_local_db_access', 30)
+        self.use_index_snapshot = general_config.get('local_index_snapshot', True)
+        # the startup scan went through, so that the index matches the folder as long as the observer runs
+        self.index_up_to_date = False
+        self.backend = general_config.get('local_watcher_backend', 'inotify')
+        self.max_watches = general_config.get('local_inotify_max_watches', 0)
+        self.poll_interval = general_config.get('local_unwatched_poll_interval', 30)
+        # folders to rescan, relative to basepath, asked by the observer => True if their unchanged directories can
+        # be skipped
+        self.rescans = {}
+        self.rescan_condition = threading.Condition()
+        # items walked and directories skipped by the last scan of the whole folder
+        self.scan_metrics = {}
 
     @pydio_profile
-    def check_from_snapshot(self, sub_folder=None, state_callback=(lambda status: None), use_transaction=True):
+    def check_from_snapshot(self, sub_folder=None, state_callback=(lambda status: None), use_transaction=True,
+                            skip_unchanged=False):
         logging.info('Scanning for changes since last application launch')
         if (not sub_folder and os.path.exists(self.basepath)) or (sub_folder and os.path.exists(self.basepath + sub_folder)):
-            previous_snapshot = SqlSnapshot(self.basepath, self.job_data_path, sub_folder)
-            if sub_folder:
-                local_path = self.basepath + os.path.normpath(sub_folder)
-            else:
-                local_path = self.basepath
             state_callback(status=_('Walking through your local folder, please wait...'))
 
-            def listdir(dir_path):
-                try:
-                    return os.listdir(dir_path)
-                except OSError as o:
-                    logging.error(o)
-                    return []
-
-            snapshot = DirectorySnapshot(local_path, recursive=True, listdir=listdir)
-            diff = SnapshotDiffStart(previous_snapshot, snapshot)
-            state_callback(status=_('Detected %i local changes...') % (len(diff.dirs_created) + len(diff.files_created)
-                                                                       + len(diff.dirs_moved) + len(diff.dirs_deleted)
-                                                                       + len(diff.files_moved) +
-                                                                       len(diff.files_modified) +
-                                                                       len(diff.files_deleted)))
-
-            if use_transaction:
-                self.event_handler.begin_transaction()
+            def walk_progress(count, rate):
+                state_callback(status=_('Walking through your local folder, %i items found (%i items/s)...')
+                               % (count, rate))
 
-            for path in diff.dirs_created:
-                if self.interrupt:
-                    return
-                self.event_handler.on_created(DirCreatedEvent(path))
-            for path in diff.files_created:
-                if self.interrupt:
-                    return
-                self.event_handler.on_created(FileCreatedEvent(path))
+            unchanged_since = None
+            if not sub_folder:
+                scan_state = self.load_scan_state()
+                if scan_state.get('clean_shutdown'):
+                    unchanged_since = scan_state['clean_shutdown'] - CLEAN_SHUTDOWN_MARGIN
+                # a crash from now on means a full scan at the next start
+                self.save_scan_state(clean_shutdown=None, watcher=None)
+                # without a clean stop, the edits whose events were still queued are only found by stat'ing every
+                # file: an edit in place does not change the mtime of its directory
+                full_scan = unchanged_since is None or self.full_scan_due(scan_state)
+                if full_scan:
+                    unchanged_since = None
+            else:
+                full_scan = not skip_unchanged
+            scan_time = time.time()
+            snapshot = self.load_index_snapshot() if not sub_folder else None
+            diff = IndexDiff(self.basepath, os.path.join(self.job_data_path, 'pydio.sqlite'), sub_folder=sub_folder,
+                             threads=self.walk_threads, timeout=self.db_timeout, skip_unchanged=not full_scan,
+                             included=lambda p: self.event_handler.included(FileCreatedEvent(p)),
+                             interrupt=lambda: self.interrupt, progress=walk_progress, snapshot=snapshot,
+                             unchanged_since=unchanged_since)
+            bulk = use_transaction and not sub_folder and self.event_handler.index_is_empty()
 
-            for path in diff.dirs_moved:
-                if self.interrupt:
-                    return
-                self.event_handler.on_moved(DirMovedEvent(path[0], path[1]))
-            for path in diff.files_moved:
-                if self.interrupt:
-                    return
-                self.event_handler.on_moved(FileMovedEvent(path[0], path[1]))
-            for path in diff.files_modified:
-                if self.interrupt:
-                    return
-                self.event_handler.on_modified(FileModifiedEvent(path))
-            for path in diff.files_deleted:
-                if self.interrupt:
-                    return
-                self.event_handler.on_deleted(FileDeletedEvent(path))
-            for path in diff.dirs_deleted:
-                if self.interrupt:
+            if use_transaction and not bulk:
+                self.event_handler.begin_transaction()
+            try:
+                if bulk:
+                    # first indexing of this folder: the diff only holds creations, loaded as they are found
+                    state_callback(status=_('Indexing your local folder, please wait...'))
+                    count = self.event_handler.bulk_index(((event.src_path, event.is_directory)
+                                                           for event in diff.walk()),
+                                                          interrupt=lambda: self.interrupt)
+                else:
+                    # the changes are indexed while walking
+                    for event in diff.walk():
+                        self.event_handler.dispatch(event)
+                    count = diff.changes_count()
+                if diff.interrupted or count is None:
                     return
-                self.event_handler.on_deleted(DirDeletedEvent(path))
+                if not sub_folder:
+                    self.scan_metrics = dict(walked=diff.count, skipped_directories=diff.skipped_directories,
+                                             full_scan=full_scan)
+                logging.info('Walked %i items in %.1fs (%i items/s), %i unchanged directories skipped%s'
+                             % (diff.count, diff.walk_time, diff.walk_rate, diff.skipped_directories,
+                                ' after a clean shutdown' if unchanged_since else ''))
+                state_callback(status=_('Detected %i local changes...') % diff.changes_count())
+                # stat of the directories as they were listed, now that their content is indexed
+                self.event_handler.update_directory_stats(diff.changed_directories)
+                if not sub_folder:
+                    if full_scan or bulk:
+                        self.save_scan_state(last_full_scan=scan_time)
+                    self.index_up_to_date = True
+            finally:
+                if snapshot:
+                    snapshot.close()
+                if use_transaction and not bulk:
+                    self.event_handler.end_transaction()
+
+    def full_scan_due(self, scan_state):
+        """
+        :param scan_state: dict, see load_scan_state()
+        :return: True if the startup scan must stat the whole tree, instead of skipping the unchanged directories
+        """
+        if self.full_scan_interval <= 0 or 'last_full_scan' not in scan_state:
+            return True
+        return time.time() - scan_state['last_full_scan'] >= self.full_scan_interval
+
+    def load_scan_state(self):
+        """
+        :return: dict, with the time of the last full scan (last_full_scan), and the time of the last clean stop of
+        the watcher (clean_shutdown) with the state of its queues at that time (watcher), when they are known
+        """
+        try:
+            with open(os.path.join(self.job_data_path, 'local_scan'), 'rb') as f:
+                scan_state = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return {}
+        return scan_state if isinstance(scan_state, dict) else {}
 
-            if use_transaction:
-                self.event_handler.end_transaction()
+    def save_scan_state(self, **values):
+        """
+        Update the values of the scan state, the ones set to None are removed
+        """
+        scan_state = self.load_scan_state()
+        scan_state.update(values)
+        try:
+            with open(os.path.join(self.job_data_path, 'local_scan'), 'wb') as f:
+                pickle.dump(dict((key, value) for key, value in scan_state.items() if value is not None), f)
+        except IOError as e:
+            logging.error('Cannot save the state of the local scans: %s' % e)
+
+    def load_index_snapshot(self):
+        """
+        :return: the IndexSnapshot left by the last stop, if it still matches the index
+        """
+        if not self.use_index_snapshot:
+            return None
+        conn = SqliteConnections.for_db(os.path.join(self.job_data_path, 'pydio.sqlite'), self.db_timeout).open()
+        try:
+            return IndexSnapshot.load(os.path.join(self.job_data_path, 'pydio.snapshot'), conn)
+        except sqlite3.Error as e:
+            logging.error('Cannot check the index snapshot: %s' % e)
+            return None
+        finally:
+            conn.close()
+
+    def save_index_snapshot(self):
+        """
+        Dump the index to the sidecar file read by the next startup scan
+        """
+        if not self.use_index_snapshot:
+            return
+        db = os.path.join(self.job_data_path, 'pydio.sqlite')
+        if not os.path.exists(db):
+            return
+        start = time.time()
+        conn = SqliteConnections.for_db(db, self.db_timeout).open()
+        try:
+            count = write_index_snapshot(conn, os.path.join(self.job_data_path, 'pydio.snapshot'))
+            logging.debug('Saved the snapshot of %i indexed nodes in %.1fs' % (count, time.time() - start))
+        except (IOError, OSError, sqlite3.Error) as e:
+            logging.error('Cannot save the index snapshot: %s' % e)
+        finally:
+            conn.close()
 
     @pydio_profile
     def stop(self):
+        """
+        Stop watching. The stop is recorded as clean when every change seen up to now made it to the index: the
+        next startup scan then only lists the directories modified after it.
+        """
+        stop_time = time.time()
+        observing = self.observer is not None and self.observer.is_alive()
+        drained = False
         self.interrupt = True
         if self.observer:
             logging.debug("Stopping: %s" % self.observer)
             try:
                 self.observer.stop()
+                if observing:
+                    # its last events reach the queues before they are drained
+                    self.observer.join(OBSERVER_STOP_TIMEOUT)
+                    drained = not self.observer.is_alive()
             except Exception as e:
                 logging.exception(e)
                 logging.error("Error while stopping watchdog thread!")
+        self.settle_queue.stop()
+        self.coalescer.stop()
+        self.save_index_snapshot()
+        metrics = self.get_metrics()
+        if drained and self.index_up_to_date and not metrics['settling'] and not metrics['queue_depth']:
+            self.save_scan_state(clean_shutdown=stop_time, watcher=metrics)
+            logging.info('Clean stop of the local watcher recorded')
+
+    def get_metrics(self):
+        """
+        :return: dict, state of the local events queue and of the files waiting to settle, the figures of the last
+        scan of the whole folder, plus the watches, overflows and rescans of the inotify observer when it is used
+        """
+        metrics = self.coalescer.get_metrics()
+        metrics.update(self.scan_metrics)
+        metrics.update(self.settle_queue.get_metrics())
+        if isinstance(self.observer, InotifyObserver):
+            metrics.update(self.observer.get_metrics())
+        return metrics
+
+    def create_observer(self):
+        """
+        :return: the inotify observer on Linux unless local_watcher_backend is "polling", watchdog's observer
+        otherwise or if inotify cannot be used
+        """
+        if platform.is_linux() and self.backend == 'inotify':
+            try:
+                return InotifyObserver(max_watches=self.max_watches, poll_interval=self.poll_interval,
+                                       rescan=self.request_rescan)
+            except (OSError, AttributeError) as e:
+                logging.warning('Cannot use inotify, polling the local folder instead: %s' % e)
+        return Observer()
+
+    def request_rescan(self, sub_folder, skip_unchanged=False):
+        """
+        Called by the observer when it may have missed changes in a folder
+        :param sub_folder: folder relative to basepath, "/" for the whole folder
+        :param skip_unchanged: only list the directories modified since the last scan, see IndexDiff
+        """
+        with self.rescan_condition:
+            self.rescans[sub_folder] = self.rescans.get(sub_folder, True) and skip_unchanged
+            self.rescan_condition.notify()
+
+    def run_rescans(self):
+        """
+        Rescan the folders asked by the observer, until it stops
+        """
+        while self.observer.is_alive() and not self.interrupt:
+            with self.rescan_condition:
+                if not self.rescans:
+                    self.rescan_condition.wait(1)
+                # the folders to stat entirely first, they are where the changes were missed most likely
+                rescans = sorted(self.rescans.items(), key=lambda item: (item[1], item[0]))
+                self.rescans.clear()
+            for sub_folder, skip_unchanged in rescans:
+                if self.interrupt:
+                    return
+                try:
+                    self.check_from_snapshot(sub_folder, use_transaction=False, skip_unchanged=skip_unchanged)
+                except Exception as e:
+                    logging.exception(e)
 
     @pydio_profile
     def run(self):
@@ -191,8 +1073,11 @@ class LocalWatcher(threading.Thread):
             return
 
         logging.info('Starting permanent monitor')
-        self.observer = Observer()
-        self.observer.schedule(self.event_handler, self.basepath, recursive=True)
+        self.coalescer.start()
+        self.settle_queue.start()
+        self.observer = self.create_observer()
+        self.observer.schedule(self.coalescer, self.basepath, recursive=True)
         self.observer.start()
+        self.run_rescans()
         self.observer.join()
 
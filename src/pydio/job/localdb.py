@@ -28,22 +28,280 @@ import fnmatch
 import pickle
 import logging
 import threading
+from collections import deque
+from stat import S_ISDIR
 from pathlib import *
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileModifiedEvent, FileDeletedEvent, FileCreatedEvent, \
+    DirCreatedEvent
 from watchdog.utils.dirsnapshot import DirectorySnapshotDiff
 try:
     from pydio.utils.pydio_profiler import pydio_profile
-    from pydio.utils.functions import hashfile, set_file_hidden, guess_filesystemencoding
+    from pydio.utils.functions import hashfile, set_file_hidden, guess_filesystemencoding, stat_columns, scan_dir, \
+        same_mtime
     from pydio.utils.global_config import GlobalConfigManager
+    from pydio.job.hash_pool import HashPool, fingerprint_file, fingerprint_row, FULL_HASH_LIMIT
+    from pydio.job.db_connections import SqliteConnections
 except ImportError:
     from utils.pydio_profiler import pydio_profile
-    from utils.functions import hashfile, set_file_hidden, guess_filesystemencoding
+    from utils.functions import hashfile, set_file_hidden, guess_filesystemencoding, stat_columns, scan_dir, \
+        same_mtime
     from utils.global_config import GlobalConfigManager
+    from job.hash_pool import HashPool, fingerprint_file, fingerprint_row, FULL_HASH_LIMIT
+    from job.db_connections import SqliteConnections
 
 class DBCorruptedException(Exception):
     pass
 
 
+def stat_signature(stat_result):
+    """
+    Identify a version of a file by its stat
+    :param stat_result: os.stat_result
+    :return: tuple (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns) or None when the filesystem does not
+    provide inode numbers (Python 2 on Windows)
+    """
+    if not stat_result.st_ino:
+        return None
+    mode, ino, dev, mtime_ns, ctime_ns = stat_columns(stat_result)
+    return dev, ino, stat_result.st_size, mtime_ns, ctime_ns
+
+
+class IndexStat(object):
+    """
+    Stat of a node, as read back from the columns of ajxp_index
+    """
+    __slots__ = ('st_mode', 'st_ino', 'st_dev', 'st_size', 'st_mtime', 'st_ctime', 'st_mtime_ns', 'st_ctime_ns')
+
+    def __init__(self, mode, ino, dev, size, mtime_ns, ctime_ns):
+        self.st_mode = mode
+        self.st_ino = ino + 2 ** 64 if ino < 0 else ino
+        self.st_dev = dev + 2 ** 64 if dev < 0 else dev
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+        self.st_ctime_ns = ctime_ns
+        self.st_mtime = mtime_ns / 1e9
+        self.st_ctime = ctime_ns / 1e9
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :param row: sqlite3.Row with mode, ino, dev, bytesize, mtime_ns and ctime_ns columns
+        :return: IndexStat or None for rows indexed without their stat
+        """
+        if row['mode'] is None:
+            return None
+        return cls(row['mode'], row['ino'], row['dev'], int(row['bytesize'] or 0), row['mtime_ns'], row['ctime_ns'])
+
+
+def migrate_pickled_stats(conn):
+    """
+    Move the pickled stat_result blobs of ajxp_index to the mode, ino, dev, mtime_ns and ctime_ns columns
+    :param conn: connection to the database being upgraded
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(ajxp_index)")]
+    for column in ('mode', 'ino', 'dev', 'mtime_ns', 'ctime_ns'):
+        if column not in columns:
+            conn.execute("ALTER TABLE ajxp_index ADD COLUMN %s INTEGER" % column)
+    if 'stat_result' not in columns:
+        return
+    # do not log these updates as content changes
+    conn.execute("DROP TRIGGER IF EXISTS LOG_UPDATE_CONTENT")
+    read = conn.cursor()
+    read.execute("SELECT node_id, stat_result FROM ajxp_index WHERE stat_result NOT NULL")
+    while True:
+        rows = read.fetchmany(1000)
+        if not rows:
+            break
+        values = []
+        for node_id, blob in rows:
+            try:
+                values.append(stat_columns(pickle.loads(str(blob))) + (node_id,))
+            except Exception as e:
+                logging.debug("Cannot read stat of node %s: %s" % (node_id, e))
+        conn.executemany("UPDATE ajxp_index SET mode=?, ino=?, dev=?, mtime_ns=?, ctime_ns=? WHERE node_id=?", values)
+    read.close()
+    try:
+        conn.execute("ALTER TABLE ajxp_index DROP COLUMN stat_result")
+    except sqlite3.OperationalError:
+        # SQLite < 3.35
+        conn.execute("UPDATE ajxp_index SET stat_result=NULL")
+    conn.execute('CREATE TRIGGER "LOG_UPDATE_CONTENT" AFTER UPDATE ON "ajxp_index" FOR EACH ROW BEGIN INSERT INTO '
+                 '"ajxp_changes" (node_id,source,target,type) VALUES (new.node_id, old.node_path, new.node_path, '
+                 'CASE WHEN old.node_path = new.node_path THEN "content" ELSE "path" END);END')
+    conn.commit()
+    conn.execute("VACUUM")
+
+
+def sql_basename(column):
+    """
+    :param column: SQL expression of a node path
+    :return: SQL expression of its last component, whatever the separator
+    """
+    return "substr(%s, length(rtrim(%s, replace(replace(%s, '/', ''), '\\', ''))) + 1)" % (column, column, column)
+
+
+def sql_dirname(column):
+    """
+    :param column: SQL expression of a node path
+    :return: SQL expression of the path of its parent folder, '' for the root
+    """
+    return "substr(%s, 1, length(rtrim(%s, replace(replace(%s, '/', ''), '\\', ''))) - 1)" % (column, column, column)
+
+
+def dir_status_triggers():
+    """
+    Triggers keeping ajxp_dir_status up to date: for each folder, the number of direct children whose status is
+    not IDLE, split between pending and conflict. Rows are removed as soon as both counts are back to zero.
+    :return: list of SQL statements
+    """
+    def node_dir(node_id):
+        return "(SELECT %s FROM ajxp_index WHERE node_id=%s)" % (sql_dirname("node_path"), node_id)
+
+    def counts(node_id):
+        return ("(SELECT count(*) FROM ajxp_node_status WHERE node_id=%s AND status NOT IN ('IDLE','CONFLICT'))" % node_id,
+                "(SELECT count(*) FROM ajxp_node_status WHERE node_id=%s AND status='CONFLICT')" % node_id)
+
+    def cleanup(dir_expr):
+        return "DELETE FROM ajxp_dir_status WHERE dir_path=%s AND pending<=0 AND conflict<=0; " % dir_expr
+
+    def add(dir_expr, pending, conflict):
+        return ("INSERT OR IGNORE INTO ajxp_dir_status (dir_path,pending,conflict) SELECT %s, 0, 0 "
+                "WHERE %s IS NOT NULL AND %s + %s > 0; "
+                "UPDATE ajxp_dir_status SET pending=pending+%s, conflict=conflict+%s WHERE dir_path=%s; "
+                % (dir_expr, dir_expr, pending, conflict, pending, conflict, dir_expr))
+
+    def remove(dir_expr, pending, conflict):
+        return ("UPDATE ajxp_dir_status SET pending=pending-%s, conflict=conflict-%s WHERE dir_path=%s; "
+                % (pending, conflict, dir_expr)) + cleanup(dir_expr)
+
+    new_status = ("(new.status NOT IN ('IDLE','CONFLICT'))", "(new.status='CONFLICT')")
+    old_status = ("(old.status NOT IN ('IDLE','CONFLICT'))", "(old.status='CONFLICT')")
+    return [
+        "CREATE TRIGGER DIR_STATUS_INSERT AFTER INSERT ON ajxp_node_status WHEN new.status<>'IDLE' BEGIN "
+        + add(node_dir("new.node_id"), *new_status) + "END",
+        "CREATE TRIGGER DIR_STATUS_UPDATE AFTER UPDATE OF status ON ajxp_node_status WHEN old.status<>new.status BEGIN "
+        + remove(node_dir("old.node_id"), *old_status) + add(node_dir("new.node_id"), *new_status) + "END",
+        "CREATE TRIGGER DIR_STATUS_MOVE AFTER UPDATE OF node_path ON ajxp_index WHEN %s<>%s BEGIN "
+        % (sql_dirname("old.node_path"), sql_dirname("new.node_path"))
+        + remove(sql_dirname("old.node_path"), *counts("old.node_id"))
+        + add(sql_dirname("new.node_path"), *counts("new.node_id")) + "END",
+        'CREATE TRIGGER "STATUS_DELETE" AFTER DELETE ON "ajxp_index" BEGIN '
+        + remove(sql_dirname("old.node_path"), *counts("old.node_id"))
+        + "DELETE FROM ajxp_node_status WHERE node_id=old.node_id; END",
+    ]
+
+
+def rebuild_dir_status(conn):
+    """
+    Recompute ajxp_dir_status from ajxp_node_status
+    :param conn: connection to the database
+    """
+    conn.execute("DELETE FROM ajxp_dir_status")
+    conn.execute("INSERT INTO ajxp_dir_status (dir_path, pending, conflict) SELECT " + sql_dirname("node_path") + ", "
+                 "sum(status NOT IN ('IDLE','CONFLICT')), sum(status='CONFLICT') FROM ajxp_index, ajxp_node_status "
+                 "WHERE ajxp_node_status.node_id = ajxp_index.node_id AND status<>'IDLE' GROUP BY 1")
+
+
+def subtree_bounds(node_path):
+    """
+    :param node_path: normalized path of a folder
+    :return: tuple (low, high), the descendants of node_path are the paths verifying low <= path < high. Unlike a
+    LIKE, this range is served by the index on node_path.
+    """
+    return node_path + os.sep, node_path + chr(ord(os.sep) + 1)
+
+
+def indexed_children(conn, node_path):
+    """
+    Direct children of a folder in the index. Each child is found by one lookup on the node_path index, then its own
+    descendants are jumped over, so the cost depends on the number of children, not on the size of the subtree.
+    :param conn: connection to use
+    :param node_path: normalized path of the folder, '' for the root
+    :return: iterator of rows (node_path, md5, bytesize, mtime_ns)
+    """
+    low, high = subtree_bounds(node_path)
+    while True:
+        row = conn.execute("SELECT node_path, md5, bytesize, mtime_ns FROM ajxp_index WHERE node_path >= ? "
+                           "AND node_path < ? ORDER BY node_path LIMIT 1", (low, high)).fetchone()
+        if row is None:
+            return
+        yield row
+        low = subtree_bounds(row['node_path'])[1]
+
+
+# Statuses set when a transfer starts, update_node_status() never buffers them
+TRANSFER_STATUSES = ('UP', 'DOWN')
+
+# Triggers firing for every node inserted in the index, replaced by set-based statements during a bulk load
+BULK_SUSPENDED_TRIGGERS = ('LOG_INSERT', 'STATUS_INSERT', 'DELETED_REUSE', 'DIR_STATUS_INSERT')
+
+
+def add_fingerprint_columns(conn):
+    """
+    Add the fingerprint columns, unless an upgrade interrupted before its user_version was written already did
+    :param conn: connection to the database being upgraded
+    """
+    for table in ('ajxp_index', 'ajxp_deleted'):
+        if 'fingerprint' not in [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)]:
+            conn.execute("ALTER TABLE %s ADD COLUMN fingerprint TEXT" % table)
+
+
+def enable_incremental_vacuum(conn):
+    """
+    Let compact_changes give the freed pages back to the filesystem. auto_vacuum only changes when the whole file
+    is rebuilt by a VACUUM, which cannot run inside a transaction.
+    :param conn: connection to the database being upgraded
+    """
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+# Statements bringing a pydio.sqlite created by a previous version to the schema of res/create.sql,
+# grouped by the user_version they lead to.
+DB_UPGRADES = [
+    (1, ["CREATE TABLE IF NOT EXISTS ajxp_hash_cache ( dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+         "ctime_ns INTEGER, md5 TEXT )",
+         "CREATE UNIQUE INDEX IF NOT EXISTS hash_cache_inode ON ajxp_hash_cache( dev, ino )"]),
+    (2, [migrate_pickled_stats]),
+    (3, ["CREATE TABLE IF NOT EXISTS ajxp_deleted ( node_id INTEGER PRIMARY KEY, seq INTEGER, basename TEXT, md5 TEXT, "
+         "source TEXT )",
+         "CREATE INDEX IF NOT EXISTS deleted_basename_md5 ON ajxp_deleted( basename, md5 )",
+         "CREATE INDEX IF NOT EXISTS deleted_seq ON ajxp_deleted( seq )",
+         "DROP TRIGGER IF EXISTS LOG_DELETE",
+         "CREATE TRIGGER LOG_DELETE AFTER DELETE ON ajxp_index BEGIN INSERT INTO ajxp_changes "
+         "(node_id,source,target,type,deleted_md5) VALUES (old.node_id, old.node_path, \"NULL\", \"delete\", old.md5); "
+         "INSERT OR REPLACE INTO ajxp_deleted (node_id,seq,basename,md5,source) VALUES (old.node_id, last_insert_rowid(), "
+         + sql_basename("old.node_path") + ", old.md5, old.node_path); END",
+         "CREATE TRIGGER IF NOT EXISTS DELETED_REUSE AFTER INSERT ON ajxp_index BEGIN DELETE FROM ajxp_deleted "
+         "WHERE node_id=new.node_id; END",
+         "INSERT OR REPLACE INTO ajxp_deleted (node_id,seq,basename,md5,source) SELECT node_id, seq, "
+         + sql_basename("source") + ", deleted_md5, source FROM ajxp_changes WHERE type='delete' "
+         "AND node_id NOT IN (SELECT node_id FROM ajxp_index) ORDER BY seq"]),
+    (4, ["CREATE TABLE IF NOT EXISTS ajxp_trigger_guard ( scope TEXT PRIMARY KEY )",
+         "DROP TRIGGER IF EXISTS LOG_UPDATE_CONTENT",
+         'CREATE TRIGGER "LOG_UPDATE_CONTENT" AFTER UPDATE ON "ajxp_index" FOR EACH ROW WHEN NOT EXISTS (SELECT 1 '
+         'FROM ajxp_trigger_guard WHERE scope=\'journal\') BEGIN INSERT INTO "ajxp_changes" (node_id,source,target,type) '
+         'VALUES (new.node_id, old.node_path, new.node_path, CASE WHEN old.node_path = new.node_path THEN "content" '
+         'ELSE "path" END);END']),
+    (5, ["CREATE TABLE IF NOT EXISTS ajxp_dir_status ( dir_path TEXT PRIMARY KEY, pending INTEGER NOT NULL DEFAULT 0, "
+         "conflict INTEGER NOT NULL DEFAULT 0 )",
+         "DROP TRIGGER IF EXISTS STATUS_DELETE"] + dir_status_triggers() + [rebuild_dir_status]),
+    (6, [add_fingerprint_columns,
+         "CREATE INDEX IF NOT EXISTS deleted_basename_fingerprint ON ajxp_deleted( basename, fingerprint )",
+         "INSERT OR IGNORE INTO ajxp_trigger_guard (scope) VALUES ('journal')",
+         "UPDATE ajxp_index SET fingerprint=md5 WHERE md5 NOT IN ('directory', 'HASHME') AND bytesize <= %i"
+         % FULL_HASH_LIMIT,
+         "DELETE FROM ajxp_trigger_guard WHERE scope='journal'",
+         "DROP TRIGGER IF EXISTS LOG_DELETE",
+         "CREATE TRIGGER LOG_DELETE AFTER DELETE ON ajxp_index BEGIN INSERT INTO ajxp_changes "
+         "(node_id,source,target,type,deleted_md5) VALUES (old.node_id, old.node_path, \"NULL\", \"delete\", old.md5); "
+         "INSERT OR REPLACE INTO ajxp_deleted (node_id,seq,basename,md5,fingerprint,source) VALUES (old.node_id, "
+         "last_insert_rowid(), " + sql_basename("old.node_path") + ", old.md5, old.fingerprint, old.node_path); END"]),
+    (7, [enable_incremental_vacuum]),
+]
+
+
 class SqlSnapshot(object):
 
     def __init__(self, basepath, job_data_path, sub_folder=None):
@@ -66,21 +324,20 @@ class SqlSnapshot(object):
     @pydio_profile
     def load_from_db(self):
 
-        conn = sqlite3.connect(self.db, timeout=self.timeout)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        if self.sub_folder:
-            res = c.execute("SELECT node_path,stat_result FROM ajxp_index WHERE stat_result NOT NULL "
-                            "AND (node_path=? OR node_path LIKE ?)",
-                            (os.path.normpath(self.sub_folder), os.path.normpath(self.sub_folder+'/%'),))
-        else:
-            res = c.execute("SELECT node_path,stat_result FROM ajxp_index WHERE stat_result NOT NULL")
-        for row in res:
-            stat = pickle.loads(str(row['stat_result']))
-            path = self.basepath + row['node_path']
-            self._stat_snapshot[path] = stat
-            self._inode_to_path[stat.st_ino] = path
-        c.close()
+        with ClosingCursor(self.db, timeout=self.timeout) as c:
+            if self.sub_folder:
+                sub_folder = os.path.normpath(self.sub_folder)
+                res = c.execute("SELECT node_path, mode, ino, dev, bytesize, mtime_ns, ctime_ns FROM ajxp_index "
+                                "WHERE mode NOT NULL AND (node_path=? OR (node_path>=? AND node_path<?))",
+                                (sub_folder,) + subtree_bounds(sub_folder))
+            else:
+                res = c.execute("SELECT node_path, mode, ino, dev, bytesize, mtime_ns, ctime_ns FROM ajxp_index "
+                                "WHERE mode NOT NULL")
+            for row in res:
+                stat = IndexStat.from_row(row)
+                path = self.basepath + row['node_path']
+                self._stat_snapshot[path] = stat
+                self._inode_to_path[stat.st_ino] = path
 
     def __sub__(self, previous_dirsnap):
         """Allow subtracting a DirectorySnapshot object instance from
@@ -141,6 +398,12 @@ class SqlSnapshot(object):
 
 
 class ClosingCursor():
+    """
+    Borrow a long-lived connection of the current thread for a few statements. Read mode gives a cursor that is
+    closed on exit. Write mode gives a connection of the thread kept for ClosingCursor writes, and commits
+    (withCommit) or rolls back on exit: the changes pending on the other connection of the thread are left alone.
+    Write blocks must not be nested.
+    """
 
     def __init__(self, file='', timeout=4, write=False, withCommit=False, retries=100):
         self.file=file
@@ -148,10 +411,12 @@ class ClosingCursor():
         self.retries = retries
         self.write = write
         self.withCommit = withCommit
+        self.cursor = None
 
     def open(self, retry=0):
         try:
-            self.conn = sqlite3.connect(self.file, timeout=self.timeout)
+            connections = SqliteConnections.for_db(self.file, self.timeout)
+            self.conn = connections.get('closing_cursor' if self.write else 'conn')
         except sqlite3.OperationalError as e:
             time.sleep(.2)
             if retry < self.retries:
@@ -164,27 +429,111 @@ class ClosingCursor():
         if self.write:
             return self.conn
         else:
-            self.conn.row_factory = sqlite3.Row
-            return self.conn.cursor()
+            self.cursor = self.conn.cursor()
+            return self.cursor
 
     def __exit__(self, type, value, traceback):
-        if self.write and self.withCommit:
-            self.conn.commit()
-        self.conn.close()
+        if self.write:
+            if self.withCommit and type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        elif self.cursor is not None:
+            self.cursor.close()
+
+
+class HashCache(object):
+    """
+    Content hashes of the local files, keyed by their stat signature. A file whose signature did not change since
+    it was last hashed is never read again.
+    """
+
+    # Files modified less than racy_delay seconds before being hashed are not cached: another write landing in the
+    # same mtime tick would go unnoticed.
+    racy_delay = 2
+
+    def __init__(self, db, timeout=30):
+        self.db = db
+        self.timeout = timeout
+
+    def get(self, stat_result, conn=None):
+        """
+        :param stat_result: os.stat_result of the file
+        :param conn: connection to use, mandatory when called while a transaction is opened on the db
+        :return: the cached md5 or None
+        """
+        sig = stat_signature(stat_result)
+        if not sig:
+            return None
+
+        def lookup(c):
+            for row in c.execute("SELECT size, mtime_ns, ctime_ns, md5 FROM ajxp_hash_cache WHERE dev=? AND ino=?",
+                                 sig[:2]):
+                if (row[0], row[1], row[2]) == sig[2:]:
+                    return row[3]
+            return None
+
+        if conn is not None:
+            return lookup(conn)
+        try:
+            with ClosingCursor(self.db, timeout=self.timeout) as c:
+                return lookup(c)
+        except sqlite3.OperationalError as oe:
+            logging.debug("Hash cache lookup failed: %s" % oe)
+            return None
+
+    def put(self, stat_result, md5, conn=None):
+        sig = stat_signature(stat_result)
+        if not sig or md5 in (None, 'directory', 'HASHME') or time.time() - stat_result.st_mtime < self.racy_delay:
+            return
+        sql = "INSERT OR REPLACE INTO ajxp_hash_cache (dev, ino, size, mtime_ns, ctime_ns, md5) VALUES (?,?,?,?,?,?)"
+        if conn is not None:
+            conn.execute(sql, sig + (md5,))
+            return
+        try:
+            with ClosingCursor(self.db, timeout=self.timeout, write=True, withCommit=True) as c:
+                c.execute(sql, sig + (md5,))
+        except sqlite3.OperationalError as oe:
+            logging.debug("Hash cache update failed: %s" % oe)
+
+    def hash(self, path, stat_result=None, conn=None):
+        """
+        :param path: full path of the file
+        :param stat_result: stat of the file, if already known by the caller
+        :param conn: connection to use, mandatory when called while a transaction is opened on the db
+        :return: md5 of the file, only read from disk when the cache does not know its current signature
+        """
+        if stat_result is None:
+            stat_result = os.stat(path)
+        md5 = self.get(stat_result, conn)
+        if md5:
+            return md5
+        with open(path, 'rb') as fd:
+            stat_result = os.fstat(fd.fileno())
+            md5 = hashfile(fd, hashlib.md5())
+        self.put(stat_result, md5, conn)
+        return md5
 
 
 class LocalDbHandler():
 
+    upgraded_dbs = set()
+
     def __init__(self, job_data_path='', base=''):
         self.base = base
         self.db = job_data_path + '/pydio.sqlite'
         self.job_data_path = job_data_path
         self.event_handler = None
+        # update_node_status() calls waiting to be written, for the threads that enabled buffer_node_status()
+        self.status_buffer = threading.local()
         global_config_manager = GlobalConfigManager.Instance(configs_path=job_data_path)
         # Increasing the timeout (default 5 seconds), to avoid database is locked error
         self.timeout = global_config_manager.get_general_config()['max_wait_time_for_local_db_access']
         if not os.path.exists(self.db):
             self.init_db()
+        self.upgrade_db()
+        self.connections = SqliteConnections.for_db(self.db, self.timeout)
+        self.hash_cache = HashCache(self.db, self.timeout)
 
     def normpath(self, path):
         return os.path.normpath(path)
@@ -209,12 +558,36 @@ class LocalDbHandler():
                 cursor.execute(statement)
         conn.close()
 
+    def upgrade_db(self):
+        """
+        Apply the DB_UPGRADES the database has not seen yet, based on its user_version pragma
+        """
+        if self.db in LocalDbHandler.upgraded_dbs:
+            return
+        conn = sqlite3.connect(self.db, timeout=self.timeout)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target, statements in DB_UPGRADES:
+                if version >= target:
+                    continue
+                logging.info("Upgrading local database %s to version %i" % (self.db, target))
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute("PRAGMA user_version = %i" % target)
+                conn.commit()
+        finally:
+            conn.close()
+        LocalDbHandler.upgraded_dbs.add(self.db)
+
     @pydio_profile
     def find_node_by_id(self, node_path, with_status=False):
         node_path = self.normpath(node_path)
         with ClosingCursor(self.db, timeout=self.timeout) as c:
             id = False
-            q = "SELECT node_id FROM ajxp_index WHERE node_path LIKE ?"
+            q = "SELECT node_id FROM ajxp_index WHERE node_path = ?"
             if with_status:
                 q = "SELECT ajxp_index.node_id FROM ajxp_index,ajxp_node_status WHERE ajxp_index.node_path = ? AND ajxp_node_status.node_id = ajxp_index.node_id"
             for row in c.execute(q, (node_path,)):
@@ -229,7 +602,7 @@ class LocalDbHandler():
         """
         node_path = self.normpath(node_path)
         with ClosingCursor(self.db, timeout=self.timeout) as c:
-            for row in c.execute("SELECT md5 FROM ajxp_index WHERE node_path LIKE ?", (node_path,)):
+            for row in c.execute("SELECT md5 FROM ajxp_index WHERE node_path = ?", (node_path,)):
                 md5 = row['md5']
                 c.close()
                 return md5
@@ -257,12 +630,10 @@ class LocalDbHandler():
         try:
             status = "IDLE"
             with ClosingCursor(self.db, timeout=self.timeout) as c:
-                if [r[0] for r in c.execute("SELECT COUNT(ajxp_index.node_id) \
-                             FROM ajxp_index \
-                             LEFT JOIN ajxp_node_status \
-                             ON ajxp_node_status.node_id = ajxp_index.node_id\
-                             WHERE ajxp_node_status.status<>'IDLE' \
-                             AND ajxp_index.node_path LIKE ?", (self.normpath(node_path + '/%'),))][0] > 0:
+                # ajxp_dir_status only holds the folders having non IDLE children
+                for row in c.execute("SELECT dir_path FROM ajxp_dir_status "
+                                     "WHERE dir_path = ? OR (dir_path >= ? AND dir_path < ?) LIMIT 1",
+                                     (node_path,) + subtree_bounds(node_path)):
                     status = "PENDING"
             return status
         except sqlite3.OperationalError:
@@ -312,26 +683,64 @@ class LocalDbHandler():
 
     @pydio_profile
     def update_node_status(self, node_path, status='IDLE', detail=''):
-        node_path = self.normpath(node_path)
-        if detail:
-            detail = pickle.dumps(detail)
-        node_id = self.find_node_by_id(node_path, with_status=True)
+        entries = getattr(self.status_buffer, 'entries', None)
+        if entries is None:
+            self.update_bulk_node_status([(node_path, status, detail)])
+            return
+        entries.append((node_path, status, detail))
+        # a transfer may last long and nothing is written while it runs: its status, and the ones before it, go now
+        if status in TRANSFER_STATUSES or len(entries) >= self.status_buffer.size or \
+                time.time() - self.status_buffer.since > self.status_buffer.delay:
+            self.flush_node_status()
 
-        with ClosingCursor(self.db, timeout=self.timeout, write=True, withCommit=True) as conn:
+    @pydio_profile
+    def update_bulk_node_status(self, entries):
+        """
+        Apply many status updates in one transaction
+        :param entries: list of tuples (node_path, status, detail), applied in order
+        """
+        rows = []
+        for node_path, status, detail in entries:
+            if detail:
+                detail = pickle.dumps(detail)
             if not isinstance(status, str):
                 logging.info("The status type is not string by default, explicitly assigning it a string value")
                 status = "False"
-
             if not isinstance(detail, str):
                 logging.info("The detail type is not string by default, explicitly assigning it a string value")
                 detail = ""
+            rows.append((status, detail, self.normpath(node_path)))
+        if not rows:
+            return
+        with ClosingCursor(self.db, timeout=self.timeout, write=True, withCommit=True) as conn:
+            conn.executemany("INSERT OR IGNORE INTO ajxp_node_status (node_id,status,detail) SELECT node_id, ?, ? "
+                             "FROM ajxp_index WHERE node_path=?", rows)
+            conn.executemany("UPDATE ajxp_node_status SET status=?, detail=? WHERE node_id=(SELECT node_id "
+                             "FROM ajxp_index WHERE node_path=?)", rows)
 
-            if not node_id:
-                node_id = self.find_node_by_id(node_path, with_status=False)
-                if node_id:
-                    conn.execute("INSERT OR IGNORE INTO ajxp_node_status (node_id,status,detail) VALUES (?,?,?)", (node_id, status, detail))
-            else:
-                conn.execute("UPDATE ajxp_node_status SET status=?, detail=? WHERE node_id=?", (status, detail, node_id))
+    def buffer_node_status(self, size=500, delay=1):
+        """
+        Until flush_node_status(stop=True), the update_node_status() calls of the current thread are written by
+        batches, when size updates are waiting or after delay seconds. There is no timer: the buffer is written at the
+        first call after that, and at the start of every transfer (TRANSFER_STATUSES). Other threads still write
+        immediately.
+        """
+        if getattr(self.status_buffer, 'entries', None) is None:
+            self.status_buffer.entries = []
+        self.status_buffer.size = size
+        self.status_buffer.delay = delay
+        self.status_buffer.since = time.time()
+
+    def flush_node_status(self, stop=False):
+        """
+        Write the status updates buffered by the current thread
+        :param stop: also stop buffering
+        """
+        entries = getattr(self.status_buffer, 'entries', None)
+        self.status_buffer.entries = None if stop or entries is None else []
+        self.status_buffer.since = time.time()
+        if entries:
+            self.update_bulk_node_status(entries)
 
     @pydio_profile
     def update_bulk_node_status_as_idle(self):
@@ -341,8 +750,7 @@ class LocalDbHandler():
     @pydio_profile
     def update_bulk_node_status_as_pending(self, list_seq_ids):
         if(len(list_seq_ids)) > 0:
-            conn = sqlite3.connect(self.db, timeout=self.timeout)
-            conn.row_factory = sqlite3.Row
+            conn = self.connections.get()
             try:
                 seq_ids = str(",".join(list_seq_ids))
 
@@ -358,9 +766,9 @@ class LocalDbHandler():
                               AND ajxp_index.md5<>"directory" \
                               AND ajxp_index.bytesize>0)')
                 conn.commit()
-                conn.close()
 
             except Exception as ex:
+                conn.rollback()
                 logging.exception(ex)
                 pass
 
@@ -379,14 +787,10 @@ class LocalDbHandler():
     @pydio_profile
     def get_local_changes_as_stream(self, seq_id, flatten_and_store_callback):
         if self.event_handler:
-            i = 1
-            cannot_read = (int(round(time.time() * 1000)) - self.event_handler.last_write_time) < (self.event_handler.db_wait_duration*1000)
-            while cannot_read:
-                logging.info('waiting db writing to end before retrieving local changes...')
-                cannot_read = (int(round(time.time() * 1000)) - self.event_handler.last_write_time) < (self.event_handler.db_wait_duration*1000)
-                time.sleep(i*self.event_handler.db_wait_duration)
-                i += 1
-            self.event_handler.reading = True
+            # the changes must carry the full MD5 of the files, not only their fingerprint: only the changed files are
+            # hashed here, the others are left to the background pass
+            self.event_handler.hash_pending(since_seq=seq_id)
+            self.event_handler.begin_read()
         info = dict()
         info['max_seq'] = seq_id
         try:
@@ -394,7 +798,7 @@ class LocalDbHandler():
             with ClosingCursor(self.db, timeout=self.timeout) as c:
                 for line in c.execute("SELECT seq , ajxp_changes.node_id ,  type ,  "
                                      "source , target, ajxp_index.bytesize, ajxp_index.md5, ajxp_index.mtime, "
-                                     "ajxp_index.node_path, ajxp_index.stat_result, ajxp_changes.deleted_md5 FROM ajxp_changes LEFT JOIN ajxp_index "
+                                     "ajxp_index.node_path, ajxp_changes.deleted_md5 FROM ajxp_changes LEFT JOIN ajxp_index "
                                      "ON ajxp_changes.node_id = ajxp_index.node_id "
                                      "WHERE seq > ? ORDER BY ajxp_changes.node_id, seq ASC", (seq_id,)):
                     row = dict(line)
@@ -405,15 +809,13 @@ class LocalDbHandler():
             flatten_and_store_callback('local', None, info)
             if info:
                 self.event_handler.last_seq_id = info['max_seq']
-
-            if self.event_handler:
-                self.event_handler.reading = False
             return info['max_seq']
         except Exception as ex:
             logging.exception(ex)
-            if self.event_handler:
-                self.event_handler.reading = False
             return info['max_seq']
+        finally:
+            if self.event_handler:
+                self.event_handler.end_read()
 
     def list_non_idle_nodes(self):
         logging.info("Listing non IDLE nodes")
@@ -428,17 +830,67 @@ class LocalDbHandler():
         """
         with ClosingCursor(self.db, timeout=self.timeout) as c:
             res = c.execute("SELECT MAX(seq) FROM ajxp_changes").fetchone()[0]
+            if res is None:
+                # the journal may be empty after a compaction, AUTOINCREMENT still knows the last sequence
+                res = c.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name='ajxp_changes'").fetchone()[0]
             if res is None:
                 res = 0
             return res
 
+    @pydio_profile
+    def compact_changes(self, checkpoint, batch_size=10000, interrupt=None):
+        """
+        Delete the journal rows already consumed by the merger, one short write transaction per batch so that the
+        watcher is never held for long. Freed pages are reused by SQLite, and given back to the filesystem when the
+        db uses auto_vacuum=INCREMENTAL, see enable_incremental_vacuum().
+        :param checkpoint: acknowledged local sequence, rows up to it are deleted
+        :param batch_size: sequence range deleted per transaction
+        :param interrupt: callable, compaction stops before the next batch when it returns True
+        :return: dict with the number of rows deleted and the bytes reclaimed
+        """
+        conn = self.connections.get()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        deleted = 0
+        low = conn.execute("SELECT MIN(seq) FROM ajxp_changes").fetchone()[0]
+        while low is not None and low <= checkpoint:
+            if interrupt and interrupt():
+                break
+            high = min(low + batch_size - 1, checkpoint)
+            if self.event_handler:
+                self.event_handler.lock_db()
+            try:
+                deleted += conn.execute("DELETE FROM ajxp_changes WHERE seq >= ? AND seq <= ?", (low, high)).rowcount
+                conn.commit()
+            except sqlite3.OperationalError as oe:
+                # the next compaction will resume from here
+                conn.rollback()
+                logging.debug("Journal compaction stopped: %s" % oe)
+                break
+            finally:
+                if self.event_handler:
+                    self.event_handler.unlock_db()
+            low = conn.execute("SELECT MIN(seq) FROM ajxp_changes WHERE seq > ?", (high,)).fetchone()[0]
+        freed = conn.execute("PRAGMA freelist_count").fetchone()[0] - free_pages
+        if deleted and conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            if self.event_handler:
+                self.event_handler.lock_db()
+            try:
+                conn.execute("PRAGMA incremental_vacuum").fetchall()
+                conn.commit()
+            except sqlite3.OperationalError as oe:
+                conn.rollback()
+                logging.debug("Incremental vacuum failed: %s" % oe)
+            finally:
+                if self.event_handler:
+                    self.event_handler.unlock_db()
+        return {'rows': deleted, 'bytes': max(freed, 0) * page_size, 'checkpoint': checkpoint}
+
 
 class SqlEventHandler(FileSystemEventHandler):
-    """reading = False
-    last_write_time = 0
-    db_wait_duration = 1"""
 
-    def __init__(self, basepath, includes, excludes, job_data_path):
+    def __init__(self, basepath, includes, excludes, job_data_path, poolsize=None, hash_processes=False,
+                 local_hash='md5'):
         super(SqlEventHandler, self).__init__()
         self.base = basepath
         self.includes = includes
@@ -446,15 +898,36 @@ class SqlEventHandler(FileSystemEventHandler):
         db_handler = LocalDbHandler(job_data_path, basepath)
         self.unique_id = hashlib.md5(job_data_path.encode(guess_filesystemencoding())).hexdigest()
         self.db = db_handler.db
+        self.connections = db_handler.connections
+        self.hash_cache = db_handler.hash_cache
         # Increasing the timeout (default 5 seconds), to avoid database is locked error
         self.timeout = db_handler.timeout
         self.reading = False
         self.last_write_time = 0
-        self.db_wait_duration = .4
         self.last_seq_id = 0
         self.prevent_atomic_commit = False
         self.con = None
         self.locked = False
+        # Serializes the writers: a transaction (begin/end_transaction) and the on_* callbacks of other threads
+        self.write_lock = threading.RLock()
+        self.write_depth = 0
+        # Handshake between the writers and the merger reading the changes: notified whenever a write or a read ends
+        self.db_state = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.waiting_readers = 0
+        self.moved_subtrees = deque(maxlen=100)
+        self.hash_pool = HashPool(poolsize, use_processes=hash_processes)
+        self.hash_batch_size = 1000
+        # algorithm of the fingerprints, MD5 is only computed by the hashing pass when another one is used
+        self.local_hash = local_hash
+        # called with the path of the files that could not be read, see local_watcher.SettleQueue
+        self.unreadable_callback = None
+        # MD5 of the files indexed with a fingerprint only are filled in the background by this thread
+        self.hashing_lock = threading.Lock()
+        self.hashing_pass_lock = threading.Lock()
+        self.hashing_needed = threading.Event()
+        self.hashing_thread = None
+        self.closed = False
 
     @staticmethod
     def get_unicode_path(src):
@@ -504,13 +977,11 @@ class SqlEventHandler(FileSystemEventHandler):
     @pydio_profile
     def on_moved(self, event):
         #   logging.info(event.src_path + event.dest_path)
+        if not self.included(event):
+            logging.debug('ignoring move event ' + self.get_unicode_path(event.src_path) + " " + self.get_unicode_path(event.dest_path))
+            return
+        self.lock_db()
         try:
-
-            if not self.included(event):
-                logging.debug('ignoring move event ' + self.get_unicode_path(event.src_path) + " " + self.get_unicode_path(event.dest_path))
-                return
-
-            self.lock_db()
             target_key = self.remove_prefix(self.get_unicode_path(event.dest_path))
             source_key = self.remove_prefix(self.get_unicode_path(event.src_path))
             logging.debug("Event: move noticed: " + event.event_type + " on file " + target_key + " at " + time.asctime())
@@ -518,9 +989,8 @@ class SqlEventHandler(FileSystemEventHandler):
             if self.prevent_atomic_commit:
                 conn = self.transaction_conn
             else:
-                conn = sqlite3.connect(self.db, timeout=self.timeout)
+                conn = self.connections.get()
 
-            conn.row_factory = sqlite3.Row
             c = conn.cursor()
             target_id = None
             node_id = None
@@ -533,6 +1003,9 @@ class SqlEventHandler(FileSystemEventHandler):
             c.close()
             if not node_id:
                 if target_id:
+                    if self.covered_by_subtree_move(source_key, target_key):
+                        logging.debug("Ignoring move of %s, already moved with its parent folder" % source_key)
+                        return
                     # fake update = content
                     conn.execute("UPDATE ajxp_index SET node_path=? WHERE node_path=?", (target_key, target_key, ))
                 else:
@@ -541,15 +1014,73 @@ class SqlEventHandler(FileSystemEventHandler):
             else:
                 t = (target_key,source_key,)
                 conn.execute("UPDATE ajxp_index SET node_path=? WHERE node_path=?", t)
+                if event.is_directory:
+                    self.move_subtree(conn, source_key, target_key)
             if not self.prevent_atomic_commit:
                 conn.commit()
-                conn.close()
         except sqlite3.OperationalError:
+            if not self.prevent_atomic_commit:
+                self.connections.get().rollback()
             time.sleep(.1)
             self.on_moved(event)
         except Exception as ex:
             logging.exception(ex)
-        self.unlock_db()
+        finally:
+            self.unlock_db()
+
+    def move_subtree(self, conn, source_key, target_key):
+        """
+        Rewrite the path of all the descendants of a moved folder in one statement. The journal only gets the
+        "path" change of the folder itself, the per-child move events following this one are ignored.
+        :param conn: connection of the current write
+        :param source_key: former path of the folder
+        :param target_key: new path of the folder
+        """
+        low, high = subtree_bounds(source_key)
+        conn.execute("INSERT OR IGNORE INTO ajxp_trigger_guard (scope) VALUES ('journal')")
+        try:
+            res = conn.execute("UPDATE ajxp_index SET node_path = ? || substr(node_path, length(?) + 1) "
+                               "WHERE node_path >= ? AND node_path < ?", (target_key, source_key, low, high))
+            logging.debug("Moved %i children of %s" % (res.rowcount, source_key))
+        finally:
+            conn.execute("DELETE FROM ajxp_trigger_guard WHERE scope='journal'")
+        self.moved_subtrees.append((source_key, target_key))
+
+    def update_directory_stats(self, directories):
+        """
+        Store the stat the directories had when they were listed, once their content is indexed: the startup scan
+        skips the directories whose mtime still matches. These updates are not logged as changes.
+        :param directories: list of tuples (full path, stat_result)
+        """
+        if not directories:
+            return
+        values = [(dir_stat.st_mtime,) + stat_columns(dir_stat) + (self.remove_prefix(path),)
+                  for path, dir_stat in directories]
+        self.lock_db()
+        try:
+            if self.prevent_atomic_commit:
+                conn = self.transaction_conn
+            else:
+                conn = self.connections.get()
+            conn.execute("INSERT OR IGNORE INTO ajxp_trigger_guard (scope) VALUES ('journal')")
+            try:
+                conn.executemany("UPDATE ajxp_index SET mtime=?, mode=?, ino=?, dev=?, mtime_ns=?, ctime_ns=? "
+                                 "WHERE node_path=? AND md5='directory'", values)
+            finally:
+                conn.execute("DELETE FROM ajxp_trigger_guard WHERE scope='journal'")
+            if not self.prevent_atomic_commit:
+                conn.commit()
+        finally:
+            self.unlock_db()
+
+    def covered_by_subtree_move(self, source_key, target_key):
+        """
+        :return: True if the move of source_key to target_key was already done by a recent move_subtree()
+        """
+        for source, target in self.moved_subtrees:
+            if source_key.startswith(source + os.sep) and target_key == target + source_key[len(source):]:
+                return True
+        return False
 
     @pydio_profile
     def on_created(self, event):
@@ -558,21 +1089,23 @@ class SqlEventHandler(FileSystemEventHandler):
             return
         self.lock_db()
         try:
-            src_path = self.get_unicode_path(event.src_path)
-            logging.debug("Event: creation noticed: " + event.event_type +
-                          " on file " + src_path + " at " + time.asctime())
-            if not os.path.exists(src_path):
-                return
-        except Exception as ex:
-            logging.exception(ex)
-        while True:
             try:
-                self.updateOrInsert(src_path, is_directory=event.is_directory, skip_nomodif=False)
-                break
-            except sqlite3.OperationalError:  # database locked
-                logging.info('DB locked')
-                time.sleep(.1)
-        self.unlock_db()
+                src_path = self.get_unicode_path(event.src_path)
+                logging.debug("Event: creation noticed: " + event.event_type +
+                              " on file " + src_path + " at " + time.asctime())
+                if not os.path.exists(src_path):
+                    return
+            except Exception as ex:
+                logging.exception(ex)
+            while True:
+                try:
+                    self.updateOrInsert(src_path, is_directory=event.is_directory, skip_nomodif=False)
+                    break
+                except sqlite3.OperationalError:  # database locked
+                    logging.info('DB locked')
+                    time.sleep(.1)
+        finally:
+            self.unlock_db()
 
     @pydio_profile
     def on_deleted(self, event):
@@ -580,24 +1113,28 @@ class SqlEventHandler(FileSystemEventHandler):
             return
         logging.debug("Event: deletion noticed: " + event.event_type + " on file " + self.get_unicode_path(event.src_path) + " at " + time.asctime())
         self.lock_db()
-        while True:
-            try:
-                src_path = self.get_unicode_path(event.src_path)
-                if self.prevent_atomic_commit:
-                    conn = self.transaction_conn
-                else:
-                    conn = sqlite3.connect(self.db, timeout=self.timeout)
-                    conn.row_factory = sqlite3.Row
-                conn.execute("DELETE FROM ajxp_index WHERE node_path LIKE ?", (self.remove_prefix(src_path) + '%',))
-                if not self.prevent_atomic_commit:
-                    conn.commit()
-                    conn.close()
-                break
-            except sqlite3.OperationalError:
-                time.sleep(.1)
-            except Exception as ex:
-                logging.exception(ex)
-        self.unlock_db()
+        try:
+            while True:
+                try:
+                    src_path = self.get_unicode_path(event.src_path)
+                    if self.prevent_atomic_commit:
+                        conn = self.transaction_conn
+                    else:
+                        conn = self.connections.get()
+                    node_path = self.remove_prefix(src_path)
+                    conn.execute("DELETE FROM ajxp_index WHERE node_path = ? OR (node_path >= ? AND node_path < ?)",
+                                 (node_path,) + subtree_bounds(node_path))
+                    if not self.prevent_atomic_commit:
+                        conn.commit()
+                    break
+                except sqlite3.OperationalError:
+                    if not self.prevent_atomic_commit:
+                        self.connections.get().rollback()
+                    time.sleep(.1)
+                except Exception as ex:
+                    logging.exception(ex)
+        finally:
+            self.unlock_db()
 
     @pydio_profile
     def on_modified(self, event):
@@ -606,60 +1143,109 @@ class SqlEventHandler(FileSystemEventHandler):
             logging.debug('ignoring modified event ' + self.get_unicode_path(event.src_path))
             return
         self.lock_db()
-        while True:
-            try:
-                src_path = self.get_unicode_path(event.src_path)
-                if event.is_directory:
-                    if os.path.isdir(src_path):
-                        files_in_dir = [src_path+"/"+f for f in os.listdir(src_path)]
-                        if len(files_in_dir) > 0:
-                            modified_filename = max(files_in_dir, key=os.path.getmtime)
-                        else:
-                            return
+        try:
+            while True:
+                try:
+                    src_path = self.get_unicode_path(event.src_path)
+                    if event.is_directory:
+                        if os.path.isdir(src_path):
+                            self.reconcile_directory(src_path)
                     else:
-                        return
-                    if os.path.isfile(modified_filename) and self.included(event=None, base=self.remove_prefix(modified_filename)):
-                        logging.debug("Event: modified file 1 : %s" % self.remove_prefix(modified_filename))
+                        modified_filename = src_path
+                        if not os.path.exists(src_path):
+                            return
+                        if not self.included(event=None, base=self.remove_prefix(modified_filename)):
+                            return
+                        logging.debug("Event: modified file : %s" % self.remove_prefix(modified_filename))
                         self.updateOrInsert(modified_filename, is_directory=False, skip_nomodif=True)
-                else:
-                    modified_filename = src_path
-                    if not os.path.exists(src_path):
-                        return
-                    if not self.included(event=None, base=self.remove_prefix(modified_filename)):
-                        return
-                    logging.debug("Event: modified file : %s" % self.remove_prefix(modified_filename))
-                    self.updateOrInsert(modified_filename, is_directory=False, skip_nomodif=True)
-                break
-            except sqlite3.OperationalError:
-                time.sleep(.1)
-            except sqlite3.ProgrammingError:
-                logging.info("Note to dev: Experimental check the callee.")
-                conn = sqlite3.connect(self.db, timeout=self.timeout)
-                conn.row_factory = sqlite3.Row
-            except Exception as ex:
-                logging.exception(ex)
-        self.unlock_db()
+                    break
+                except sqlite3.OperationalError:
+                    time.sleep(.1)
+                except sqlite3.ProgrammingError:
+                    logging.info("Note to dev: Experimental check the callee.")
+                except Exception as ex:
+                    logging.exception(ex)
+                    break
+        finally:
+            self.unlock_db()
+
+    @pydio_profile
+    def reconcile_directory(self, src_path):
+        """
+        Compare the files of a directory with their index rows and apply all the differences in one transaction:
+        files created, modified (size or mtime) or deleted since they were indexed. Subfolders are left to their own
+        events.
+        :param src_path: full path of the directory
+        :return: number of files updated or deleted
+        """
+        parent_key = self.remove_prefix(src_path)
+        if parent_key in ('.', os.sep):
+            parent_key = ''
+        own_transaction = not self.prevent_atomic_commit
+        if own_transaction:
+            self.begin_transaction()
+        try:
+            conn = self.transaction_conn
+            dir_stat = os.stat(src_path)
+            indexed = dict((row['node_path'], row) for row in indexed_children(conn, parent_key))
+            modified = []
+            for name, stat_result in scan_dir(src_path):
+                key = parent_key + os.sep + name
+                row = indexed.pop(key, None)
+                if S_ISDIR(stat_result.st_mode) or not self.included(FileModifiedEvent(os.path.join(src_path, name))):
+                    continue
+                if row is None or row['bytesize'] != stat_result.st_size \
+                        or not same_mtime(row['mtime_ns'], stat_columns(stat_result)[3]):
+                    modified.append(os.path.join(src_path, name))
+            deleted = [key for key, row in indexed.items()
+                       if row['md5'] != 'directory' and self.included(FileDeletedEvent(self.base + key))]
+            for path in modified:
+                logging.debug("Event: modified file : %s" % self.remove_prefix(path))
+                self.updateOrInsert(path, is_directory=False, skip_nomodif=True)
+            for key in deleted:
+                logging.debug("Event: deleted file : %s" % key)
+                conn.execute("DELETE FROM ajxp_index WHERE node_path = ?", (key,))
+            self.update_directory_stats([(src_path, dir_stat)])
+            return len(modified) + len(deleted)
+        finally:
+            if own_transaction:
+                self.end_transaction()
 
     @pydio_profile
     def updateOrInsert(self, src_path, is_directory, skip_nomodif, force_insert=False):
         search_key = self.remove_prefix(src_path)
         size = 0
         mtime = 0
+        fingerprint = None
+        if self.prevent_atomic_commit:
+            conn = self.transaction_conn
+        else:
+            conn = self.connections.get()
 
         try:
-            stat = os.stat(src_path)
             if is_directory:
+                stat = os.stat(src_path)
                 hash_key = 'directory'
             else:
+                stat = os.stat(src_path)
+                cached = self.hash_cache.get(stat, conn=conn)
+                if cached and stat.st_size <= FULL_HASH_LIMIT and self.local_hash == 'md5':
+                    # the fingerprint of a small file is its MD5
+                    fingerprint = hash_key = cached
+                else:
+                    fingerprint, hash_key, stat = fingerprint_file(src_path, self.local_hash)
+                    if hash_key:
+                        self.hash_cache.put(stat, hash_key, conn=conn)
+                    else:
+                        # Will be hashed by the hashing pass
+                        hash_key = self.hash_cache.get(stat, conn=conn) or "HASHME"
                 size = stat.st_size
                 mtime = stat.st_mtime
-                if self.prevent_atomic_commit:
-                    hash_key = "HASHME"  # Will be hashed when transaction ends
-                else:
-                    hash_key = hashfile(open(src_path, 'rb'), hashlib.md5())
         except IOError:
-            # Skip the file from processing, It could be a file that is being copied or a open file!
-            logging.debug('Skipping file %s, as it is being copied / kept open!' % src_path)
+            # It could be a file that is being copied or a open file, try again later
+            logging.debug('Cannot read file %s for now, as it is being copied / kept open!' % src_path)
+            if self.unreadable_callback:
+                self.unreadable_callback(src_path)
             return
         except Exception as e:
             logging.exception(e)
@@ -668,11 +1254,6 @@ class SqlEventHandler(FileSystemEventHandler):
         while True:
             try:
                 node_id = False
-                if self.prevent_atomic_commit:
-                    conn = self.transaction_conn
-                else:
-                    conn = sqlite3.connect(self.db, timeout=self.timeout)
-                    conn.row_factory = sqlite3.Row
                 if not force_insert:
                     c = conn.cursor()
                     node_id = None
@@ -687,8 +1268,8 @@ class SqlEventHandler(FileSystemEventHandler):
                         size,
                         hash_key,
                         mtime,
-                        pickle.dumps(stat)
-                    )
+                        fingerprint
+                    ) + stat_columns(stat)
                     logging.debug("Real insert %s" % search_key)
                     c = conn.cursor()
                     del_element = None
@@ -698,7 +1279,8 @@ class SqlEventHandler(FileSystemEventHandler):
                         if existing_id:
                             del_element = self.find_deleted_element(c, self.last_seq_id, os.path.basename(src_path), node_id=existing_id)
                     else:
-                        del_element = self.find_deleted_element(c, self.last_seq_id, os.path.basename(src_path), md5=hash_key)
+                        del_element = self.find_deleted_element(c, self.last_seq_id, os.path.basename(src_path),
+                                                                 md5=hash_key, fingerprint=fingerprint)
 
                     if del_element:
                         logging.info("THIS IS CAN BE A MOVE OR WINDOWS UPDATE " + src_path)
@@ -708,45 +1290,47 @@ class SqlEventHandler(FileSystemEventHandler):
                             size,
                             hash_key,
                             mtime,
-                            pickle.dumps(stat)
-                        )
-                        c.execute("INSERT INTO ajxp_index (node_id,node_path,bytesize,md5,mtime,stat_result) "
-                                  "VALUES (?,?,?,?,?,?)", t)
+                            fingerprint
+                        ) + stat_columns(stat)
+                        c.execute("INSERT INTO ajxp_index (node_id,node_path,bytesize,md5,mtime,fingerprint,mode,ino,dev,"
+                                  "mtime_ns,ctime_ns) VALUES (?,?,?,?,?,?,?,?,?,?,?)", t)
                         c.execute("UPDATE ajxp_index SET node_path=? WHERE node_path=?", (search_key, del_element['source']))
 
                     else:
                         if hash_key == 'directory' and existing_id:
                             self.clear_windows_folder_id(src_path)
-                        c.execute("INSERT INTO ajxp_index (node_path,bytesize,md5,mtime,stat_result) VALUES (?,?,?,?,?)", t)
+                        c.execute("INSERT INTO ajxp_index (node_path,bytesize,md5,mtime,fingerprint,mode,ino,dev,mtime_ns,"
+                                  "ctime_ns) VALUES (?,?,?,?,?,?,?,?,?,?)", t)
                         if hash_key == 'directory':
                             self.set_windows_folder_id(c.lastrowid, src_path)
                 else:
-                    if skip_nomodif:
-                        t = (
-                            size,
-                            hash_key,
-                            mtime,
-                            pickle.dumps(stat),
-                            search_key,
-                            hash_key
-                        )
-                        logging.debug("Real update not the same (size %d)" % size)
-                        conn.execute("UPDATE ajxp_index SET bytesize=?, md5=?, mtime=?, stat_result=? WHERE node_path=? AND md5!=?", t)
-                    else:
-                        t = (
-                            size,
-                            hash_key,
-                            mtime,
-                            pickle.dumps(stat),
-                            search_key
-                        )
-                        logging.debug("Real update %s" % search_key)
-                        conn.execute("UPDATE ajxp_index SET bytesize=?, md5=?, mtime=?, stat_result=? WHERE node_path=?", t)
+                    t = (
+                        size,
+                        hash_key,
+                        mtime,
+                        fingerprint
+                    ) + stat_columns(stat) + (
+                        search_key,
+                    )
+                    sql = "UPDATE ajxp_index SET bytesize=?, md5=?, mtime=?, fingerprint=?, mode=?, ino=?, dev=?, " \
+                          "mtime_ns=?, ctime_ns=? WHERE node_path=?"
+                    if skip_nomodif and hash_key == "HASHME":
+                        # MD5 not known yet: only a new fingerprint or mtime mean that the content changed
+                        sql += " AND (fingerprint IS NOT ? OR mtime_ns IS NOT ?)"
+                        t += (fingerprint, stat_columns(stat)[3])
+                    elif skip_nomodif:
+                        sql += " AND md5!=?"
+                        t += (hash_key,)
+                    logging.debug("Real update %s (size %d)" % (search_key, size))
+                    conn.execute(sql, t)
                 if not self.prevent_atomic_commit:
                     conn.commit()
-                    conn.close()
+                    if hash_key == "HASHME":
+                        self.schedule_hashing()
                 break
             except sqlite3.OperationalError:
+                if not self.prevent_atomic_commit:
+                    conn.rollback()
                 time.sleep(.1)
             except IOError:
                 return
@@ -786,160 +1370,316 @@ class SqlEventHandler(FileSystemEventHandler):
             os.unlink(path + "\\.pydio_id")
 
     @pydio_profile
-    def find_deleted_element(self, cursor, start_seq, basename, md5=None, node_id=None):
+    def find_deleted_element(self, cursor, start_seq, basename, md5=None, node_id=None, fingerprint=None):
+        """
+        Look for a node deleted since start_seq that could be the source of a move
+        :param cursor: cursor of the current connection
+        :param start_seq: only consider deletions logged after this sequence
+        :param basename: name of the created node
+        :param md5: hash of the created file
+        :param node_id: id of the created folder, from its .pydio_id
+        :param fingerprint: fast fingerprint of the created file
+        :return: dict with the source and node_id of the deleted node, or None
+        """
+        if md5 == 'HASHME':
+            md5 = None
         try:
-            res = cursor.execute('SELECT * FROM ajxp_changes WHERE source LIKE ? AND type="delete" '
-                                 'AND node_id NOT IN (SELECT node_id FROM ajxp_index) '
-                                 'AND seq > ? ORDER BY seq DESC', ("%\\"+basename, start_seq))
-            if not res:
+            if node_id:
+                res = cursor.execute("SELECT node_id, source FROM ajxp_deleted WHERE node_id=? AND seq > ?",
+                                     (node_id, start_seq))
+            elif md5 or fingerprint:
+                res = cursor.execute("SELECT node_id, source FROM ajxp_deleted WHERE basename=? AND (fingerprint=? "
+                                     "OR md5=?) AND seq > ? ORDER BY seq DESC LIMIT 1",
+                                     (basename, fingerprint, md5, start_seq))
+            else:
                 return None
             for row in res:
-                try:
-                    if (md5 and row['deleted_md5'] == md5) or (node_id and row['node_id'] == node_id):
-                        return {'source': row['source'], 'node_id': row['node_id']}
-                except Exception as e:
-                    logging.exception(e)
-                    pass
+                return {'source': row['source'], 'node_id': row['node_id']}
             return None
         except sqlite3.OperationalError:
-            return self.find_deleted_element(cursor, start_seq, basename, md5, node_id)
+            return self.find_deleted_element(cursor, start_seq, basename, md5, node_id, fingerprint)
 
+    def index_is_empty(self):
+        return self.connections.get().execute("SELECT 1 FROM ajxp_index LIMIT 1").fetchone() is None
+
+    @pydio_profile
+    def bulk_index(self, nodes, interrupt=None):
+        """
+        Initial indexing of a new folder. The rows are inserted by batches with the per-row triggers suspended,
+        then the journal and the node statuses are written set-based. Files are fingerprinted in parallel by the
+        hashing pool, their MD5 is filled by the hashing pass when needed. Everything happens in one transaction:
+        an interrupted or failed load leaves the index as it was.
+        :param nodes: iterable of tuples (full path, True for a folder) of the new nodes, parents first. It is
+        consumed batch by batch, it can be the walk finding them.
+        :param interrupt: callable, the load is rolled back as soon as it returns True
+        :return: number of nodes indexed, or None if the load was interrupted
+        """
+        sql = "INSERT INTO ajxp_index (node_path,bytesize,md5,mtime,fingerprint,mode,ino,dev,mtime_ns,ctime_ns) " \
+              "VALUES (?,?,?,?,?,?,?,?,?,?)"
+        self.lock_db()
+        conn = self.connections.open()
+        # the sqlite3 module would commit before each DROP/CREATE TRIGGER, the transaction is handled here instead
+        conn.isolation_level = None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            first_id = conn.execute("SELECT COALESCE(MAX(node_id), 0) FROM ajxp_index").fetchone()[0]
+            triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger' AND name IN (%s)"
+                                    % ','.join('?' * len(BULK_SUSPENDED_TRIGGERS)), BULK_SUSPENDED_TRIGGERS).fetchall()
+            for trigger in triggers:
+                conn.execute('DROP TRIGGER "%s"' % trigger['name'])
+            dirs = []
+            tasks = []
+            for path, is_dir in nodes:
+                path = self.get_unicode_path(path)
+                if is_dir:
+                    if not self.included(DirCreatedEvent(path)):
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    dirs.append((self.remove_prefix(path), 0, 'directory', stat.st_mtime, None) + stat_columns(stat))
+                    if len(dirs) >= self.hash_batch_size:
+                        conn.executemany(sql, dirs)
+                        dirs = []
+                elif self.included(FileCreatedEvent(path)):
+                    tasks.append((self.base, self.remove_prefix(path), self.local_hash))
+                    if len(tasks) >= self.hash_batch_size:
+                        conn.executemany(sql, self.fingerprint_rows(tasks, interrupt))
+                        tasks = []
+            conn.executemany(sql, dirs)
+            conn.executemany(sql, self.fingerprint_rows(tasks, interrupt))
+            if interrupt and interrupt():
+                conn.execute("ROLLBACK")
+                return None
+            # what the suspended triggers would have written
+            conn.execute("INSERT INTO ajxp_changes (node_id,source,target,type) SELECT node_id, 'NULL', node_path, "
+                         "'create' FROM ajxp_index WHERE node_id > ? ORDER BY node_id", (first_id,))
+            conn.execute("INSERT INTO ajxp_node_status (node_id) SELECT node_id FROM ajxp_index WHERE node_id > ?",
+                         (first_id,))
+            conn.execute("DELETE FROM ajxp_deleted WHERE node_id > ?", (first_id,))
+            for trigger in triggers:
+                conn.execute(trigger['sql'])
+            rebuild_dir_status(conn)
+            count = conn.execute("SELECT count(*) FROM ajxp_index WHERE node_id > ?", (first_id,)).fetchone()[0]
+            conn.execute("COMMIT")
+            if os.name in ("nt", "ce"):
+                for row in conn.execute("SELECT node_id, node_path FROM ajxp_index WHERE node_id > ? "
+                                        "AND md5='directory'", (first_id,)).fetchall():
+                    self.set_windows_folder_id(row['node_id'], self.base + row['node_path'])
+            logging.info("Indexed %i nodes in bulk" % count)
+            return count
+        except Exception:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass  # no transaction left to roll back
+            raise
+        finally:
+            conn.close()
+            self.unlock_db()
+            self.schedule_hashing()
+
+    def fingerprint_rows(self, tasks, interrupt=None):
+        """
+        :param tasks: list of the fingerprint_row arguments of a batch of files
+        :param interrupt: callable, the batch is abandoned as soon as it returns True
+        :return: list of the ajxp_index rows of the files that could be read
+        """
+        rows = []
+        for row in self.hash_pool.imap_unordered(tasks, func=fingerprint_row) if tasks else []:
+            if interrupt and interrupt():
+                break
+            if row:
+                rows.append(row)
+        return rows
 
     @pydio_profile
     def begin_transaction(self):
-        self.transaction_conn = sqlite3.connect(self.db, timeout=self.timeout)
-        self.transaction_conn.row_factory = sqlite3.Row
+        self.lock_db()
+        self.transaction_conn = self.connections.open()
         self.prevent_atomic_commit = True
 
     @pydio_profile
     def end_transaction(self):
-        """ The db is unicode_escape encoded, other functions seem to expect unicode
-        """
-        class hasher(threading.Thread):
-            """ This is a thread, used to md5 hash files
-            """
-            def __init__(self):
-                threading.Thread.__init__(self)
-                self.brow = ""
-                self.res = {}
-
-            def hashrow(self):
-                """
-                :return: a dict containing SQL code and values to be executed later
-                """
-                base = self.brow[0]
-                row = self.brow[1]
-                #logging.info(brow)
-                path = row[1] #unicodedata.normalize('NFC', r[1])
-                if os.path.exists(base + path):
-                    with open(base + path, 'rb') as fd:
-                        t = (
-                            os.path.getsize(base + path),
-                            hashfile(fd, hashlib.md5()),
-                            os.path.getmtime(base + path),
-                            pickle.dumps(os.stat(base + path)),
-                            row[1]
-                             )
-                    return {"sql": "UPDATE ajxp_index SET bytesize=?, md5=?, mtime=?, stat_result=? WHERE node_path=? AND md5='HASHME'", "values": t}
-                else:
-                    # delete the index of non existing files
-                    return {"sql": "DELETE FROM ajxp_index WHERE node_path=? AND md5='HASHME'", "values": base+path}
-
-            def do(self):
-                self.res = self.hashrow()
+        """ Commit the transaction. Files flagged HASHME during the transaction are left to the hashing pass.
+        """
+        try:
+            self.transaction_conn.commit()
+            # deletions already consumed by the merger cannot be the source of a move anymore
+            self.transaction_conn.execute("DELETE FROM ajxp_deleted WHERE seq <= ?", (self.last_seq_id,))
+            self.transaction_conn.commit()
+        finally:
+            self.prevent_atomic_commit = False
+            self.transaction_conn.close()
+            self.unlock_db()
+        self.schedule_hashing()
+
+    def schedule_hashing(self):
+        """
+        Wake up the background hashing pass, starting its thread on first call
+        """
+        self.hashing_needed.set()
+        with self.hashing_lock:
+            if self.hashing_thread is None:
+                self.hashing_thread = threading.Thread(target=self.run_hashing, name='HashingPass')
+                self.hashing_thread.daemon = True
+                self.hashing_thread.start()
+
+    def close(self):
+        """
+        Stop the background hashing pass and the workers of the hashing pool, once the job is stopped
+        """
+        self.closed = True
+        self.hashing_needed.set()
+        with self.hashing_lock:
+            thread = self.hashing_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.hash_pool.close()
+
+    def run_hashing(self):
+        while not self.closed:
+            self.hashing_needed.wait()
+            self.hashing_needed.clear()
+            if self.closed:
+                return
+            try:
+                self.hash_pending()
+            except Exception as e:
+                logging.exception(e)
 
-            def run(self):
-                pass
-        self.transaction_conn.commit()
-        if self.prevent_atomic_commit:
-            cur = self.transaction_conn.cursor()
-        else:  # This is propably useless
-            cur = sqlite3.connect(self.db, timeout=self.timeout).cursor()
-            cur.row_factory = sqlite3.Row
-        def hashfetcher(cur):
-            """ Yields brows (basepath + sql row) of changes to be processed
-            :param cur: sqlite cursor
-            :yield: brow
-            """
-            while True:
+    @pydio_profile
+    def hash_pending(self, since_seq=None):
+        """ Fill the MD5 of the files indexed with their fingerprint only (md5 is HASHME). Hashes already known by
+        the hash cache are used as is, the other files are read in parallel by the hashing pool, without holding
+        the write lock. Results are written back batch by batch, without journaling: the create or content change of
+        these files was logged when they were indexed.
+        Runs in the background; the merger only asks for the files it is about to read the changes of.
+        :param since_seq: optional local sequence, only the files changed after it are hashed
+        :return: number of files read
+        """
+        query = "SELECT node_id, node_path, mode, ino, dev, bytesize, mtime_ns, ctime_ns FROM ajxp_index " \
+                "WHERE md5='HASHME' AND node_id>?"
+        changed = ()
+        if since_seq is not None:
+            query += " AND node_id IN (SELECT node_id FROM ajxp_changes WHERE seq > ?)"
+            changed = (since_seq,)
+        query += " ORDER BY node_id LIMIT ?"
+        conn = self.connections.get()
+        last_id = 0
+        hashedfiles = 0
+        while not self.closed:
+            # taken per batch, so that the merger does not wait for a whole background pass
+            with self.hashing_pass_lock:
                 try:
-                    cur.execute("SELECT * FROM ajxp_index WHERE md5=?", ("HASHME",))
-                    rows = cur.fetchmany(100)
-                    if not rows:
-                        break
-                    for row in rows:
-                        yield (self.base, row)
+                    rows = conn.execute(query, (last_id,) + changed + (self.hash_batch_size,)).fetchall()
                 except sqlite3.OperationalError as oe:
                     logging.exception(oe)  # catch DB locked errors
-                    pass
-        #logging.info(" HASHING BEGINS (" + str(cur.execute("SELECT COUNT(*) FROM ajxp_index WHERE md5=?", ("HASHME",)).fetchone()[0]) + ")")
-        #ts = time.time()
-        pool = [hasher() for t in range(4)] # TODO Tune me depending on the number of changes to be processed, and HW
-        for p in pool:
-            p.start()
-        shouldexit = False
-        brows = hashfetcher(cur)
-        hashedfiles = 0
-        while True:
-            """ A pool of threads is used and managed here, for every cycle we go through the pool to collect
-                possible results and load more items in the pool to be hashed, termination is handled by the
-                shouldexit flag. We make sure all the results are collected by waiting for the threads to join.
-            """
-            for t in pool:
-                if not t.isAlive():
-                    if t.res != {}:
-                        """try:  # for debugging
-                            import resource, humanize
-                            logging.info(' Memory usage: %s' % humanize.naturalsize(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
-                        except ImportError:
-                            pass
-                        """
-                        cur.execute(t.res["sql"], t.res["values"])
-                        t.res = {}
-                        hashedfiles += 1
-                        if hashedfiles > 1000:
-                            hashedfiles = 0
-                            try:
-                                self.transaction_conn.commit()
-                            except Exception as e:
-                                logging.exception(e)
-                    if not shouldexit:
-                        try:
-                            t.brow = next(brows)
-                            t.do()
-                        except StopIteration:
-                            shouldexit = True
-            if shouldexit:
-                for t in pool:
-                    t.join()
-                    if t.res != {}:
-                        cur.execute(t.res["sql"], t.res["values"])
-                break
-        #logging.info(" Threaded HASHING DONE " + str(time.time() - ts))
-        self.transaction_conn.commit()
-        self.prevent_atomic_commit = False
-        self.transaction_conn.close()
+                    time.sleep(.1)
+                    continue
+                if not rows:
+                    break
+                last_id = rows[-1]['node_id']
+                known = []
+                tasks = []
+                for row in rows:
+                    md5 = None
+                    stat_result = IndexStat.from_row(row)
+                    if stat_result:
+                        md5 = self.hash_cache.get(stat_result, conn=conn)
+                    if md5:
+                        known.append((md5, row['node_id']))
+                    else:
+                        tasks.append((self.base, row['node_path']))
+                results = [res for res in self.hash_pool.imap_unordered(tasks) if res] if tasks else []
+                self.lock_db()
+                try:
+                    conn.execute("INSERT OR IGNORE INTO ajxp_trigger_guard (scope) VALUES ('journal')")
+                    try:
+                        conn.executemany("UPDATE ajxp_index SET md5=? WHERE node_id=? AND md5='HASHME'", known)
+                        for res in results:
+                            conn.execute(res["sql"], res["values"])
+                            if "stat" in res:
+                                self.hash_cache.put(res["stat"], res["values"][1], conn=conn)
+                    finally:
+                        conn.execute("DELETE FROM ajxp_trigger_guard WHERE scope='journal'")
+                    conn.commit()
+                    hashedfiles += len(results)
+                except sqlite3.OperationalError as oe:
+                    # these files stay HASHME, the next pass will pick them
+                    logging.exception(oe)
+                    conn.rollback()
+                finally:
+                    self.unlock_db()
+        if hashedfiles:
+            logging.debug("Hashed %i files with a pool of %i workers" % (hashedfiles, self.hash_pool.size))
+        return hashedfiles
 
     @pydio_profile
     def lock_db(self):
-        self.locked = True
-        ###################################################################
-        while self.reading:
-            time.sleep(self.db_wait_duration)
-        self.last_write_time = int(round(time.time() * 1000))
-        ###################################################################
+        """
+        Start a write, once the changes being read or waited for by the merger (if any) are consumed. Reentrant.
+        """
+        self.write_lock.acquire()
+        with self.db_state:
+            if not self.write_depth:
+                while self.readers or self.waiting_readers:
+                    self.db_state.wait()
+            self.write_depth += 1
+            self.locked = True
+            self.last_write_time = int(round(time.time() * 1000))
 
     @pydio_profile
     def unlock_db(self):
-        self.locked = False
-        self.last_write_time = int(round(time.time() * 1000))
+        with self.db_state:
+            self.write_depth -= 1
+            self.locked = self.write_depth > 0
+            self.last_write_time = int(round(time.time() * 1000))
+            self.db_state.notify_all()
+        self.write_lock.release()
+
+    def begin_read(self):
+        """
+        Wait for the write in progress to end, then keep the writers out until end_read() is called. New writes are
+        held as soon as a reader waits, so that a steady trickle of local events cannot starve the merger.
+        """
+        with self.db_state:
+            self.waiting_readers += 1
+            try:
+                while self.write_depth:
+                    self.db_state.wait()
+            finally:
+                self.waiting_readers -= 1
+            self.readers += 1
+            self.reading = True
+
+    def end_read(self):
+        with self.db_state:
+            self.readers -= 1
+            self.reading = self.readers > 0
+            self.db_state.notify_all()
+
+    def wait_for_writes(self, timeout=None):
+        """
+        :param timeout: maximum time to wait, in seconds
+        :return: True if no write is in progress anymore
+        """
+        with self.db_state:
+            if self.write_depth and timeout is not None:
+                end = time.time() + timeout
+                while self.write_depth and time.time() < end:
+                    self.db_state.wait(end - time.time())
+            elif self.write_depth:
+                while self.write_depth:
+                    self.db_state.wait()
+            return not self.write_depth
 
     def db_stats(self):
         """
         :return: some stats about the database
         """
-        c = sqlite3.connect(self.db, timeout=self.timeout)
-        c.row_factory = sqlite3.Row
+        c = self.connections.get()
         logging.info(self.db)
         while True:
             try:
@@ -950,6 +1690,5 @@ class SqlEventHandler(FileSystemEventHandler):
             except sqlite3.OperationalError as oe:
                 logging.exception(oe)  # catch DB locked errors
                 pass
-        c.close()
         #logging.info(str(files) + " " + str(dirs))
         return {"nbfiles": files, "nbdirs": dirs}
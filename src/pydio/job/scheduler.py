@@ -26,9 +26,11 @@ try:
     from pydio.utils.pydio_profiler import pydio_profile
     from pydio.utils.functions import Singleton, guess_filesystemencoding
     from pydio.job import manager
+    from pydio.job.db_connections import SqliteConnections
 except ImportError:
     from job.continous_merger import ContinuousDiffMerger
     from job import manager
+    from job.db_connections import SqliteConnections
     from utils.functions import Singleton, guess_filesystemencoding
     from utils.pydio_profiler import pydio_profile
     COMMAND_SIGNAL = 'command'
@@ -139,8 +141,9 @@ class PydioScheduler():
             logging.info("R E S Y N C " + job_id)
             # delete databases
             job_folder = os.path.join(str(self.jobs_root_path), job_id)
+            SqliteConnections.close_db(os.path.join(job_folder, "pydio.sqlite"))
             for file in os.listdir(job_folder):
-                if file in ["pydio.sqlite", "changes.sqlite", "sequences"]:
+                if file in ["pydio.sqlite", "pydio.sqlite-wal", "pydio.sqlite-shm", "changes.sqlite", "sequences"]:
                     try:
                         os.unlink(os.path.join(job_folder, file))
                     except Exception as e:
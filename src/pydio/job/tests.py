@@ -0,0 +1,951 @@
+import hashlib
+import os
+import pickle
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from pydio.job.hash_pool import HashPool, hash_row, fingerprint_file, FULL_HASH_LIMIT
+from pydio.job.localdb import LocalDbHandler, SqlEventHandler, ClosingCursor, HashCache, DB_UPGRADES, IndexStat, \
+    migrate_pickled_stats, sql_basename, rebuild_dir_status, indexed_children
+from pydio.job.db_connections import SqliteConnections
+from pydio.utils.functions import hash_providers, get_hasher, hashfile, stat_columns
+from pydio.utils.global_config import GlobalConfigManager
+from pydio.job.local_watcher import EventCoalescer, SettleQueue, IndexDiff, SnapshotDiffStart, LocalWatcher
+from pydio.job.index_snapshot import IndexSnapshot, write_index_snapshot
+from pydio.job.inotify_observer import InotifyObserver, IN_Q_OVERFLOW
+from watchdog.utils.dirsnapshot import DirectorySnapshot
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent, DirMovedEvent
+
+
+class HashPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_hash_row(self):
+        with open(os.path.join(self.base, 'file.txt'), 'wb') as f:
+            f.write(b'test data')
+        res = hash_row((self.base, '/file.txt'))
+        assert res['sql'].startswith('UPDATE ajxp_index')
+        assert res['values'][0] == 9
+        assert res['values'][1] == hashlib.md5(b'test data').hexdigest()
+        assert res['values'][-1] == '/file.txt'
+
+    def test_close_stops_the_workers(self):
+        pool = HashPool(2, use_processes=True)
+        with open(os.path.join(self.base, 'file.txt'), 'wb') as f:
+            f.write(b'test data')
+        assert len(list(pool.imap_unordered([(self.base, '/file.txt')] * 4))) == 4
+        workers = list(pool.pool._pool)
+        pool.close()
+        assert pool.pool is None
+        assert not [worker for worker in workers if worker.is_alive()]
+
+    def test_shared_by_threads(self):
+        pool = HashPool(2)
+        pools = []
+        threads = [threading.Thread(target=lambda: pools.append(pool.open())) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(id(p) for p in pools)) == 1
+        tasks = []
+        for i in range(50):
+            with open(os.path.join(self.base, 'f%i' % i), 'wb') as f:
+                f.write(b'x' * i)
+            tasks.append((self.base, '/f%i' % i))
+        results = pool.imap_unordered(tasks)
+        # the job stops while the results are read
+        pool.close()
+        assert len(list(results)) == 50
+
+    def test_hash_row_missing_file(self):
+        res = hash_row((self.base, '/missing.txt'))
+        assert res['sql'].startswith('DELETE FROM ajxp_index')
+        assert res['values'] == ('/missing.txt',)
+
+    def test_pool_hashes_every_file(self):
+        tasks = []
+        for i in range(20):
+            with open(os.path.join(self.base, 'f%i' % i), 'wb') as f:
+                f.write(b'x' * i)
+            tasks.append((self.base, '/f%i' % i))
+        pool = HashPool(3)
+        try:
+            results = list(pool.imap_unordered(tasks))
+        finally:
+            pool.close()
+        assert len(results) == 20
+        assert sorted(r['values'][0] for r in results) == list(range(20))
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'file.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_small_file_fingerprint_is_md5(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'test data')
+        fingerprint, md5, stat_result = fingerprint_file(self.path)
+        assert md5 == fingerprint == hashlib.md5(b'test data').hexdigest()
+        assert stat_result.st_size == 9
+
+    def test_big_file_is_sampled(self):
+        data = bytearray(b'x' * (FULL_HASH_LIMIT * 3))
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        fingerprint, md5, stat_result = fingerprint_file(self.path)
+        assert md5 is None
+        assert fingerprint.startswith('fp:')
+        data[-1] = b'y'
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        assert fingerprint_file(self.path)[0] != fingerprint
+
+    def test_hashfile_block_sizes(self):
+        data = os.urandom(FULL_HASH_LIMIT + 7)
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        expected = hashlib.md5(data).hexdigest()
+        for blocksize in (4096, None):
+            with open(self.path, 'rb') as fd:
+                assert hashfile(fd, hashlib.md5(), blocksize) == expected
+        open(self.path, 'wb').close()
+        with open(self.path, 'rb') as fd:
+            assert hashfile(fd, hashlib.md5()) == hashlib.md5().hexdigest()
+
+    def test_local_hash_algorithms(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'test data')
+        assert get_hasher('unknown').hexdigest() == hashlib.md5().hexdigest()
+        for algorithm in hash_providers():
+            if algorithm == 'md5':
+                continue
+            fingerprint, md5, stat_result = fingerprint_file(self.path, algorithm)
+            assert md5 is None
+            assert fingerprint.startswith(algorithm + ':')
+
+
+class HashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.db = os.path.join(self.base, 'pydio.sqlite')
+        conn = sqlite3.connect(self.db)
+        # the hash cache table only
+        for sql in dict(DB_UPGRADES)[1]:
+            conn.execute(sql)
+        conn.commit()
+        conn.close()
+        self.path = os.path.join(self.base, 'file.txt')
+        with open(self.path, 'wb') as f:
+            f.write(b'test data')
+        # old enough to be cached
+        os.utime(self.path, (time.time() - 60, time.time() - 60))
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_unchanged_file_is_not_read_again(self):
+        cache = HashCache(self.db)
+        md5 = hashlib.md5(b'test data').hexdigest()
+        assert cache.hash(self.path) == md5
+        assert cache.get(os.stat(self.path)) == md5
+
+    def test_modified_file_is_hashed_again(self):
+        cache = HashCache(self.db)
+        cache.hash(self.path)
+        with open(self.path, 'wb') as f:
+            f.write(b'other data')
+        assert cache.get(os.stat(self.path)) is None
+        assert cache.hash(self.path) == hashlib.md5(b'other data').hexdigest()
+
+    def test_recent_file_is_not_cached(self):
+        cache = HashCache(self.db)
+        os.utime(self.path, None)
+        cache.hash(self.path)
+        assert cache.get(os.stat(self.path)) is None
+
+
+class StatColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_migrate_pickled_stats(self):
+        conn = sqlite3.connect(os.path.join(self.base, 'pydio.sqlite'))
+        conn.row_factory = sqlite3.Row
+        conn.execute("CREATE TABLE ajxp_index ( node_id INTEGER PRIMARY KEY AUTOINCREMENT, node_path TEXT, "
+                     "bytesize NUMERIC, md5 TEXT, mtime NUMERIC, stat_result BLOB)")
+        stat_result = os.stat(self.base)
+        conn.execute("INSERT INTO ajxp_index (node_path, bytesize, md5, mtime, stat_result) VALUES (?,?,?,?,?)",
+                     ('/', stat_result.st_size, 'directory', stat_result.st_mtime, pickle.dumps(stat_result)))
+        conn.commit()
+        migrate_pickled_stats(conn)
+        row = conn.execute("SELECT * FROM ajxp_index").fetchone()
+        assert 'stat_result' not in row.keys() or row['stat_result'] is None
+        stat = IndexStat.from_row(row)
+        assert stat.st_ino == stat_result.st_ino
+        assert stat.st_mode == stat_result.st_mode
+        assert int(stat.st_mtime) == int(stat_result.st_mtime)
+        conn.close()
+
+    def test_fingerprint_upgrade_runs_twice(self):
+        conn = sqlite3.connect(os.path.join(self.base, 'pydio.sqlite'))
+        conn.execute("CREATE TABLE ajxp_index ( node_id INTEGER PRIMARY KEY AUTOINCREMENT, node_path TEXT, "
+                     "bytesize NUMERIC, md5 TEXT, mtime NUMERIC)")
+        conn.execute("CREATE TABLE ajxp_changes ( seq INTEGER PRIMARY KEY AUTOINCREMENT, node_id NUMERIC, "
+                     "type TEXT, source TEXT, target TEXT, deleted_md5 TEXT )")
+        for sql in dict(DB_UPGRADES)[3] + dict(DB_UPGRADES)[4]:
+            conn.execute(sql)
+        conn.execute("INSERT INTO ajxp_index (node_path, bytesize, md5) VALUES ('/a.txt', 4, 'abc')")
+        # interrupted before the user_version was written: the whole step runs again
+        for attempt in range(2):
+            for statement in dict(DB_UPGRADES)[6]:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+        conn.commit()
+        assert conn.execute("SELECT fingerprint FROM ajxp_index").fetchone()[0] == 'abc'
+        assert 'fingerprint' in [row[1] for row in conn.execute("PRAGMA table_info(ajxp_deleted)")]
+        conn.close()
+
+    def test_sql_basename(self):
+        conn = sqlite3.connect(':memory:')
+        for path, expected in ((u'/a/b/file.txt', u'file.txt'), (u'\\a\\b.txt', u'b.txt'), (u'/aba/ab', u'ab'),
+                               (u'/', u'')):
+            assert conn.execute("SELECT " + sql_basename('?'), (path, path, path)).fetchone()[0] == expected
+        conn.close()
+
+
+class DirStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        create = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'res', 'create.sql')
+        with open(create) as inserts:
+            for statement in inserts:
+                self.conn.execute(statement)
+        for path in ('/a', '/a/b', '/a/b/c', '/d'):
+            self.conn.execute("INSERT INTO ajxp_index (node_path, md5) VALUES (?, 'x')", (path,))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def dir_status(self):
+        return sorted(self.conn.execute("SELECT * FROM ajxp_dir_status").fetchall())
+
+    def assert_consistent(self):
+        current = self.dir_status()
+        rebuild_dir_status(self.conn)
+        assert current == self.dir_status()
+        return current
+
+    def test_counts_follow_status_changes(self):
+        assert self.assert_consistent() == [(u'', 2, 0), (u'/a', 1, 0), (u'/a/b', 1, 0)]
+        self.conn.execute("UPDATE ajxp_node_status SET status='IDLE'")
+        assert self.assert_consistent() == []
+        self.conn.execute("UPDATE ajxp_node_status SET status='CONFLICT' WHERE node_id IN "
+                          "(SELECT node_id FROM ajxp_index WHERE node_path='/a/b/c')")
+        assert self.assert_consistent() == [(u'/a/b', 0, 1)]
+
+    def test_counts_follow_moves_and_deletes(self):
+        self.conn.execute("UPDATE ajxp_index SET node_path='/d/c' WHERE node_path='/a/b/c'")
+        assert self.assert_consistent() == [(u'', 2, 0), (u'/a', 1, 0), (u'/d', 1, 0)]
+        self.conn.execute("DELETE FROM ajxp_index WHERE node_path='/d/c'")
+        assert self.assert_consistent() == [(u'', 2, 0), (u'/a', 1, 0)]
+
+    def test_indexed_children(self):
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("INSERT INTO ajxp_index (node_path, md5) VALUES ('/a/b0', 'x')")
+        assert [row['node_path'] for row in indexed_children(self.conn, '')] == ['/a', '/d']
+        assert [row['node_path'] for row in indexed_children(self.conn, '/a')] == ['/a/b', '/a/b0']
+        assert list(indexed_children(self.conn, '/d')) == []
+
+
+class StatusRecorder(LocalDbHandler):
+
+    def __init__(self):
+        self.status_buffer = threading.local()
+        self.written = []
+
+    def update_bulk_node_status(self, entries):
+        self.written.append(entries)
+
+
+class NodeStatusBufferTest(unittest.TestCase):
+
+    def test_transfer_statuses_are_written_at_once(self):
+        handler = StatusRecorder()
+        written = handler.written
+        handler.buffer_node_status(size=10, delay=60)
+        handler.update_node_status('/a', 'IDLE')
+        assert written == []
+        handler.update_node_status('/b', 'UP')
+        assert written == [[('/a', 'IDLE', ''), ('/b', 'UP', '')]]
+        handler.update_node_status('/b', 'IDLE')
+        handler.flush_node_status(stop=True)
+        assert written[-1] == [('/b', 'IDLE', '')]
+
+
+class IndexTestCase(unittest.TestCase):
+    """
+    A local folder and the data folder of its job, with a SqlEventHandler indexing the first into the second
+    """
+
+    def setUp(self):
+        self.base = unicode(tempfile.mkdtemp())
+        self.data = tempfile.mkdtemp()
+        config = GlobalConfigManager.Instance(configs_path=self.data)
+        config.configs_path = self.data
+        config.set_general_config(config.default_settings)
+        self.handler = SqlEventHandler(self.base, ['*'], [], self.data)
+        self.conn = sqlite3.connect(self.handler.db)
+
+    def tearDown(self):
+        self.conn.close()
+        self.handler.close()
+        SqliteConnections.close_db(self.handler.db)
+        shutil.rmtree(self.base)
+        shutil.rmtree(self.data)
+
+    def path(self, *names):
+        return os.path.join(self.base, *names)
+
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+
+
+class LocalDbHandlerTest(IndexTestCase):
+
+    def test_compact_changes(self):
+        self.conn.executemany("INSERT INTO ajxp_changes (node_id, type, source, target) VALUES (?, 'create', 'NULL', ?)",
+                              [(i, '/f%i' % i) for i in range(30)])
+        self.conn.commit()
+        db_handler = LocalDbHandler(self.data, self.base)
+        max_seq = db_handler.get_max_seq()
+        checkpoint = max_seq - 10
+        assert db_handler.compact_changes(checkpoint, batch_size=7)['rows'] == 20
+        assert [row[0] for row in self.conn.execute("SELECT seq FROM ajxp_changes ORDER BY seq")] == \
+            range(checkpoint + 1, max_seq + 1)
+        assert db_handler.get_max_seq() == max_seq
+        assert db_handler.compact_changes(max_seq)['rows'] == 10
+        assert db_handler.get_max_seq() == max_seq
+
+    def test_upgrade_enables_incremental_vacuum(self):
+        def pragma(name):
+            conn = sqlite3.connect(self.handler.db)
+            try:
+                return conn.execute("PRAGMA %s" % name).fetchall()[0][0]
+            finally:
+                conn.close()
+
+        assert pragma('auto_vacuum') == 2
+        # a database created before auto_vacuum was set
+        self.conn.execute("PRAGMA auto_vacuum = NONE")
+        self.conn.execute("VACUUM")
+        self.conn.execute("PRAGMA user_version = 6")
+        assert pragma('auto_vacuum') == 0
+        LocalDbHandler.upgraded_dbs.discard(self.handler.db)
+        LocalDbHandler(self.data, self.base)
+        assert pragma('auto_vacuum') == 2
+        assert pragma('user_version') == DB_UPGRADES[-1][0]
+
+
+class SqlEventHandlerTest(IndexTestCase):
+
+    def test_reconcile_directory(self):
+        for i in range(5):
+            self.write('f%i' % i, b'data %i' % i)
+        assert self.handler.reconcile_directory(self.base) == 5
+        assert self.handler.reconcile_directory(self.base) == 0
+        self.write('new', b'new')
+        self.write('f0', b'modified')
+        os.remove(self.path('f1'))
+        assert self.handler.reconcile_directory(self.base) == 3
+        assert sorted(row[0] for row in self.conn.execute("SELECT node_path FROM ajxp_index")) == \
+            ['/f0', '/f2', '/f3', '/f4', '/new']
+        assert self.handler.reconcile_directory(self.base) == 0
+
+    def triggers(self):
+        return sorted(row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type='trigger'"))
+
+    def test_bulk_index(self):
+        os.makedirs(self.path('d', 'sub'))
+        for name in ('f', os.path.join('d', 'g'), os.path.join('d', 'sub', 'h')):
+            self.write(name, b'data')
+        nodes = [(self.path('d'), True), (self.path('d', 'sub'), True), (self.path('f'), False),
+                 (self.path('d', 'g'), False), (self.path('d', 'sub', 'h'), False)]
+        triggers = self.triggers()
+
+        def failing_walk():
+            for node in nodes:
+                yield node
+            raise OSError('walk failed')
+
+        self.assertRaises(OSError, self.handler.bulk_index, failing_walk())
+        assert self.handler.bulk_index(iter(nodes), interrupt=lambda: True) is None
+        assert self.triggers() == triggers
+        assert self.conn.execute("SELECT count(*) FROM ajxp_index").fetchone()[0] == 0
+
+        assert self.handler.bulk_index(iter(nodes)) == 5
+        assert self.triggers() == triggers
+        assert sorted(self.conn.execute("SELECT node_id, type FROM ajxp_changes")) == \
+            sorted((row[0], u'create') for row in self.conn.execute("SELECT node_id FROM ajxp_index"))
+        dir_status = sorted(self.conn.execute("SELECT * FROM ajxp_dir_status"))
+        assert dir_status == [(u'', 2, 0), (u'/d', 2, 0), (u'/d/sub', 1, 0)]
+        rebuild_dir_status(self.conn)
+        assert sorted(self.conn.execute("SELECT * FROM ajxp_dir_status")) == dir_status
+        self.conn.rollback()
+
+    def test_move_subtree(self):
+        # /ab shares the prefix of /a, but is not below it
+        dirs = ['a', os.path.join('a', 'sub'), 'ab']
+        files = [os.path.join('a', 'f'), os.path.join('a', 'sub', 'g'), os.path.join('ab', 'h')]
+        for name in dirs:
+            os.mkdir(self.path(name))
+        for name in files:
+            self.write(name, b'data')
+        self.handler.bulk_index([(self.path(name), True) for name in dirs] + [(self.path(name), False) for name in files])
+        seq = self.conn.execute("SELECT MAX(seq) FROM ajxp_changes").fetchone()[0]
+        os.rename(self.path('a'), self.path('c'))
+        self.handler.on_moved(DirMovedEvent(self.path('a'), self.path('c')))
+        # the moves of the children that follow are already done
+        self.handler.on_moved(FileMovedEvent(self.path('a', 'f'), self.path('c', 'f')))
+        self.handler.on_moved(FileMovedEvent(self.path('a', 'sub', 'g'), self.path('c', 'sub', 'g')))
+        assert sorted(row[0] for row in self.conn.execute("SELECT node_path FROM ajxp_index")) == \
+            ['/ab', '/ab/h', '/c', '/c/f', '/c/sub', '/c/sub/g']
+        assert self.conn.execute("SELECT type, source, target FROM ajxp_changes WHERE seq > ?", (seq,)).fetchall() == \
+            [(u'path', u'/a', u'/c')]
+
+
+class LocalWatcherTest(IndexTestCase):
+
+    def setUp(self):
+        super(LocalWatcherTest, self).setUp()
+        for name in ('a', 'b'):
+            os.mkdir(self.path(name))
+            for i in range(3):
+                self.write(os.path.join(name, 'f%i' % i), b'data')
+                os.utime(self.path(name, 'f%i' % i), (time.time() - 60, time.time() - 60))
+        # older than the margin of a clean stop
+        for name in ('a', 'b', ''):
+            os.utime(self.path(name), (time.time() - 60, time.time() - 60))
+        self.watcher = LocalWatcher(self.base, self.data, self.handler)
+        self.watcher.check_from_snapshot()
+        assert self.watcher.get_metrics()['full_scan']
+
+    def scan(self):
+        self.watcher = LocalWatcher(self.base, self.data, self.handler)
+        self.watcher.check_from_snapshot()
+        return self.watcher.get_metrics()
+
+    def test_start_after_clean_stop_skips_directories(self):
+        self.watcher.save_scan_state(clean_shutdown=time.time())
+        metrics = self.scan()
+        assert not metrics['full_scan']
+        # a and b, the root is always listed
+        assert metrics['skipped_directories'] == 2
+
+    def test_start_after_crash_stats_every_file(self):
+        # edited in place while its event was still queued: the mtime of the directory does not change
+        self.write(os.path.join('a', 'f0'), b'edited')
+        os.utime(self.path('a'), (time.time() - 60, time.time() - 60))
+        metrics = self.scan()
+        assert metrics['full_scan']
+        assert metrics['skipped_directories'] == 0
+        assert self.conn.execute("SELECT bytesize FROM ajxp_index WHERE node_path='/a/f0'").fetchone()[0] == 6
+
+
+    def test_rescan_skipping_unchanged_directories(self):
+        # asked by the observer after an overflow: b changed, its new file is found
+        self.write(os.path.join('b', 'new'), b'new')
+        self.watcher.check_from_snapshot(u'/', skip_unchanged=True)
+        assert self.conn.execute("SELECT count(*) FROM ajxp_index WHERE node_path='/b/new'").fetchone()[0] == 1
+
+
+class SqliteConnectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.db = os.path.join(self.base, 'pydio.sqlite')
+
+    def tearDown(self):
+        SqliteConnections.close_db(self.db)
+        shutil.rmtree(self.base)
+
+    def test_one_connection_per_thread(self):
+        connections = SqliteConnections.for_db(self.db)
+        assert SqliteConnections.for_db(self.db) is connections
+        conn = connections.get()
+        assert connections.get() is conn
+        other = []
+        t = threading.Thread(target=lambda: other.append(connections.get()))
+        t.start()
+        t.join()
+        assert other[0] is not conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+    def test_close_all_reopens(self):
+        connections = SqliteConnections.for_db(self.db)
+        conn = connections.get()
+        connections.close_all()
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, "SELECT 1")
+        assert connections.get().execute("SELECT 1").fetchone()[0] == 1
+
+    def test_close_all_leaves_other_threads_connections(self):
+        connections = SqliteConnections.for_db(self.db)
+        closed = threading.Event()
+        results = []
+
+        def use():
+            conn = connections.get()
+            closed.wait()
+            # still usable by its thread, until it asks for a connection again
+            results.append(conn.execute("SELECT 1").fetchone()[0])
+            results.append(connections.get() is not conn)
+            self.assertRaises(sqlite3.ProgrammingError, conn.execute, "SELECT 1")
+            results.append(True)
+        t = threading.Thread(target=use)
+        t.start()
+        while not connections.owners:
+            time.sleep(0.01)
+        connections.close_all()
+        closed.set()
+        t.join()
+        assert results == [1, True, True]
+
+
+    def test_closing_cursor_writes_leave_pending_changes(self):
+        connections = SqliteConnections.for_db(self.db, timeout=0.1)
+        conn = connections.get()
+        for sql in dict(DB_UPGRADES)[1]:
+            conn.execute(sql)
+        with ClosingCursor(self.db, write=True, withCommit=True) as c:
+            assert c is not conn
+            c.execute("INSERT INTO ajxp_hash_cache (dev, ino, md5) VALUES (1, 1, 'committed')")
+        conn.execute("INSERT INTO ajxp_hash_cache (dev, ino, md5) VALUES (1, 2, 'pending')")
+        # cannot write while the thread has changes pending, and does not commit them
+        old = time.time() - 60
+        HashCache(self.db).put(os.stat_result((0o100644, 3, 1, 1, 0, 0, 4, old, old, old)), 'other')
+        conn.rollback()
+        assert [row[0] for row in conn.execute("SELECT md5 FROM ajxp_hash_cache")] == ['committed']
+
+
+class RecordingHandler(object):
+
+    def __init__(self):
+        self.events = []
+        self.transactions = 0
+
+    def begin_transaction(self):
+        self.transactions += 1
+
+    def end_transaction(self):
+        pass
+
+    def dispatch(self, event):
+        self.events.append((event.event_type, event.src_path))
+
+
+class EventCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.coalescer = EventCoalescer(self.handler, window=0)
+
+    def flush(self):
+        self.coalescer.start()
+        self.coalescer.stop()
+        return self.handler.events
+
+    def test_create_modify_gives_create(self):
+        self.coalescer.dispatch(FileCreatedEvent('/a'))
+        self.coalescer.dispatch(FileModifiedEvent('/a'))
+        self.coalescer.dispatch(FileModifiedEvent('/a'))
+        assert self.flush() == [('created', '/a')]
+        assert self.handler.transactions == 1
+
+    def test_create_delete_gives_nothing(self):
+        self.coalescer.dispatch(FileCreatedEvent('/a'))
+        self.coalescer.dispatch(FileModifiedEvent('/a'))
+        self.coalescer.dispatch(FileDeletedEvent('/a'))
+        self.coalescer.dispatch(FileCreatedEvent('/b'))
+        assert self.flush() == [('created', '/b')]
+
+    def test_delete_create_gives_modify(self):
+        self.coalescer.dispatch(FileDeletedEvent('/a'))
+        self.coalescer.dispatch(FileCreatedEvent('/a'))
+        assert self.flush() == [('modified', '/a')]
+
+    def test_moves_keep_their_order(self):
+        self.coalescer.dispatch(FileModifiedEvent('/a'))
+        self.coalescer.dispatch(FileMovedEvent('/a', '/b'))
+        self.coalescer.dispatch(FileModifiedEvent('/a'))
+        assert self.flush() == [('modified', '/a'), ('moved', '/a'), ('modified', '/a')]
+        metrics = self.coalescer.get_metrics()
+        assert metrics['events_received'] == 3
+        assert metrics['events_applied'] == 3
+        assert metrics['queue_depth'] == 0
+
+
+class IndexDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.db = os.path.join(tempfile.mkdtemp(), 'pydio.sqlite')
+        conn = sqlite3.connect(self.db)
+        create = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'res', 'create.sql')
+        with open(create) as inserts:
+            for statement in inserts:
+                conn.execute(statement)
+        conn.commit()
+        conn.close()
+        for i in range(5):
+            path = os.path.join(self.base, 'd%i' % i, 'sub')
+            os.makedirs(path)
+            for j in range(10):
+                open(os.path.join(path, 'f%i' % j), 'w').close()
+        # sorted before d0/... by the index, but walked after d0 by a depth first walk
+        open(os.path.join(self.base, 'd0-x'), 'w').close()
+
+    def tearDown(self):
+        SqliteConnections.close_db(self.db)
+        shutil.rmtree(self.base)
+        shutil.rmtree(os.path.dirname(self.db))
+
+    def index(self, exclude=()):
+        conn = sqlite3.connect(self.db)
+        for path in DirectorySnapshot(self.base, recursive=True).paths - set([self.base]) - set(exclude):
+            stat_result = os.stat(path)
+            conn.execute("INSERT INTO ajxp_index (node_path, bytesize, md5, mtime, mode, ino, dev, mtime_ns, ctime_ns) "
+                         "VALUES (?,?,?,?,?,?,?,?,?)", (path[len(self.base):], stat_result.st_size,
+                                                        'directory' if os.path.isdir(path) else 'x',
+                                                        stat_result.st_mtime) + stat_columns(stat_result))
+        conn.commit()
+        conn.close()
+
+    def changes(self, diff):
+        """
+        :return: dict event class name => sorted paths of the events of the walk, (source, target) for the moves
+        """
+        changes = {}
+        for event in diff.walk():
+            path = (event.src_path, event.dest_path) if hasattr(event, 'dest_path') else event.src_path
+            changes.setdefault(type(event).__name__, []).append(path)
+        return dict((name, sorted(paths)) for name, paths in changes.items())
+
+    def test_first_walk_creates_everything(self):
+        progress = []
+        diff = IndexDiff(self.base, self.db, threads=3, progress_interval=0,
+                         progress=lambda count, rate: progress.append(count))
+        changes = self.changes(diff)
+        assert sorted(changes) == ['DirCreatedEvent', 'FileCreatedEvent']
+        reference = DirectorySnapshot(self.base, recursive=True).paths - set([self.base])
+        assert set(changes['DirCreatedEvent'] + changes['FileCreatedEvent']) == reference
+        assert diff.count == len(reference) == diff.changes_count() and progress and not diff.interrupted
+
+    def test_changes_and_moves(self):
+        self.index()
+        modified = os.path.join(self.base, 'd1', 'sub', 'f1')
+        os.utime(modified, (time.time() + 10, time.time() + 10))
+        os.rename(os.path.join(self.base, 'd0'), os.path.join(self.base, 'e0'))
+        os.unlink(os.path.join(self.base, 'e0', 'sub', 'f0'))
+        os.rename(os.path.join(self.base, 'd2', 'sub', 'f2'), os.path.join(self.base, 'd3', 'sub', 'moved'))
+        os.unlink(os.path.join(self.base, 'd4', 'sub', 'f4'))
+        diff = IndexDiff(self.base, self.db)
+        # the content of the moved folder follows it
+        assert self.changes(diff) == {
+            'FileModifiedEvent': [modified],
+            'DirMovedEvent': [(os.path.join(self.base, 'd0'), os.path.join(self.base, 'e0'))],
+            'FileMovedEvent': [(os.path.join(self.base, 'd2', 'sub', 'f2'),
+                                os.path.join(self.base, 'd3', 'sub', 'moved'))],
+            'FileDeletedEvent': [os.path.join(self.base, 'd4', 'sub', 'f4'), os.path.join(self.base, 'e0', 'sub', 'f0')]}
+        assert diff.changes_count() == 5
+
+    def test_creations_and_deletions_are_streamed(self):
+        self.index()
+        os.rename(os.path.join(self.base, 'd1', 'sub', 'f1'), os.path.join(self.base, 'd1', 'sub', 'f1b'))
+        os.rename(os.path.join(self.base, 'd0', 'sub', 'f0'), os.path.join(self.base, 'd4', 'sub', 'moved'))
+        shutil.rmtree(os.path.join(self.base, 'd2'))
+        diff = IndexDiff(self.base, self.db, move_window=4)
+        events = diff.walk()
+        # given before the end of the walk
+        assert next(events).src_path.startswith(os.path.join(self.base, 'd'))
+        assert diff.count < 30
+        events.close()
+        changes = self.changes(IndexDiff(self.base, self.db, move_window=4))
+        # a rename is found within the window, a move further apart is a deletion and a creation
+        assert changes['FileMovedEvent'] == [(os.path.join(self.base, 'd1', 'sub', 'f1'),
+                                              os.path.join(self.base, 'd1', 'sub', 'f1b'))]
+        assert os.path.join(self.base, 'd0', 'sub', 'f0') in changes['FileDeletedEvent']
+        assert changes['FileCreatedEvent'] == [os.path.join(self.base, 'd4', 'sub', 'moved')]
+        assert os.path.join(self.base, 'd2') in changes['DirDeletedEvent']
+
+    def test_unchanged_directories_are_skipped(self):
+        # never indexed, but its directory is still unchanged
+        ignored = os.path.join(self.base, 'd1', 'sub', '.hidden')
+        open(ignored, 'w').close()
+        self.index(exclude=[ignored])
+        added = os.path.join(self.base, 'd2', 'sub', 'added')
+        open(added, 'w').close()
+        diff = IndexDiff(self.base, self.db, skip_unchanged=True,
+                         included=lambda path: not os.path.basename(path).startswith('.'))
+        assert self.changes(diff) == {'FileCreatedEvent': [added]}
+        assert diff.skipped_directories == 9
+        assert [path for path, dir_stat in diff.changed_directories] == [os.path.dirname(added)]
+
+    def test_directories_unchanged_since_a_clean_stop_are_not_listed(self):
+        self.index()
+        # changes found by the watcher do not refresh the indexed mtime of their directory
+        conn = sqlite3.connect(self.db)
+        conn.execute("UPDATE ajxp_index SET mtime_ns=0 WHERE node_path=?", ('/d1/sub',))
+        conn.commit()
+        conn.close()
+        added = os.path.join(self.base, 'd2', 'sub', 'added')
+        open(added, 'w').close()
+        os.utime(os.path.join(self.base, 'd2', 'sub'), (time.time() + 100, time.time() + 100))
+        diff = IndexDiff(self.base, self.db, skip_unchanged=True, unchanged_since=time.time() + 50)
+        assert self.changes(diff) == {'FileCreatedEvent': [added]}
+        # all but the root and d2/sub
+        assert diff.skipped_directories == 9
+        assert sorted(path for path, dir_stat in diff.changed_directories) == [os.path.join(self.base, 'd1', 'sub'),
+                                                                               os.path.join(self.base, 'd2', 'sub')]
+
+    def test_interrupted_walk(self):
+        diff = IndexDiff(self.base, self.db, threads=2, interrupt=lambda: True)
+        assert self.changes(diff) == {}
+        assert diff.interrupted and diff.changes_count() == 0
+
+    def test_snapshot_gives_the_same_diff(self):
+        self.index()
+        snapshot_path = os.path.join(os.path.dirname(self.db), 'pydio.snapshot')
+        conn = SqliteConnections.for_db(self.db).open()
+        assert write_index_snapshot(conn, snapshot_path) == 61
+        modified = os.path.join(self.base, 'd1', 'sub', 'f1')
+        os.utime(modified, (time.time() + 10, time.time() + 10))
+        os.rename(os.path.join(self.base, 'd2', 'sub', 'f2'), os.path.join(self.base, 'd3', 'sub', 'moved'))
+        os.unlink(os.path.join(self.base, 'd4', 'sub', 'f4'))
+        for sub_folder in (None, '/d1', '/d0'):
+            snapshot = IndexSnapshot.load(snapshot_path, conn)
+            with_snapshot = IndexDiff(self.base, self.db, sub_folder=sub_folder, snapshot=snapshot)
+            without = IndexDiff(self.base, self.db, sub_folder=sub_folder)
+            assert self.changes(with_snapshot) == self.changes(without)
+            snapshot.close()
+            assert with_snapshot.count == without.count
+        # stat updates do not always reach the journal, they change the stamp all the same
+        conn.execute("INSERT INTO ajxp_trigger_guard (scope) VALUES ('journal')")
+        conn.execute("UPDATE ajxp_index SET mtime_ns=mtime_ns+1 WHERE node_path=?", ('/d0-x',))
+        conn.commit()
+        assert IndexSnapshot.load(snapshot_path, conn) is None
+        conn.close()
+
+
+class EventRecorder(object):
+
+    def __init__(self):
+        self.events = []
+
+    def dispatch(self, event):
+        self.events.append((event.event_type, event.src_path, getattr(event, 'dest_path', None)))
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux')
+class InotifyObserverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = unicode(tempfile.mkdtemp())
+        for path in ('a/b', 'c'):
+            os.makedirs(os.path.join(self.base, path))
+        self.recorder = EventRecorder()
+        self.rescans = []
+        self.observer = None
+
+    def tearDown(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+        shutil.rmtree(self.base)
+
+    def start(self, **kwargs):
+        self.observer = InotifyObserver(rescan=lambda sub_folder, skip_unchanged: self.rescans.append(
+            (sub_folder, skip_unchanged)), **kwargs)
+        self.observer.schedule(self.recorder, self.base)
+        self.observer.start()
+        while not self.observer.get_metrics()['watches']:
+            time.sleep(0.05)
+
+    def wait_for_polled(self, count):
+        deadline = time.time() + 5
+        while self.observer.get_metrics()['polled_directories'] < count and time.time() < deadline:
+            time.sleep(0.05)
+
+    def path(self, *names):
+        return os.path.join(self.base, *names)
+
+    def test_events(self):
+        outside = tempfile.mkdtemp()
+        self.start()
+        open(self.path('a', 'f'), 'w').close()
+        # its content is created before the new directory is watched
+        os.makedirs(self.path('new', 'sub'))
+        open(self.path('new', 'sub', 'g'), 'w').close()
+        os.rename(self.path('a', 'f'), self.path('c', 'f'))
+        os.rename(self.path('a', 'b'), self.path('c', 'b'))
+        os.rename(self.path('c', 'b'), os.path.join(outside, 'b'))
+        time.sleep(1)
+        open(self.path('new', 'sub', 'h'), 'w').close()
+        time.sleep(0.5)
+        shutil.rmtree(outside)
+        events = self.recorder.events
+        assert ('created', self.path('new', 'sub', 'g'), None) in events
+        assert ('created', self.path('new', 'sub', 'h'), None) in events
+        assert ('moved', self.path('a', 'f'), self.path('c', 'f')) in events
+        assert ('moved', self.path('a', 'b'), self.path('c', 'b')) in events
+        assert ('deleted', self.path('c', 'b'), None) in events
+        assert self.observer.get_metrics()['watches'] == 5
+
+    def test_watch_budget(self):
+        self.start(max_watches=2, poll_interval=0.2)
+        self.wait_for_polled(2)
+        metrics = self.observer.get_metrics()
+        assert (metrics['watches'], metrics['polled_directories']) == (2, 2)
+        open(self.path('c', 'f'), 'w').close()
+        time.sleep(1)
+        # c changed and took the watch of a, that never changed
+        assert self.rescans == [('/c', False)]
+        assert self.observer.get_metrics()['promotions'] == 1
+        open(self.path('c', 'g'), 'w').close()
+        time.sleep(0.5)
+        assert ('created', self.path('c', 'g'), None) in self.recorder.events
+
+    def test_polled_file_modified(self):
+        with open(self.path('a', 'b', 'f'), 'w') as f:
+            f.write('before')
+        self.start(max_watches=2, poll_interval=0.2)
+        self.wait_for_polled(2)
+        assert self.path('a', 'b') in self.observer.polled
+        with open(self.path('a', 'b', 'f'), 'a') as f:
+            f.write(', after')
+        time.sleep(1)
+        assert ('modified', self.path('a', 'b', 'f'), None) in self.recorder.events
+        assert self.rescans == []
+
+    def test_overflow_rescans_active_directories(self):
+        self.start()
+        open(self.path('a', 'b', 'f'), 'w').close()
+        deadline = time.time() + 5
+        while self.path('a', 'b') not in self.observer.last_activity and time.time() < deadline:
+            time.sleep(0.05)
+        self.observer.handle_event(-1, IN_Q_OVERFLOW, 0, '')
+        # then the whole folder, where the lost events may belong too
+        assert self.rescans == [('/a/b', False), ('/', True)]
+        assert self.observer.get_metrics()['overflows'] == 1
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, stats):
+        self._stat_info = self.stat_snapshot = stats
+        self.paths = set(stats)
+
+    def stat_info(self, path):
+        return self._stat_info[path]
+
+
+class SnapshotDiffStartTest(unittest.TestCase):
+
+    def stat(self, ino, size=0, mtime=1, is_dir=False):
+        return IndexStat(0o40755 if is_dir else 0o100644, ino, 1, size, mtime * 10 ** 9, mtime * 10 ** 9)
+
+    def test_moves_by_inode(self):
+        count = 20000
+        old = dict(('/old/f%i' % i, self.stat(i + 10)) for i in range(count))
+        old['/old'] = self.stat(1, is_dir=True)
+        new = dict(('/new/g%i' % i, self.stat(i + 10)) for i in range(count))
+        new['/new'] = self.stat(1, is_dir=True)
+        ref, current = FakeSnapshot(old), FakeSnapshot(new)
+        start = time.time()
+        diff = SnapshotDiffStart(ref, current)
+        assert time.time() - start < 5
+        assert diff.dirs_moved == [('/old', '/new')]
+        assert sorted(diff.files_moved)[:2] == [('/old/f0', '/new/g0'), ('/old/f1', '/new/g1')]
+        assert len(diff.files_moved) == count
+        assert not diff.files_created and not diff.files_deleted
+
+    def test_moves_by_size_and_mtime(self):
+        ref = FakeSnapshot({'/a': self.stat(1, 10, 5), '/b': self.stat(2, 20, 5), '/c': self.stat(3, 20, 5)})
+        # new inodes: only the unambiguous file is a move
+        current = FakeSnapshot({'/a2': self.stat(4, 10, 5), '/b2': self.stat(5, 20, 5)})
+        diff = SnapshotDiffStart(ref, current)
+        assert diff.files_moved == [('/a', '/a2')]
+        assert diff.files_created == ['/b2']
+        assert sorted(diff.files_deleted) == ['/b', '/c']
+
+
+class SettleQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(b'x')
+        self.settled = []
+        self.queue = SettleQueue(self.settled.append, interval=0.2)
+
+    def tearDown(self):
+        self.queue.stop()
+        shutil.rmtree(self.base)
+
+    def test_growing_file_is_released_once(self):
+        assert self.queue.hold(FileCreatedEvent(self.path))
+        assert self.queue.hold(FileModifiedEvent(self.path))
+        self.queue.start()
+        for i in range(3):
+            with open(self.path, 'ab') as f:
+                f.write(b'x')
+            time.sleep(0.1)
+        assert self.settled == []
+        time.sleep(0.5)
+        assert [(e.event_type, e.src_path) for e in self.settled] == [('modified', self.path)]
+        # the released event goes through
+        assert not self.queue.hold(self.settled[0])
+        assert self.queue.get_metrics()['settled'] == 1
+
+    def test_old_and_deleted_files_are_not_held(self):
+        os.utime(self.path, (time.time() - 60, time.time() - 60))
+        assert not self.queue.hold(FileModifiedEvent(self.path))
+        os.utime(self.path, None)
+        assert self.queue.hold(FileModifiedEvent(self.path))
+        assert not self.queue.hold(FileDeletedEvent(self.path))
+        assert self.queue.get_metrics()['settling'] == 0
+
+    def test_unreadable_file_backs_off(self):
+        self.queue.retry(self.path)
+        first = self.queue.pending[self.path]['next']
+        self.queue.retry(self.path)
+        assert self.queue.pending[self.path]['next'] > first
+        assert self.queue.get_metrics()['open_retries'] == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -73,6 +73,7 @@ import encodings
 # from flask_restful import Api
 import argparse
 import json
+import multiprocessing
 import thread
 import time
 from pathlib import Path
@@ -316,5 +317,6 @@ def setup_logging(verbosity=None, application_path=None):
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
     manager.wait()
@@ -1,13 +1,22 @@
+PRAGMA auto_vacuum = INCREMENTAL
 CREATE TABLE ajxp_changes ( seq INTEGER PRIMARY KEY AUTOINCREMENT, node_id NUMERIC, type TEXT, source TEXT, target TEXT, deleted_md5 TEXT )
-CREATE TABLE ajxp_index ( node_id INTEGER PRIMARY KEY AUTOINCREMENT, node_path TEXT, bytesize NUMERIC, md5 TEXT, mtime NUMERIC, stat_result BLOB)
+CREATE TABLE ajxp_index ( node_id INTEGER PRIMARY KEY AUTOINCREMENT, node_path TEXT, bytesize NUMERIC, md5 TEXT, mtime NUMERIC, mode INTEGER, ino INTEGER, dev INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, fingerprint TEXT)
 CREATE TABLE "ajxp_node_status" ("node_id" INTEGER PRIMARY KEY  NOT NULL , "status" TEXT NOT NULL  DEFAULT 'NEW', "detail" TEXT)
+CREATE TABLE ajxp_hash_cache ( dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, md5 TEXT )
+CREATE TABLE ajxp_deleted ( node_id INTEGER PRIMARY KEY, seq INTEGER, basename TEXT, md5 TEXT, source TEXT, fingerprint TEXT )
+CREATE TABLE ajxp_trigger_guard ( scope TEXT PRIMARY KEY )
+CREATE TABLE ajxp_dir_status ( dir_path TEXT PRIMARY KEY, pending INTEGER NOT NULL DEFAULT 0, conflict INTEGER NOT NULL DEFAULT 0 )
 CREATE TABLE events (id INTEGER PRIMARY KEY AUTOINCREMENT, type text, message text, source text, target text, action text, status text, date text)
 
-CREATE TRIGGER LOG_DELETE AFTER DELETE ON ajxp_index BEGIN INSERT INTO ajxp_changes (node_id,source,target,type,deleted_md5) VALUES (old.node_id, old.node_path, "NULL", "delete", old.md5); END
+CREATE TRIGGER LOG_DELETE AFTER DELETE ON ajxp_index BEGIN INSERT INTO ajxp_changes (node_id,source,target,type,deleted_md5) VALUES (old.node_id, old.node_path, "NULL", "delete", old.md5); INSERT OR REPLACE INTO ajxp_deleted (node_id,seq,basename,md5,fingerprint,source) VALUES (old.node_id, last_insert_rowid(), substr(old.node_path, length(rtrim(old.node_path, replace(replace(old.node_path, '/', ''), '\', ''))) + 1), old.md5, old.fingerprint, old.node_path); END
 CREATE TRIGGER LOG_INSERT AFTER INSERT ON ajxp_index BEGIN INSERT INTO ajxp_changes (node_id,source,target,type) VALUES (new.node_id, "NULL", new.node_path, "create"); END
-CREATE TRIGGER "LOG_UPDATE_CONTENT" AFTER UPDATE ON "ajxp_index" FOR EACH ROW BEGIN INSERT INTO "ajxp_changes" (node_id,source,target,type) VALUES (new.node_id, old.node_path, new.node_path, CASE WHEN old.node_path = new.node_path THEN "content" ELSE "path" END);END
-CREATE TRIGGER "STATUS_DELETE" AFTER DELETE ON "ajxp_index" BEGIN DELETE FROM ajxp_node_status WHERE node_id=old.node_id; END
+CREATE TRIGGER "LOG_UPDATE_CONTENT" AFTER UPDATE ON "ajxp_index" FOR EACH ROW WHEN NOT EXISTS (SELECT 1 FROM ajxp_trigger_guard WHERE scope='journal') BEGIN INSERT INTO "ajxp_changes" (node_id,source,target,type) VALUES (new.node_id, old.node_path, new.node_path, CASE WHEN old.node_path = new.node_path THEN "content" ELSE "path" END);END
+CREATE TRIGGER "STATUS_DELETE" AFTER DELETE ON "ajxp_index" BEGIN UPDATE ajxp_dir_status SET pending=pending-(SELECT count(*) FROM ajxp_node_status WHERE node_id=old.node_id AND status NOT IN ('IDLE','CONFLICT')), conflict=conflict-(SELECT count(*) FROM ajxp_node_status WHERE node_id=old.node_id AND status='CONFLICT') WHERE dir_path=substr(old.node_path, 1, length(rtrim(old.node_path, replace(replace(old.node_path, '/', ''), '\', ''))) - 1); DELETE FROM ajxp_dir_status WHERE dir_path=substr(old.node_path, 1, length(rtrim(old.node_path, replace(replace(old.node_path, '/', ''), '\', ''))) - 1) AND pending<=0 AND conflict<=0; DELETE FROM ajxp_node_status WHERE node_id=old.node_id; END
 CREATE TRIGGER "STATUS_INSERT" AFTER INSERT ON "ajxp_index" BEGIN INSERT INTO ajxp_node_status (node_id) VALUES (new.node_id); END
+CREATE TRIGGER DELETED_REUSE AFTER INSERT ON ajxp_index BEGIN DELETE FROM ajxp_deleted WHERE node_id=new.node_id; END
+CREATE TRIGGER DIR_STATUS_INSERT AFTER INSERT ON ajxp_node_status WHEN new.status<>'IDLE' BEGIN INSERT OR IGNORE INTO ajxp_dir_status (dir_path,pending,conflict) SELECT (SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=new.node_id), 0, 0 WHERE (SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=new.node_id) IS NOT NULL AND (new.status NOT IN ('IDLE','CONFLICT')) + (new.status='CONFLICT') > 0; UPDATE ajxp_dir_status SET pending=pending+(new.status NOT IN ('IDLE','CONFLICT')), conflict=conflict+(new.status='CONFLICT') WHERE dir_path=(SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=new.node_id); END
+CREATE TRIGGER DIR_STATUS_UPDATE AFTER UPDATE OF status ON ajxp_node_status WHEN old.status<>new.status BEGIN UPDATE ajxp_dir_status SET pending=pending-(old.status NOT IN ('IDLE','CONFLICT')), conflict=conflict-(old.status='CONFLICT') WHERE dir_path=(SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=old.node_id); DELETE FROM ajxp_dir_status WHERE dir_path=(SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=old.node_id) AND pending<=0 AND conflict<=0; INSERT OR IGNORE INTO ajxp_dir_status (dir_path,pending,conflict) SELECT (SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=new.node_id), 0, 0 WHERE (SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=new.node_id) IS NOT NULL AND (new.status NOT IN ('IDLE','CONFLICT')) + (new.status='CONFLICT') > 0; UPDATE ajxp_dir_status SET pending=pending+(new.status NOT IN ('IDLE','CONFLICT')), conflict=conflict+(new.status='CONFLICT') WHERE dir_path=(SELECT substr(node_path, 1, length(rtrim(node_path, replace(replace(node_path, '/', ''), '\', ''))) - 1) FROM ajxp_index WHERE node_id=new.node_id); END
+CREATE TRIGGER DIR_STATUS_MOVE AFTER UPDATE OF node_path ON ajxp_index WHEN substr(old.node_path, 1, length(rtrim(old.node_path, replace(replace(old.node_path, '/', ''), '\', ''))) - 1)<>substr(new.node_path, 1, length(rtrim(new.node_path, replace(replace(new.node_path, '/', ''), '\', ''))) - 1) BEGIN UPDATE ajxp_dir_status SET pending=pending-(SELECT count(*) FROM ajxp_node_status WHERE node_id=old.node_id AND status NOT IN ('IDLE','CONFLICT')), conflict=conflict-(SELECT count(*) FROM ajxp_node_status WHERE node_id=old.node_id AND status='CONFLICT') WHERE dir_path=substr(old.node_path, 1, length(rtrim(old.node_path, replace(replace(old.node_path, '/', ''), '\', ''))) - 1); DELETE FROM ajxp_dir_status WHERE dir_path=substr(old.node_path, 1, length(rtrim(old.node_path, replace(replace(old.node_path, '/', ''), '\', ''))) - 1) AND pending<=0 AND conflict<=0; INSERT OR IGNORE INTO ajxp_dir_status (dir_path,pending,conflict) SELECT substr(new.node_path, 1, length(rtrim(new.node_path, replace(replace(new.node_path, '/', ''), '\', ''))) - 1), 0, 0 WHERE substr(new.node_path, 1, length(rtrim(new.node_path, replace(replace(new.node_path, '/', ''), '\', ''))) - 1) IS NOT NULL AND (SELECT count(*) FROM ajxp_node_status WHERE node_id=new.node_id AND status NOT IN ('IDLE','CONFLICT')) + (SELECT count(*) FROM ajxp_node_status WHERE node_id=new.node_id AND status='CONFLICT') > 0; UPDATE ajxp_dir_status SET pending=pending+(SELECT count(*) FROM ajxp_node_status WHERE node_id=new.node_id AND status NOT IN ('IDLE','CONFLICT')), conflict=conflict+(SELECT count(*) FROM ajxp_node_status WHERE node_id=new.node_id AND status='CONFLICT') WHERE dir_path=substr(new.node_path, 1, length(rtrim(new.node_path, replace(replace(new.node_path, '/', ''), '\', ''))) - 1); END
 
 CREATE INDEX changes_node_id ON ajxp_changes( node_id )
 CREATE INDEX changes_type ON ajxp_changes( type )
@@ -16,4 +25,10 @@ CREATE INDEX index_node_id ON ajxp_index( node_id )
 CREATE INDEX index_node_path ON ajxp_index( node_path )
 CREATE INDEX index_bytesize ON ajxp_index( bytesize )
 CREATE INDEX index_md5 ON ajxp_index( md5 )
-CREATE INDEX node_status_status ON ajxp_node_status( status )
\ No newline at end of file
+CREATE INDEX node_status_status ON ajxp_node_status( status )
+CREATE UNIQUE INDEX hash_cache_inode ON ajxp_hash_cache( dev, ino )
+CREATE INDEX deleted_basename_md5 ON ajxp_deleted( basename, md5 )
+CREATE INDEX deleted_seq ON ajxp_deleted( seq )
+CREATE INDEX deleted_basename_fingerprint ON ajxp_deleted( basename, fingerprint )
+
+PRAGMA user_version = 7
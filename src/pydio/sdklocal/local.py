@@ -41,11 +41,12 @@ except ImportError:
 
 class SystemSdk(object):
 
-    def __init__(self, basepath):
+    def __init__(self, basepath, hash_cache=None):
         """
         Encapsulate some filesystem functions. We should try to make SystemSdk and PydioSdk converge
         with a same interface, wich would allow syncing any "nodes", not necessarily one remote and one local.
         :param basepath: root folder path
+        :param hash_cache: pydio.job.localdb.HashCache, avoids re-hashing files that did not change
         :return:
         """
         self.signature_extension = '.sync_signature'
@@ -53,6 +54,7 @@ class SystemSdk(object):
         self.path_extension = '.sync_patched'
         self.basepath = basepath
         self.rdiff_path = ConfigManager.Instance().get_rdiff_path()
+        self.hash_cache = hash_cache
 
     def check_basepath(self):
         """
@@ -101,7 +103,11 @@ class SystemSdk(object):
             s['inode'] = stat_result.st_ino
             if with_hash:
                 if stat.S_ISREG(stat_result.st_mode):
-                    s['hash'] = hashfile(open(path, 'rb'), hashlib.md5())
+                    if self.hash_cache is not None:
+                        s['hash'] = self.hash_cache.hash(path, stat_result)
+                    else:
+                        with open(path, 'rb') as fd:
+                            s['hash'] = hashfile(fd, hashlib.md5())
                 elif stat.S_ISDIR(stat_result.st_mode):
                     s['hash'] = 'directory'
             return s
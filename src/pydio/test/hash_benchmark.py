@@ -0,0 +1,89 @@
+#
+# Copyright 2007-2014 Charles du Jeu - Abstrium SAS <team (at) pyd.io>
+# This file is part of Pydio.
+#
+#  Pydio is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Pydio is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Pydio.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The latest code can be found at <http://pyd.io/>.
+#
+"""
+Throughput of utils.functions.hashfile, compared to the former 64KB read loop.
+    python -m pydio.test.hash_benchmark [--size MB] [--runs N] [--file PATH]
+The first run of each method warms the page cache, the best run is reported.
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+try:
+    from pydio.utils.functions import hashfile, hash_providers
+except ImportError:
+    from utils.functions import hashfile, hash_providers
+
+
+def chunked_hash(afile, hasher, blocksize=65536):
+    buf = afile.read(blocksize)
+    while len(buf) > 0:
+        hasher.update(buf)
+        buf = afile.read(blocksize)
+    return hasher.hexdigest()
+
+
+def measure(path, method, runs):
+    best = None
+    for i in range(runs):
+        with open(path, 'rb') as fd:
+            start = time.time()
+            method(fd)
+            elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hashing throughput benchmark')
+    parser.add_argument('--size', type=int, default=512, help='size of the generated test file, in MB')
+    parser.add_argument('--runs', type=int, default=3, help='runs per method, the best one is kept')
+    parser.add_argument('--file', help='hash this file instead of a generated one')
+    parser.add_argument('--blocksize', type=int, default=None, help='block size given to hashfile, in bytes')
+    args = parser.parse_args(argv)
+
+    path = args.file
+    if not path:
+        fd, path = tempfile.mkstemp(prefix='pydio_hash_bench')
+        with os.fdopen(fd, 'wb') as f:
+            chunk = os.urandom(1024 * 1024)
+            for i in range(args.size):
+                f.write(chunk)
+    size = os.path.getsize(path)
+    methods = [
+        ('md5, 64KB read loop', lambda fd: chunked_hash(fd, hashlib.md5())),
+        ('md5, readinto', lambda fd: hashfile(fd, hashlib.md5(), args.blocksize)),
+    ]
+    for name, factory in sorted(hash_providers().items()):
+        if name != 'md5':
+            methods.append((name + ', hashfile', lambda fd, factory=factory: hashfile(fd, factory(), args.blocksize)))
+    try:
+        print('Hashing %i MB' % (size // (1024 * 1024)))
+        for name, method in methods:
+            elapsed = measure(path, method, args.runs)
+            print('%-24s %8.1f MB/s' % (name, size / (1024.0 * 1024.0) / max(elapsed, 1e-6)))
+    finally:
+        if not args.file:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
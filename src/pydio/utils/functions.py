@@ -21,32 +21,133 @@ import os,sys
 import urllib2
 import logging
 import time
-
-def hashfile(afile, hasher, blocksize=65536):
+import hashlib
+# Optional faster hash algorithms, used for local change detection only
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = False
+try:
+    import xxhash
+except ImportError:
+    xxhash = False
+# os.scandir is Python 3.5+, the scandir package is its backport
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = False
+
+# Read size of hashfile()
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hashfile(afile, hasher, blocksize=None):
     """
     Hash a fd
     :param afile: a file descriptor, WARNING don't forget to close it in the caller, check with p = psutil.Processor(); len(p.open_files())
     :param hasher: usually hashlib.md5()
-    :param blocksize: the size of the chunks
+    :param blocksize: the size of the chunks, HASH_BLOCK_SIZE by default
     :return: hash of fd using hasher and blocksize
     """
-    #ts = time.time()
-    buf = afile.read(blocksize)
-    while len(buf) > 0:
-        hasher.update(buf)
-        buf = afile.read(blocksize)
-    res = hasher.hexdigest()
-    if res == "d41d8cd98f00b204e9800998ecf8427e":  # empty file
-        time.sleep(.2)
-        #logging.info("DOUBLE HASH")
+    blocksize = blocksize or HASH_BLOCK_SIZE
+    # no memory map here: a file truncated by another program while mapped kills the process with SIGBUS
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    for attempt in range(2):
+        total = 0
+        read = afile.readinto(buf)
+        while read:
+            hasher.update(view[:read])
+            total += read
+            read = afile.readinto(buf)
+        if total or not os.fstat(afile.fileno()).st_size:
+            break
+        # the file was still empty when read but its content has been written since, nothing was hashed yet
         afile.seek(0)
-        buf = afile.read(blocksize)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(blocksize)
-        res = hasher.hexdigest()
-    #logging.info(" HASHED " + afile.name + " " + str(res) + " in " + str(time.time()-ts) + "s")
-    return res
+    return hasher.hexdigest()
+
+
+def blake2b_128():
+    return blake2b(digest_size=16)
+
+
+def hash_providers():
+    """
+    Hash algorithms available on this machine. MD5 is always there, it is the one the server speaks.
+    :return: dict algorithm name => function returning a new hashlib-like object
+    """
+    providers = {'md5': hashlib.md5}
+    if blake2b:
+        providers['blake2b'] = blake2b_128
+    if xxhash:
+        providers['xxh64'] = xxhash.xxh64
+    return providers
+
+
+def get_hasher(algorithm='md5'):
+    """
+    :param algorithm: name of one of the hash_providers()
+    :return: a new hasher, md5 if the algorithm is not available here
+    """
+    providers = hash_providers()
+    if algorithm not in providers:
+        logging.warning('Hash algorithm %s is not available, using md5' % algorithm)
+        algorithm = 'md5'
+    return providers[algorithm]()
+
+
+def stat_columns(stat_result):
+    """
+    Integer representation of a stat, as stored in the local index
+    :param stat_result: os.stat_result
+    :return: tuple (st_mode, st_ino, st_dev, st_mtime_ns, st_ctime_ns). SQLite integers are signed 64 bits, inode
+    and device numbers using the full unsigned range are wrapped.
+    """
+    def int64(value):
+        value = int(value)
+        return value - 2 ** 64 if value >= 2 ** 63 else value
+
+    mtime_ns = getattr(stat_result, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(stat_result.st_mtime * 1e9))
+    ctime_ns = getattr(stat_result, 'st_ctime_ns', None)
+    if ctime_ns is None:
+        ctime_ns = int(round(stat_result.st_ctime * 1e9))
+    return stat_result.st_mode, int64(stat_result.st_ino), int64(stat_result.st_dev), mtime_ns, ctime_ns
+
+
+def same_mtime(mtime_ns, other_mtime_ns):
+    """
+    Stats read through a float (os.stat on python 2) lose the last hundreds of nanoseconds of the mtime, while
+    scandir stats keep them: compare the mtimes at the microsecond.
+    """
+    return mtime_ns is not None and other_mtime_ns is not None and abs(mtime_ns - other_mtime_ns) < 1000
+
+
+def scan_dir(path):
+    """
+    List a directory with the stat of its entries, using scandir when available
+    :param path: full path of the directory
+    :return: iterator of tuples (name, stat_result), entries that vanish while listing are skipped
+    """
+    if scandir:
+        for entry in scandir(path):
+            try:
+                yield entry.name, entry.stat()
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(path):
+            try:
+                yield name, os.stat(os.path.join(path, name))
+            except OSError:
+                continue
 
 
 def set_file_hidden(path):
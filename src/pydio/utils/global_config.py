@@ -208,6 +208,14 @@ class GlobalConfigManager:
                 "last_update_date": 0
             },
             "max_wait_time_for_local_db_access": 30,
+            "local_events_window": 1,
+            "local_settle_interval": 2,
+            "local_walk_threads": 8,
+            "local_full_scan_interval": 86400,
+            "local_index_snapshot": True,
+            "local_watcher_backend": "inotify",
+            "local_inotify_max_watches": 0,
+            "local_unwatched_poll_interval": 30,
             "language": ""
         }
 